@@ -13,9 +13,8 @@ This script is designed to run with a configuration parameter
 
 import pandas as pd
 import numpy as np
-import io
 import zipfile
-from flowsa.common import log, get_all_state_FIPS_2
+from flowsa.common import log, get_all_state_FIPS_2, response_file
 from flowsa.flowbyfunctions import assign_fips_location_system
 
 
@@ -41,7 +40,7 @@ def bls_qcew_call(url, qcew_response, args):
         # initiate dataframes list
         df_list = []
         # unzip folder that contains bls data in ~4000 csv files
-        with zipfile.ZipFile(io.BytesIO(qcew_response.content), "r") as f:
+        with zipfile.ZipFile(response_file(qcew_response), "r") as f:
             # read in file names
             for name in f.namelist():
                 # Only want state info
@@ -57,7 +56,7 @@ def bls_qcew_call(url, qcew_response, args):
                     df = df.rename(columns={'annual_avg_estabs_count': 'annual_avg_estabs'})
             return df
     else:
-        df = pd.read_csv(io.StringIO(qcew_response.content.decode('utf-8')))
+        df = pd.read_csv(response_file(qcew_response), encoding='utf-8')
         df = df[['area_fips', 'own_code', 'industry_code', 'year',
                  'annual_avg_estabs', 'annual_avg_emplvl', 'total_annual_wages']]
         return df
@@ -32,8 +32,8 @@ def eia_cbecs_URL_helper(build_url, config, args):
 
 def eia_cbecs_call(url, cbesc_response, args):
     # Convert response to dataframe
-    df_raw_data = pd.io.excel.read_excel(io.BytesIO(cbesc_response.content), sheet_name='data').dropna()
-    df_raw_rse = pd.io.excel.read_excel(io.BytesIO(cbesc_response.content), sheet_name='rse').dropna()
+    df_raw_data = pd.io.excel.read_excel(response_file(cbesc_response), sheet_name='data').dropna()
+    df_raw_rse = pd.io.excel.read_excel(response_file(cbesc_response), sheet_name='rse').dropna()
 
     if("b5.xlsx" in url):
         # skip rows and remove extra rows at end of dataframe
@@ -6,13 +6,12 @@ Pulls EIA CBECS water use data for large buildings from 2012
 '''
 
 import pandas as pd
-import io
-from flowsa.common import US_FIPS, withdrawn_keyword
+from flowsa.common import US_FIPS, withdrawn_keyword, response_file
 from flowsa.flowbyfunctions import assign_fips_location_system
 
 def eia_cbecs_call(url, response_load, args):
     # Convert response to dataframe
-    df_raw = pd.io.excel.read_excel(io.BytesIO(response_load.content), sheet_name='data').dropna()
+    df_raw = pd.io.excel.read_excel(response_file(response_load), sheet_name='data').dropna()
     # skip rows and remove extra rows at end of dataframe
     df = pd.DataFrame(df_raw.loc[10:25]).reindex()
     # set column headers
@@ -48,8 +48,8 @@ def eia_mecs_URL_helper(build_url, config, args):
 
 def eia_mecs_land_call(url, cbesc_response, args):
     # Convert response to dataframe
-    df_raw_data = pd.io.excel.read_excel(io.BytesIO(cbesc_response.content), sheet_name='Table 9.1')
-    df_raw_rse = pd.io.excel.read_excel(io.BytesIO(cbesc_response.content), sheet_name='RSE 9.1')
+    df_raw_data = pd.io.excel.read_excel(response_file(cbesc_response), sheet_name='Table 9.1')
+    df_raw_rse = pd.io.excel.read_excel(response_file(cbesc_response), sheet_name='RSE 9.1')
     if (args["year"] == "2014"):
         df_rse = pd.DataFrame(df_raw_rse.loc[12:93]).reindex()
         df_data = pd.DataFrame(df_raw_data.loc[16:97]).reindex()
@@ -184,8 +184,8 @@ def eia_mecs_energy_call(url, cbesc_response, args):
     
     ## read raw data into dataframe
     ## (include both Sheet 1 (data) and Sheet 2 (relative standard errors))
-    df_raw_data = pd.io.excel.read_excel(io.BytesIO(cbesc_response.content), sheet_name=0, header=None)
-    df_raw_rse = pd.io.excel.read_excel(io.BytesIO(cbesc_response.content), sheet_name=1, header=None)
+    df_raw_data = pd.io.excel.read_excel(response_file(cbesc_response), sheet_name=0, header=None)
+    df_raw_rse = pd.io.excel.read_excel(response_file(cbesc_response), sheet_name=1, header=None)
     
     ## retrieve table name from cell A3 of Excel file
     table = df_raw_data.iloc[2][0]
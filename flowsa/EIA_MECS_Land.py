@@ -33,8 +33,8 @@ def eia_mecs_URL_helper(build_url, config, args):
 
 def eia_mecs_call(url, cbesc_response, args):
     # Convert response to dataframe
-    df_raw_data = pd.io.excel.read_excel(io.BytesIO(cbesc_response.content), sheet_name='Table 9.1')
-    df_raw_rse = pd.io.excel.read_excel(io.BytesIO(cbesc_response.content), sheet_name='RSE 9.1')
+    df_raw_data = pd.io.excel.read_excel(response_file(cbesc_response), sheet_name='Table 9.1')
+    df_raw_rse = pd.io.excel.read_excel(response_file(cbesc_response), sheet_name='RSE 9.1')
     if (args["year"] == "2014"):
         df_rse = pd.DataFrame(df_raw_rse.loc[12:93]).reindex()
         df_data = pd.DataFrame(df_raw_data.loc[16:97]).reindex()
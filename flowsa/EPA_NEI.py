@@ -7,7 +7,7 @@ Pulls EPA National Emissions Inventory (NEI) data for nonpoint sources
 import pandas as pd
 import numpy as np
 import zipfile
-import io
+from flowsa.common import response_file
 from flowsa.flowbyfunctions import assign_fips_location_system
 
 def epa_nei_url_helper(build_url, config, args):
@@ -37,7 +37,7 @@ def epa_nei_call(url, response_load, args):
     the individual .csv files. The .csv files are read into a dataframe and 
     concatenated into one master dataframe containing all 10 EPA regions.
     """
-    z = zipfile.ZipFile(io.BytesIO(response_load.content))
+    z = zipfile.ZipFile(response_file(response_load))
     # create a list of files contained in the zip archive
     znames = z.namelist()
     # retain only those files that are in .csv format
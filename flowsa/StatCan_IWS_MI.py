@@ -6,7 +6,6 @@ Pulls Statistics Canada data on water intake and discharge for 3 digit NAICS fro
 '''
 
 import pandas as pd
-import io
 import zipfile
 import pycountry
 from flowsa.common import *
@@ -14,7 +13,7 @@ from flowsa.common import *
 def sc_call(url, sc_response, args):
     # Convert response to dataframe
     # read all files in the stat canada zip
-    with zipfile.ZipFile(io.BytesIO(sc_response.content), "r") as f:
+    with zipfile.ZipFile(response_file(sc_response), "r") as f:
         # read in file names
         for name in f.namelist():
             # if filename does not contain "MetaData", then create dataframe
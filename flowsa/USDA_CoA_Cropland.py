@@ -200,8 +200,7 @@ def disaggregate_pastureland(fba_w_sector, attr):
     """
 
     import flowsa
-    from flowsa.flowbyfunctions import allocate_by_sector, clean_df, flow_by_activity_fields, \
-        fba_fill_na_dict
+    from flowsa.flowbyfunctions import allocate_by_sector
 
 
     # subset the coa data so only pastureland
@@ -212,8 +211,8 @@ def disaggregate_pastureland(fba_w_sector, attr):
     # load usda coa cropland naics
     df_f = flowsa.getFlowByActivity(flowclass=['Land'],
                                     years=[attr['allocation_source_year']],
-                                    datasource='USDA_CoA_Cropland_NAICS')
-    df_f = clean_df(df_f, flow_by_activity_fields, fba_fill_na_dict)
+                                    datasource='USDA_CoA_Cropland_NAICS',
+                                    clean=True)
     # subset to land in farms data
     df_f = df_f[df_f['FlowName'] == 'FARM OPERATIONS']
     # subset to rows related to pastureland
@@ -257,7 +256,7 @@ def disaggregate_cropland(fba_w_sector, attr):
 
     import flowsa
     from flowsa.flowbyfunctions import generalize_activity_field_names, sector_aggregation,\
-        fbs_default_grouping_fields, clean_df, fba_fill_na_dict, add_missing_flow_by_fields
+        fbs_default_grouping_fields, add_missing_flow_by_fields
     from flowsa.mapping import add_sectors_to_flowbyactivity
 
     # drop pastureland data
@@ -268,11 +267,10 @@ def disaggregate_cropland(fba_w_sector, attr):
     crop.loc[:, 'Location_tmp'] = crop['Location'].apply(lambda x: str(x[0:2]))
 
     # load the relevant state level harvested cropland by naics
-    naics_load = flowsa.getFlowByActivity(flowclass=['Land'],
-                                          years=[attr['allocation_source_year']],
-                                          datasource="USDA_CoA_Cropland_NAICS").reset_index(drop=True)
-    # clean df
-    naics = clean_df(naics_load, flow_by_activity_fields, fba_fill_na_dict)
+    naics = flowsa.getFlowByActivity(flowclass=['Land'],
+                                     years=[attr['allocation_source_year']],
+                                     datasource="USDA_CoA_Cropland_NAICS",
+                                     clean=True).reset_index(drop=True)
     # subset the harvested cropland by naics
     naics = naics[naics['FlowName'] == 'AG LAND, CROPLAND, HARVESTED'].reset_index(drop=True)
     # add sectors
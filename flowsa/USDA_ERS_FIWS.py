@@ -11,13 +11,12 @@ Downloads the February 5, 2020 update
 import pandas as pd
 import numpy as np
 import zipfile
-import io
 from flowsa.common import *
 
 
 def fiws_call(url, fiws_response, args):
     # extract data from zip file (only one csv)
-    with zipfile.ZipFile(io.BytesIO(fiws_response.content), "r") as f:
+    with zipfile.ZipFile(response_file(fiws_response), "r") as f:
         # read in file names
         for name in f.namelist():
             data = f.open(name)
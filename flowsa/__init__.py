@@ -6,60 +6,271 @@ Public functions for flowsa
 For standard dataframe formats, see https://github.com/USEPA/flowsa/tree/master/format%20specs
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from flowsa.common import fbaoutputpath, fbsoutputpath, datapath, log
-from flowsa.flowbyfunctions import collapse_fbs_sectors
+import flowsa.database
+from flowsa.common import fbaoutputpath, fbsoutputpath, datapath, log, flow_by_activity_fields, \
+    flow_by_sector_fields, get_flow_by_categorical_cols
+from flowsa.flowbyfunctions import collapse_fbs_sectors, to_string_categorical, clean_df, fba_fill_na_dict, \
+    fbs_fill_na_dict, clean_stamp
+from flowsa.storage import fba_filter_columns, fbs_filter_columns, build_filter_expression, \
+    build_sector_expression, combine_expressions, \
+    read_flowby_parquet, read_flowbyactivity, flowbyactivity_files, iter_flowbyactivity_batches, \
+    fingerprint, read_provenance, stored_clean_stamp
+from flowsa.cache import flowby_cache, set_cache_size, clear_cache, cache_stats
+from flowsa.query import query_fba, query_fbs
+from flowsa.manifest import skip_flowbyactivity_files, read_manifest
+from flowsa.cube import read_flowbysector_cube
+from flowsa.datachecks import compare_fbs
+from flowsa.database import set_database, export_database, database_files, read_database
 
 
-def getFlowByActivity(flowclass, years, datasource):
+def getFlowByActivity(flowclass, years, datasource, columns=None, locations=None, activities=None,
+                      flownames=None, compartments=None, categorical=False, clean=False):
     """
     Retrieves stored data in the FlowByActivity format
     :param flowclass: list, a list of`Class' of the flow. required. E.g. ['Water'] or
      ['Land', 'Other']
     :param year: list, a list of years [2015], or [2010,2011,2012]
     :param datasource: str, the code of the datasource.
+    :param columns: list, optional, the FlowByActivity columns to load. Default loads all columns.
+    :param locations: list, optional, only load flows for these Location codes. E.g. ['06000', '06037']
+    :param activities: list, optional, only load flows where ActivityProducedBy or ActivityConsumedBy is in the list
+    :param flownames: list, optional, only load flows with these FlowNames
+    :param compartments: list, optional, only load flows in these Compartments
+    :param categorical: bool, if True descriptive string columns are loaded as pandas categoricals
+    :param clean: bool, if True return the data cleaned with clean_df. Files stamped as clean when stored skip
+     most of the cleaning.
     :return: a pandas DataFrame in FlowByActivity format
     """
-    fbas = pd.DataFrame()
+    if clean:
+        # the loaded df is cached as read, and cleaned into a new df for each call
+        fbas = getFlowByActivity(flowclass, years, datasource, columns=clean_scan_columns(columns),
+                                 locations=locations, activities=activities, flownames=flownames,
+                                 compartments=compartments, categorical=categorical)
+        stamped = columns is None and not database_files('FBA', datasource, years) and \
+            stored_clean_stamp(flowbyactivity_files(datasource, years)) == clean_stamp(flow_by_activity_fields)
+        return clean_loaded_df(fbas, flow_by_activity_fields, fba_fill_na_dict, columns, categorical, stamped)
     # for assigning dtypes
     fields = {'ActivityProducedBy':'str'}
-    for y in years:
-        try:
-            fba = pd.read_parquet(fbaoutputpath + datasource + "_" + str(y) + ".parquet")
-            fba = fba[fba['Class'].isin(flowclass)]
-            fba = fba.astype(fields)
-            fbas = pd.concat([fbas, fba], sort=False)
-        except FileNotFoundError:
-            log.error("No parquet file found for datasource " + datasource + "and year " + str(
-                y) + " in flowsa")
+    # filters are applied while reading, so row groups and Class partitions without matching flows are skipped
+    filter_expression = build_filter_expression(fba_filter_columns, flowclass=flowclass, locations=locations,
+                                                activities=activities, flownames=flownames,
+                                                compartments=compartments)
+    # a database set with set_database is read instead of the parquet files, if it holds all the years
+    database_sources = database_files('FBA', datasource, years)
+    # loaded data is cached in memory until the parquet files, or the database, change
+    files = [flowsa.database.database_path] if database_sources else flowbyactivity_files(datasource, years)
+    cache_key = ('FBA', datasource, tuple(str(y) for y in years), str(filter_expression),
+                 None if columns is None else tuple(columns), categorical, len(database_sources) > 0)
+    fbas = flowby_cache.get(cache_key, files)
+    if fbas is not None:
+        return fbas
+    dictionary_columns = get_flow_by_categorical_cols(flow_by_activity_fields) if categorical else None
+    if database_sources:
+        fbas = read_database('FBA', database_sources, columns=columns, categorical=categorical, flowclass=flowclass,
+                             locations=locations, activities=activities, flownames=flownames,
+                             compartments=compartments)
+    else:
+        # the output manifest lets files without requested classes or locations be skipped unopened
+        fbas = read_flowbyactivity(datasource, years, columns=columns, filter_expression=filter_expression,
+                                   dictionary_columns=dictionary_columns,
+                                   file_filter=lambda f: skip_flowbyactivity_files(f, flowclass, locations))
+    for k, v in fields.items():
+        if k in fbas.columns:
+            fbas[k] = to_string_categorical(fbas[k]) if categorical else fbas[k].astype(v)
+    flowby_cache.put(cache_key, files, fbas)
     return fbas
 
 
-def getFlowBySector(methodname):
+def clean_scan_columns(columns):
+    """Columns read to return cleaned columns, units are harmonized while cleaning, which needs the amount and unit"""
+    if columns is None:
+        return None
+    return list(columns) + [c for c in ('FlowAmount', 'Unit') if c not in columns]
+
+
+def clean_loaded_df(df, flowbyfields, fill_na_dict, columns=None, categorical=False, stamped=False):
+    """
+    Clean a loaded df with clean_df
+    :param df: flowbyactivity or flowbysector df, read with clean_scan_columns(columns)
+    :param flowbyfields: flow_by_activity_fields or flow_by_sector_fields
+    :param fill_na_dict: fba_fill_na_dict or fbs_fill_na_dict
+    :param columns: list, columns to return, None returns all fields
+    :param categorical: bool, if True the descriptive string fields are returned as pandas categoricals
+    :param stamped: bool, True if all files read are stamped with clean_stamp
+    :return: df
+    """
+    # a missing file or a filter matching nothing loads a df without columns, which is cleaned into an empty df of
+    # the requested fields
+    if columns is None:
+        return clean_df(df, flowbyfields, fill_na_dict, categorical=categorical, stamped=stamped)
+    fields = {k: v for k, v in flowbyfields.items() if k in clean_scan_columns(columns)}
+    df = clean_df(df, fields, fill_na_dict, categorical=categorical)
+    return df[[c for c in columns if c in df.columns]]
+
+
+def getFlowByActivities(requests, max_workers=None):
+    """
+    Retrieves several stored FlowByActivity datasets at once, decoding the parquet files concurrently. Each request
+    goes through getFlowByActivity, so filters are pushed down and loaded data is cached the same way.
+    :param requests: dict of name: dict of getFlowByActivity keyword arguments, or a list of such dicts. E.g.
+     {'usgs': {'flowclass': ['Water'], 'years': [2015], 'datasource': 'USGS_NWIS_WU'}}
+    :param max_workers: int, maximum number of datasets loaded at the same time, defaults to the
+     concurrent.futures default
+    :return: dict of name (or list position): FlowByActivity df
+    """
+    if not isinstance(requests, dict):
+        requests = dict(enumerate(requests))
+    # pyarrow releases the GIL while decoding, so threads load files in parallel
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {k: executor.submit(getFlowByActivity, **v) for k, v in requests.items()}
+        return {k: f.result() for k, f in futures.items()}
+
+
+def iterFlowByActivity(flowclass, years, datasource, columns=None, locations=None, activities=None,
+                       flownames=None, compartments=None, categorical=False, batch_rows=100000):
+    """
+    Streams stored data in the FlowByActivity format in chunks, so large sources can be processed in bounded memory.
+    Filters are the same as getFlowByActivity. Loaded chunks are not cached.
+    :param flowclass: list, a list of`Class' of the flow. required. E.g. ['Water'] or
+     ['Land', 'Other']
+    :param years: list, a list of years [2015], or [2010,2011,2012]
+    :param datasource: str, the code of the datasource.
+    :param columns: list, optional, the FlowByActivity columns to return. Default returns all columns.
+    :param locations: list, optional, only load flows for these Location codes. E.g. ['06000', '06037']
+    :param activities: list, optional, only load flows where ActivityProducedBy or ActivityConsumedBy is in the list
+    :param flownames: list, optional, only load flows with these FlowNames
+    :param compartments: list, optional, only load flows in these Compartments
+    :param categorical: bool, if True descriptive string columns are returned as pandas categoricals
+    :param batch_rows: int, maximum rows per chunk
+    :return: generator of pandas DataFrames in FlowByActivity format, cleaned with clean_df
+    """
+    filter_expression = build_filter_expression(fba_filter_columns, flowclass=flowclass, locations=locations,
+                                                activities=activities, flownames=flownames,
+                                                compartments=compartments)
+    dictionary_columns = get_flow_by_categorical_cols(flow_by_activity_fields) if categorical else None
+    stamped = columns is None and \
+        stored_clean_stamp(flowbyactivity_files(datasource, years)) == clean_stamp(flow_by_activity_fields)
+    batches = iter_flowbyactivity_batches(datasource, years, batch_rows, columns=clean_scan_columns(columns),
+                                          filter_expression=filter_expression,
+                                          dictionary_columns=dictionary_columns,
+                                          file_filter=lambda f: skip_flowbyactivity_files(f, flowclass, locations))
+    for batch in batches:
+        yield clean_loaded_df(batch.to_pandas(), flow_by_activity_fields, fba_fill_na_dict, columns, categorical,
+                              stamped)
+
+
+def getFlowBySector(methodname, columns=None, locations=None, sectors=None, flowables=None, contexts=None,
+                    categorical=False, sector_prefix=None, sector_level=None, clean=False):
     """
     Retrieves stored data in the FlowBySector format
     :param methodname: string, Name of an available method for the given class
+    :param columns: list, optional, the FlowBySector columns to load. Default loads all columns.
+    :param locations: list, optional, only load flows for these Location codes
+    :param sectors: list, optional, only load flows where SectorProducedBy or SectorConsumedBy is in the list
+    :param sector_prefix: str or list, optional, only load flows where SectorProducedBy or SectorConsumedBy starts
+     with one of the prefixes. E.g. ['31', '32', '33'] for manufacturing
+    :param sector_level: int, optional, only load flows where the matching sector has this many digits. E.g. 4
+    :param flowables: list, optional, only load flows for these Flowables
+    :param contexts: list, optional, only load flows in these Contexts
+    :param categorical: bool, if True descriptive string columns are loaded as pandas categoricals
+    :param clean: bool, if True return the data cleaned with clean_df. Files stamped as clean when stored skip
+     most of the cleaning.
     :return: dataframe in flow by sector format
     """
+    if clean:
+        # the loaded df is cached as read, and cleaned into a new df for each call
+        fbs = getFlowBySector(methodname, columns=clean_scan_columns(columns), locations=locations, sectors=sectors,
+                              flowables=flowables, contexts=contexts, categorical=categorical,
+                              sector_prefix=sector_prefix, sector_level=sector_level)
+        stamped = columns is None and not database_files('FBS', methodname) and \
+            stored_clean_stamp([fbsoutputpath + methodname + ".parquet"]) == clean_stamp(flow_by_sector_fields)
+        return clean_loaded_df(fbs, flow_by_sector_fields, fbs_fill_na_dict, columns, categorical, stamped)
     fbs = pd.DataFrame()
-    try:
-        fbs = pd.read_parquet(fbsoutputpath + methodname + ".parquet")
-    except FileNotFoundError:
-        log.error("No parquet file found for datasource " + methodname + " in flowsa")
+    # sector prefixes are read as ranges of the sorted sector columns, skipping row groups outside the ranges
+    filter_expression = combine_expressions(
+        build_filter_expression(fbs_filter_columns, locations=locations, sectors=sectors, flowables=flowables,
+                                contexts=contexts),
+        build_sector_expression(sector_prefix, sector_level))
+    # a database set with set_database is read instead of the parquet file, if it holds the method
+    database_sources = database_files('FBS', methodname)
+    files = [flowsa.database.database_path] if database_sources else [fbsoutputpath + methodname + ".parquet"]
+    cache_key = ('FBS', methodname, str(filter_expression), None if columns is None else tuple(columns), categorical,
+                 len(database_sources) > 0)
+    cached = flowby_cache.get(cache_key, files)
+    if cached is not None:
+        return cached
+    if database_sources:
+        fbs = read_database('FBS', database_sources, columns=columns, categorical=categorical,
+                            sector_prefix=sector_prefix, sector_level=sector_level, locations=locations,
+                            sectors=sectors, flowables=flowables, contexts=contexts)
+    else:
+        dictionary_columns = get_flow_by_categorical_cols(flow_by_sector_fields) if categorical else None
+        try:
+            fbs = read_flowby_parquet(files, columns=columns, filter_expression=filter_expression,
+                                      dictionary_columns=dictionary_columns)
+        except FileNotFoundError:
+            log.error("No parquet file found for datasource " + methodname + " in flowsa")
+            return fbs
+    flowby_cache.put(cache_key, files, fbs)
     return fbs
 
 
 
+def getFlowBySector_cube(methodname, sector_level, geoscale, columns=None, locations=None, sectors=None,
+                         flowables=None, contexts=None, sector_prefix=None):
+    """
+    Retrieves a precomputed rollup of a FlowBySector method, saved when the method is run with the cube option
+    :param methodname: string, Name of an available method for the given class
+    :param sector_level: int, NAICS level of the sectors, 2 to 6
+    :param geoscale: str, national, state, or county, from the method's target geoscale up to national
+    :param columns: list, optional, the FlowBySector columns to load. Default loads all columns.
+    :param locations: list, optional, only load flows for these Location codes
+    :param sectors: list, optional, only load flows where SectorProducedBy or SectorConsumedBy is in the list
+    :param flowables: list, optional, only load flows for these Flowables
+    :param contexts: list, optional, only load flows in these Contexts
+    :param sector_prefix: str or list, optional, only load flows where SectorProducedBy or SectorConsumedBy starts
+     with one of the prefixes
+    :return: dataframe in flow by sector format
+    """
+    return read_flowbysector_cube(methodname, sector_level, geoscale, columns=columns, locations=locations,
+                                  sectors=sectors, flowables=flowables, contexts=contexts,
+                                  sector_prefix=sector_prefix)
+
+
 def getFlowBySector_collapsed(methodname):
     """
     Retrieves stored data in the FlowBySector format,
     :param methodname: string, Name of an available method for the given class
     :return: dataframe in flow by sector format
     """
-
+    # the collapsed file saved with the method is used while it was built from the current FBS parquet
+    fbs_file = fbsoutputpath + methodname + ".parquet"
+    collapsed_file = fbsoutputpath + methodname + "_collapsed.parquet"
+    files = [fbs_file, collapsed_file]
+    # an FBS parquet written without a fingerprint cannot be matched to a collapsed file
+    fbs_fingerprint = fingerprint(fbs_file) if os.path.isfile(fbs_file) else None
+    if fbs_fingerprint is not None and os.path.isfile(collapsed_file) and \
+            read_provenance(collapsed_file).get(methodname + '.parquet') == fbs_fingerprint:
+        cache_key = ('FBS_collapsed', methodname)
+        fbs_collapsed = flowby_cache.get(cache_key, files)
+        if fbs_collapsed is None:
+            fbs_collapsed = read_flowby_parquet(collapsed_file)
+            flowby_cache.put(cache_key, files, fbs_collapsed)
+        return fbs_collapsed
     # load saved FBS parquet
     fbs = getFlowBySector(methodname)
     fbs_collapsed = collapse_fbs_sectors(fbs)
     return fbs_collapsed
 
 
+def getManifest(kind='FBA'):
+    """
+    Lists the stored FlowByActivity or FlowBySector files and their contents, from the output manifest
+    :param kind: str, 'FBA' or 'FBS'
+    :return: dataframe with one row per stored parquet file
+    """
+    outputdir = fbaoutputpath if kind == 'FBA' else fbsoutputpath
+    return pd.DataFrame(read_manifest(outputdir))
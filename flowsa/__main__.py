@@ -0,0 +1,51 @@
+# __main__.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Command line entry point for flowsa, e.g.
+flowsa serve --port 8080
+flowsa export-db --fbs Water_national_2015_m1
+flowsa vintages --source USGS_NWIS_WU --years 2010 2015
+python -m flowsa serve
+"""
+
+import argparse
+
+
+def parse_args(argv=None):
+    """Make subcommand and parameters"""
+    ap = argparse.ArgumentParser(prog='flowsa')
+    subcommands = ap.add_subparsers(dest='command', required=True)
+    serve = subcommands.add_parser('serve', help="Run a local read-only query service for stored FBA/FBS data")
+    serve.add_argument("--host", default='127.0.0.1', help="Address to listen on")
+    serve.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on")
+    serve.add_argument("--cache_bytes", type=int, default=None,
+                       help="Byte budget of each of the loaded and cleaned data caches")
+    export_db = subcommands.add_parser('export-db', help="Load stored FBA/FBS outputs into an indexed SQLite database")
+    export_db.add_argument("-d", "--database", default=None, help="Database file, defaults to output/flowsa.sqlite")
+    export_db.add_argument("--fba", nargs='*', default=None,
+                           help="FlowByActivity sources to export, all if not given, none if given without names")
+    export_db.add_argument("--fbs", nargs='*', default=None,
+                           help="FlowBySector methods to export, all if not given, none if given without names")
+    vintages = subcommands.add_parser('vintages', help="Move stored years of a FlowByActivity source into the "
+                                                       "vintage store, sharing one dictionary per string column")
+    vintages.add_argument("-s", "--source", required=True, help="FlowByActivity source")
+    vintages.add_argument("-y", "--years", nargs='+', required=True, help="Years of the source to move")
+    return vars(ap.parse_args(argv))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args['command'] == 'serve':
+        from flowsa.server import serve
+        serve(args['host'], args['port'], args['cache_bytes'])
+    elif args['command'] == 'export-db':
+        from flowsa.database import export_database, default_database_file
+        export_database(args['database'] or default_database_file, args['fba'], args['fbs'])
+    elif args['command'] == 'vintages':
+        from flowsa.flowbyactivity import store_flowbyactivity_vintages
+        store_flowbyactivity_vintages(args['source'], args['years'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# aio.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+asyncio counterparts of the flowsa data loading and flowbysector build functions.
+Loads run in the I/O executor and method builds in the build executor, so the event loop is never blocked. Both
+executors default to the event loop's default thread pool and can be replaced with set_executors(). A cancelled
+build stops at the next stage of flowbysector.main.
+"""
+
+import asyncio
+import functools
+import threading
+import flowsa
+import flowsa.flowbysector
+
+# executors used by the coroutines, None uses the event loop's default executor
+executors = {'io': None, 'build': None}
+
+
+class BuildCancelled(Exception):
+    """Raised inside flowbysector.main when the coroutine awaiting the build is cancelled"""
+
+
+def set_executors(io=None, build=None):
+    """
+    Set the executors running loads and method builds
+    :param io: concurrent.futures.Executor for parquet loads, None for the event loop default
+    :param build: concurrent.futures.ThreadPoolExecutor for method builds, None for the event loop default. Builds
+     are cancelled through shared memory, so process pools are not supported.
+    :return: None
+    """
+    executors['io'] = io
+    executors['build'] = build
+
+
+async def run_in_executor(kind, fxn, *args, **kwargs):
+    """Run a blocking function in one of the executors"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executors[kind], functools.partial(fxn, *args, **kwargs))
+
+
+async def get_flow_by_activity(flowclass, years, datasource, **kwargs):
+    """
+    Awaitable getFlowByActivity, see flowsa.getFlowByActivity for parameters
+    :return: a pandas DataFrame in FlowByActivity format
+    """
+    return await run_in_executor('io', flowsa.getFlowByActivity, flowclass, years, datasource, **kwargs)
+
+
+async def get_flow_by_activities(requests):
+    """
+    Load several FlowByActivity datasets concurrently, see flowsa.getFlowByActivities
+    :param requests: dict of name: dict of getFlowByActivity keyword arguments, or a list of such dicts
+    :return: dict of name (or list position): FlowByActivity df
+    """
+    if not isinstance(requests, dict):
+        requests = dict(enumerate(requests))
+    dfs = await asyncio.gather(*[get_flow_by_activity(**v) for v in requests.values()])
+    return dict(zip(requests.keys(), dfs))
+
+
+async def get_flow_by_sector(methodname, **kwargs):
+    """
+    Awaitable getFlowBySector, see flowsa.getFlowBySector for parameters
+    :return: dataframe in flow by sector format
+    """
+    return await run_in_executor('io', flowsa.getFlowBySector, methodname, **kwargs)
+
+
+async def build_flow_by_sector(method_name, **kwargs):
+    """
+    Awaitable flowbysector.main. Cancelling the coroutine stops the build before its next stage.
+    :param method_name: Name of method corresponding to flowbysector method yaml name
+    :param kwargs: other flowbysector.main parameters, e.g. cube=True
+    :return: flowbysector df
+    """
+    cancelled = threading.Event()
+
+    def checkpoint(stage):
+        if cancelled.is_set():
+            raise BuildCancelled("Build of " + method_name + " cancelled before " + stage)
+
+    try:
+        return await run_in_executor('build', flowsa.flowbysector.main, method_name, checkpoint=checkpoint, **kwargs)
+    except asyncio.CancelledError:
+        # the worker thread can't be interrupted, so stop it at its next checkpoint
+        cancelled.set()
+        raise
@@ -0,0 +1,160 @@
+# cache.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Process-wide, in-memory cache of loaded FlowByActivity and FlowBySector dataframes.
+Entries are keyed by the load request, invalidated when the parquet files they were read from change on disk, and
+evicted least recently used first once the cache exceeds its byte budget.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+import pandas as pd
+from flowsa.common import log
+
+# default byte budget of the cache, change with set_cache_size()
+default_cache_bytes = 2 * 1024 ** 3
+
+
+def file_signature(files):
+    """
+    Modification time and size of each file, used to detect changed files
+    :param files: list of file paths
+    :return: tuple of (path, mtime_ns, size) tuples, None if a file no longer exists
+    """
+    signature = []
+    for f in files:
+        try:
+            stat = os.stat(f)
+        except FileNotFoundError:
+            return None
+        signature.append((f, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def copy_on_write_enabled():
+    """Check if pandas copy-on-write mode is available and switched on"""
+    try:
+        return bool(pd.get_option('mode.copy_on_write'))
+    except (KeyError, pd.errors.OptionError):
+        return False
+
+
+def hand_out(df):
+    """
+    Copy of a cached df that can be modified without changing the cache. Under pandas copy-on-write a shallow copy
+    shares the cached data until either frame is modified, otherwise a deep copy is returned.
+    :param df: cached df
+    :return: df
+    """
+    return df.copy(deep=not copy_on_write_enabled())
+
+
+class FrameCache:
+    """LRU cache of dataframes under a byte budget"""
+
+    def __init__(self, max_bytes=default_cache_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, files):
+        """
+        Return a copy of a cached df, if the files it was loaded from are unchanged
+        :param key: hashable load request
+        :param files: list of file paths the df is loaded from
+        :return: df, or None if not cached
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            signature, df, nbytes = entry
+            if signature != file_signature(files):
+                log.debug("Cached data is out of date for " + str(key))
+                del self.entries[key]
+                self.nbytes -= nbytes
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return hand_out(df)
+
+    def put(self, key, files, df):
+        """
+        Cache a df, evicting the least recently used entries to stay within the byte budget
+        :param key: hashable load request
+        :param files: list of file paths the df is loaded from
+        :param df: df to cache, a copy is stored
+        :return: None
+        """
+        signature = file_signature(files)
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if signature is None or nbytes > self.max_bytes:
+            return
+        df = hand_out(df)
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[2]
+            self.entries[key] = (signature, df, nbytes)
+            self.nbytes += nbytes
+            self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits the byte budget"""
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            key, (signature, df, nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= nbytes
+
+    def clear(self):
+        """Remove all cached dfs"""
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        Usage counters of the cache
+        :return: dict of entries, bytes, max_bytes, hits and misses
+        """
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def set_max_bytes(self, max_bytes):
+        """
+        Change the byte budget of the cache
+        :param max_bytes: int, 0 disables caching
+        :return: None
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+
+# cache shared by getFlowByActivity and getFlowBySector
+flowby_cache = FrameCache()
+
+
+def set_cache_size(max_bytes):
+    """
+    Set the byte budget of the FlowByActivity/FlowBySector cache
+    :param max_bytes: int, 0 disables caching
+    :return: None
+    """
+    flowby_cache.set_max_bytes(max_bytes)
+
+
+def clear_cache():
+    """Remove all cached FlowByActivity/FlowBySector dataframes"""
+    flowby_cache.clear()
+
+
+def cache_stats():
+    """Usage counters of the FlowByActivity/FlowBySector cache, see FrameCache.stats"""
+    return flowby_cache.stats()
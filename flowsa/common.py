@@ -7,13 +7,27 @@
 
 import sys
 import os
+import io
+import json
+import tempfile
+import weakref
+import functools
+import multiprocessing
+import hashlib
+import datetime
+import time
+import threading
+import ftplib
 import yaml
 import requests
-import requests_ftp
 import pandas as pd
 import numpy as np
 import logging as log
 import appdirs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, CancelledError
+from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
 
 log.basicConfig(level=log.DEBUG, format='%(asctime)s %(levelname)-8s %(message)s',
                 datefmt='%Y-%m-%d %H:%M:%S', stream=sys.stdout)
@@ -51,6 +65,32 @@ flow_types = ['ELEMENTARY_FLOW','TECHNOSPHERE_FLOW','WASTE_FLOW']
 #Sets default Sector Source Name
 sector_source_name = 'NAICS_2012_Code'
 
+# concurrent url requests, in total and to any one host, so data providers are not flooded with requests
+http_max_workers = 8
+http_max_per_host = 4
+# processes parsing responses, at most, as each spawned process imports flowsa and each parsed frame is copied back
+http_max_parse_workers = 4
+# (connect, read) timeouts in seconds of url requests, so a stalled endpoint fails instead of hanging a pull
+http_timeout = (10, 120)
+# retries of failed url requests, waiting http_backoff_factor * 2 ** (retry - 1) seconds between attempts
+http_retries = 5
+http_backoff_factor = 0.5
+http_retry_status = [429, 500, 502, 503, 504]
+# bytes of a response body read into memory at a time while it is written to disk
+http_chunk_bytes = 1024 * 1024
+
+# raw responses of url requests, refreshed with conditional requests, so unchanged data is not downloaded again.
+# Bodies are stored once per content hash, entries are keyed by the url without api keys.
+response_cache_path = local_storage_path + '/flowsa/response_cache/'
+# query parameters holding api keys, left out of cache keys and cache entries
+api_key_params = ['key', 'api_key', 'apikey', 'registrationkey', 'userkey', 'token']
+# if True, url requests are answered from the response cache only, see set_offline
+http_offline = False
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_http_stats = {}
+
 def load_api_key(api_source):
     """
     Loads a txt file from the appdirs user directory with a set name
@@ -71,21 +111,495 @@ def load_api_key(api_source):
     return key
 
 
-def make_http_request(url):
-    r = []
+def http_session():
+    """
+    Session shared by all url requests, so connections to a host are kept alive and reused. Requests failing with
+    a connection error, a read timeout or a 429/5xx status are retried with exponential backoff, honoring
+    Retry-After headers.
+    :return: requests Session
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(total=http_retries, backoff_factor=http_backoff_factor, status_forcelist=http_retry_status,
+                          allowed_methods=['GET', 'HEAD'], respect_retry_after_header=True, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=http_max_workers, pool_maxsize=http_max_workers, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def close_http_session():
+    """Close the shared session, the next request opens a new one with the current http settings"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is not None:
+            _http_session.close()
+        _http_session = None
+
+
+def count_http_request(url, seconds, nbytes, retries=0, error=False, cached=False):
+    """Add a request to the latency and byte counters of its host"""
+    with _http_session_lock:
+        c = _http_stats.setdefault(urlparse(url).netloc, {'requests': 0, 'errors': 0, 'retries': 0, 'cached': 0,
+                                                          'bytes': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        c['requests'] += 1
+        c['errors'] += int(error)
+        c['retries'] += retries
+        c['cached'] += int(cached)
+        c['bytes'] += nbytes
+        c['total_seconds'] += seconds
+        c['max_seconds'] = max(c['max_seconds'], seconds)
+
+
+def http_stats():
+    """
+    Url request counters of each host since the last reset_http_stats
+    :return: dict of host: dict of requests, errors, retries, requests answered from the response cache, bytes
+     downloaded, total_seconds, mean_seconds, max_seconds
+    """
+    with _http_session_lock:
+        return {k: dict(v, mean_seconds=v['total_seconds'] / v['requests']) for k, v in _http_stats.items()}
+
+
+def reset_http_stats():
+    """Clear the url request counters"""
+    with _http_session_lock:
+        _http_stats.clear()
+
+
+def set_offline(offline=True):
+    """
+    Answer url requests from the response cache only, so sources are parsed again without downloading them
+    :param offline: bool
+    :return: None
+    """
+    global http_offline
+    http_offline = offline
+
+
+def response_cache_key(url):
+    """
+    Url a response is cached under: scheme and host in lower case, query parameters sorted and api keys removed
+    :param url: str
+    :return: str
+    """
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if k.lower() not in api_key_params)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ''))
+
+
+def response_cache_files(url):
+    """Entry file of a url in the response cache"""
+    key = response_cache_key(url)
+    return response_cache_path + hashlib.sha256(key.encode()).hexdigest() + '.json', key
+
+
+def read_cached_response(url):
+    """
+    Cached response of a url
+    :param url: str
+    :return: dict with the cache entry and the path of the body, or None if the url is not cached
+    """
+    entry_file, key = response_cache_files(url)
+    try:
+        with open(entry_file, 'r') as f:
+            entry = json.load(f)
+        entry['path'] = response_cache_path + entry['sha256'] + '.body'
+    except (OSError, ValueError, KeyError):
+        return None
+    if not os.path.isfile(entry['path']):
+        return None
+    return entry
+
+
+def download_response_body(r, directory=None):
+    """
+    Stream the body of a response to a file in chunks of http_chunk_bytes, so large downloads are never held in
+    memory
+    :param r: requests Response, requested with stream=True
+    :param directory: str, directory of the file, defaults to the system temporary directory
+    :return: file path, sha256 of the body, bytes written
+    """
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    digest = hashlib.sha256()
+    nbytes = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in r.iter_content(http_chunk_bytes):
+                digest.update(chunk)
+                f.write(chunk)
+                nbytes = nbytes + len(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, digest.hexdigest(), nbytes
+
+
+def download_ftp_body(url, timeout=None, directory=None):
+    """
+    Download an ftp url to a file, writing each block as it is received, so large archives are never held in
+    memory. Each download opens and closes its own connection. ftp errors are raised as requests ConnectionErrors,
+    so they are handled like failed http requests.
+    :param url: str, ftp url
+    :param timeout: (connect, read) timeouts in seconds, defaults to http_timeout
+    :param directory: str, directory of the file, defaults to the system temporary directory
+    :return: file path, sha256 of the body, bytes written
+    """
+    parts = urlsplit(url)
+    timeout = timeout or http_timeout
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    digest = hashlib.sha256()
+    nbytes = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            def write_block(block):
+                nonlocal nbytes
+                digest.update(block)
+                f.write(block)
+                nbytes = nbytes + len(block)
+
+            with ftplib.FTP(timeout=max(timeout) if isinstance(timeout, tuple) else timeout) as ftp:
+                ftp.connect(parts.hostname, parts.port or 21)
+                ftp.login(parts.username or 'anonymous', parts.password or '')
+                ftp.retrbinary('RETR ' + parts.path, write_block, blocksize=http_chunk_bytes)
+    except ftplib.all_errors as e:
+        os.remove(path)
+        raise requests.exceptions.ConnectionError(e) from e
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, digest.hexdigest(), nbytes
+
+
+def ftp_response(url, nbytes):
+    """
+    Successful requests Response of a downloaded ftp url, its body is attached with file_response
+    :param url: str, ftp url
+    :param nbytes: int, bytes downloaded
+    :return: requests Response
+    """
+    r = requests.Response()
+    r.status_code = 200
+    r.url = url
+    r.headers['Content-Length'] = str(nbytes)
+    return r
+
+
+def write_cached_response(url, r, path, digest):
+    """
+    Store a successful response in the response cache, the body under its content hash and an entry for the url
+    :param url: str, url requested
+    :param r: requests Response
+    :param path: str, file in response_cache_path holding the body, from download_response_body
+    :param digest: str, sha256 of the body
+    :return: str, path of the cached body
+    """
+    entry_file, key = response_cache_files(url)
+    body_file = response_cache_path + digest + '.body'
+    # files are written under temporary names and moved into place, so readers never see partial files
+    if os.path.isfile(body_file):
+        os.remove(path)
+    else:
+        os.replace(path, body_file)
+    headers = {k: v for k, v in r.headers.items() if k.lower() != 'set-cookie'}
+    entry = {'url': key, 'sha256': digest, 'headers': headers,
+             'fetched': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')}
+    tmp = entry_file + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp, entry_file)
+    return body_file
+
+
+class ResponseBodyFile:
+    """Raw body of a response stored in a file, opened on the first read and closed at the end of the file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def read(self, size=-1):
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        data = self.file.read(size)
+        if not data:
+            self.close()
+        return data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class FileResponse(requests.Response):
+    """
+    Response with its body in a file. content reads the file on first use, response_file returns the path. It is
+    pickled with the path instead of the body, so it can be sent to parser processes without copying the body.
+    """
+
+    __attrs__ = [a for a in requests.Response.__attrs__ if a != '_content'] + ['body_path']
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.body_path = path
+        self.raw = ResponseBodyFile(path)
+
+    def __getstate__(self):
+        return {a: getattr(self, a, None) for a in self.__attrs__}
+
+    def __setstate__(self, state):
+        self.__init__(state['body_path'])
+        for k, v in state.items():
+            setattr(self, k, v)
+
+
+def file_response(r, path):
+    """
+    Response reading its body from a file
+    :param r: requests Response, its status, headers and url are copied
+    :param path: str, file holding the body
+    :return: FileResponse
+    """
+    f = FileResponse(path)
+    for a in requests.Response.__attrs__:
+        if a != '_content':
+            setattr(f, a, getattr(r, a))
+    if r.raw is not None:
+        r.close()
+    return f
+
+
+def response_file(r):
+    """
+    Body of a response for file readers such as zipfile.ZipFile, pd.read_csv and pd.read_excel: the path of the
+    file a downloaded body was streamed to, so zip members are read straight from disk, or an in-memory file
+    :param r: requests Response from make_http_request
+    :return: str file path, or io.BytesIO
+    """
+    path = getattr(r, 'body_path', None)
+    if path is not None:
+        return path
+    return io.BytesIO(r.content)
+
+
+def remove_file(path):
+    """Remove a file if it still exists"""
     try:
-        r = requests.get(url)
-    except requests.exceptions.InvalidSchema: # if url is ftp rather than http
-        requests_ftp.monkeypatch_session()
-        r = requests.Session().get(url)
-    except requests.exceptions.ConnectionError:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def cached_response(url, entry):
+    """
+    Response built from a response cache entry, reading the cached body file
+    :param url: str, url requested
+    :param entry: dict from read_cached_response
+    :return: requests Response
+    """
+    r = FileResponse(entry['path'])
+    r.status_code = 200
+    r.reason = 'OK'
+    r.url = url
+    r.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+    r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+    return r
+
+
+def conditional_headers(entry):
+    """Headers asking for a response only if it changed since the cached entry"""
+    headers = {}
+    cached = requests.structures.CaseInsensitiveDict(entry['headers'])
+    if 'ETag' in cached:
+        headers['If-None-Match'] = cached['ETag']
+    if 'Last-Modified' in cached:
+        headers['If-Modified-Since'] = cached['Last-Modified']
+    return headers
+
+
+def make_http_request(url, timeout=None, use_cache=True):
+    """
+    Request a url with the shared session. Successful responses are stored in the response cache, and a cached
+    response is refreshed with a conditional request, so unchanged data is not downloaded again. In offline mode
+    the cached response is returned without a request.
+    :param url: str, http, https or ftp url
+    :param timeout: (connect, read) timeouts in seconds, defaults to http_timeout
+    :param use_cache: bool, if False neither read nor write the response cache
+    :return: requests Response, or an empty list if no response was received. The body of a successful response
+     is streamed to a file, use response_file for file readers.
+    """
+    start = time.perf_counter()
+    entry = read_cached_response(url) if use_cache else None
+    if use_cache and http_offline:
+        if entry is None:
+            log.error("No cached response for " + response_cache_key(url) + " in offline mode")
+            count_http_request(url, time.perf_counter() - start, 0, error=True)
+            return []
+        count_http_request(url, time.perf_counter() - start, 0, cached=True)
+        return cached_response(url, entry)
+    retries = 0
+    try:
+        # bodies are streamed to disk rather than read into memory
+        if urlparse(url).scheme == 'ftp':
+            path, digest, nbytes = download_ftp_body(url, timeout, response_cache_path if use_cache else None)
+            r = ftp_response(url, nbytes)
+        else:
+            headers = conditional_headers(entry) if entry is not None else None
+            r = http_session().get(url, timeout=timeout or http_timeout, headers=headers, stream=True)
+            retries = getattr(r.raw, 'retries', None)
+            retries = 0 if retries is None else len(retries.history)
+            if r.status_code == 304 and entry is not None:
+                r.close()
+                count_http_request(url, time.perf_counter() - start, 0, retries=retries, cached=True)
+                log.debug("Cached response of " + response_cache_key(url) + " is unchanged")
+                return cached_response(url, entry)
+            if r.status_code == 200:
+                path, digest, nbytes = download_response_body(r, response_cache_path if use_cache else None)
+            else:
+                nbytes = len(r.content)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError):
         log.error("URL Connection Error for " + url)
+        count_http_request(url, time.perf_counter() - start, 0, retries=retries, error=True)
+        return []
+    seconds = time.perf_counter() - start
+    count_http_request(url, seconds, nbytes, retries=retries, error=not r.ok)
+    log.debug("Received " + str(nbytes) + " bytes in " + "{:.2f}".format(seconds) + "s from " + url)
+    if r.status_code == 200:
+        if use_cache:
+            try:
+                path = write_cached_response(url, r, path, digest)
+            except OSError as e:
+                log.warning("Failed to cache the response of " + response_cache_key(url) + ": " + str(e))
+        r = file_response(r, path)
+        if not use_cache:
+            # the downloaded body is removed with the response
+            weakref.finalize(r, remove_file, path)
     try:
         r.raise_for_status()
     except requests.exceptions.HTTPError:
         log.error('Error in URL request!')
     return r
 
+
+def make_http_requests(urls, max_workers=None, max_per_host=None):
+    """
+    Request urls concurrently with make_http_request, with a limit on the requests in flight to each host
+    :param urls: list of str
+    :param max_workers: int, maximum number of requests in flight, defaults to http_max_workers
+    :param max_per_host: int, maximum number of requests in flight to one host, defaults to http_max_per_host
+    :return: generator of responses, in the order of urls, each yielded as soon as it and all earlier responses
+     are received
+    """
+    urls = list(urls)
+    host_limits = {h: threading.BoundedSemaphore(max_per_host or http_max_per_host)
+                   for h in set(urlparse(u).netloc for u in urls)}
+
+    def request(url):
+        with host_limits[urlparse(url).netloc]:
+            log.info("Calling " + url)
+            return make_http_request(url)
+
+    with ThreadPoolExecutor(max_workers=max_workers or http_max_workers) as executor:
+        for r in executor.map(request, urls):
+            yield r
+
+
+def parse_workers_pool(parse_workers):
+    """
+    Process pool parsing responses. Workers are spawned rather than forked, as the process also runs download
+    threads.
+    :param parse_workers: int, number of processes
+    :return: concurrent.futures.ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def fetch_and_parse(urls, parse_fxn, args, max_workers=None, max_per_host=None, parse_workers=None,
+                    max_pending=None):
+    """
+    Request urls and parse each response. Urls are requested on threads, as in make_http_requests, and by default
+    each response is parsed in this process, in url order, as it arrives. With parse_workers, responses are parsed
+    in a process pool as soon as they are downloaded, overlapping downloads and parsing. A url is only
+    requested once fewer than max_pending responses are downloaded or downloading but not yet parsed, which bounds
+    the raw responses held at once.
+    :param urls: list of str
+    :param parse_fxn: function of (url, response, args) returning the parsed data, importable by worker processes
+    :param args: dict, passed to parse_fxn
+    :param max_workers: int, maximum number of requests in flight, defaults to http_max_workers
+    :param max_per_host: int, maximum number of requests in flight to one host, defaults to http_max_per_host
+    :param parse_workers: int, number of parser processes, at most one per url and http_max_parse_workers. None
+     or 0 parses in this process, which avoids copying each parsed data frame back from a worker process.
+    :param max_pending: int, maximum number of responses not yet parsed, defaults to twice the parser processes
+    :return: list of parsed data, in the order of urls
+    """
+    urls = list(urls)
+    if not parse_workers or len(urls) <= 1:
+        return [parse_fxn(url, r, args)
+                for url, r in zip(urls, make_http_requests(urls, max_workers, max_per_host))]
+    parse_workers = min(parse_workers, len(urls), http_max_parse_workers)
+    pending = threading.BoundedSemaphore(max_pending or 2 * parse_workers)
+    host_limits = {h: threading.BoundedSemaphore(max_per_host or http_max_per_host)
+                   for h in set(urlparse(u).netloc for u in urls)}
+
+    # set when the pipeline stops early, so downloads waiting for a pending slot give up
+    aborted = threading.Event()
+
+    def fetch(url):
+        while not pending.acquire(timeout=0.1):
+            if aborted.is_set():
+                return None, CancelledError()
+        try:
+            with host_limits[urlparse(url).netloc]:
+                log.info("Calling " + url)
+                return make_http_request(url), None
+        except Exception as e:
+            # the error is raised by the caller, in url order, rather than stopping the other downloads
+            pending.release()
+            return None, e
+
+    def parsed(r, future):
+        # the callback holds the response until it is parsed, so a temporary body is not removed before it is read
+        pending.release()
+
+    with parse_workers_pool(parse_workers) as parse_pool, \
+            ThreadPoolExecutor(max_workers=max_workers or http_max_workers) as download_pool:
+        downloads = {download_pool.submit(fetch, url): i for i, url in enumerate(urls)}
+        parses = {}
+        errors = {}
+        try:
+            for download in as_completed(downloads):
+                i = downloads[download]
+                r, error = download.result()
+                if error is not None:
+                    errors[i] = error
+                    continue
+                parses[i] = parse_pool.submit(parse_fxn, urls[i], r, args)
+                parses[i].add_done_callback(functools.partial(parsed, r))
+            if errors:
+                raise errors[min(errors)]
+            return [parses[i].result() for i in range(len(urls))]
+        except BaseException:
+            aborted.set()
+            # free the slots of downloads that finished but were never handed to the parsers
+            for download, i in downloads.items():
+                if download.done() and not download.cancelled() and i not in parses and \
+                        download.result()[1] is None:
+                    pending.release()
+            download_pool.shutdown(cancel_futures=True)
+            parse_pool.shutdown(cancel_futures=True)
+            raise
+
+
 def load_sector_crosswalk():
     cw = pd.read_csv(datapath + "NAICS_07_to_17_Crosswalk.csv", dtype="str")
     return cw
@@ -265,6 +779,16 @@ def get_flow_by_groupby_cols(flow_by_fields):
     return groupby_cols
 
 
+def get_flow_by_categorical_cols(flow_by_fields):
+    """
+    Descriptive string fields that can be held as pandas categoricals / Arrow dictionaries, as these fields only
+    contain a small number of distinct values
+    :param flow_by_fields: flow_by_activity_fields, flow_by_sector_fields or flow_by_sector_collapsed_fields
+    :return: list of field names
+    """
+    return [k for k, v in flow_by_fields.items() if v[0]['dtype'] == 'str' and k != 'Description']
+
+
 def read_stored_FIPS(year='2015'):
     """
     Read fips based on year specified, year defaults to 2015
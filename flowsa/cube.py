@@ -0,0 +1,136 @@
+# cube.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Rollup cube of FlowBySector results: FlowAmount summed for every NAICS 2-6 sector level and every geoscale from the
+method's target geoscale up to national, by Flowable and Context. The cube is stored as a parquet dataset
+partitioned by SectorLevel and Geoscale, so any rollup is read from one partition without re-aggregating.
+"""
+
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from flowsa.common import fbsoutputpath, fips_number_key, US_FIPS, log, flow_by_sector_fields
+from flowsa.flowbyfunctions import aggregator, fbs_activity_fields, fbs_default_grouping_fields, \
+    add_missing_flow_by_fields
+from flowsa.mapping import get_sector_list, add_non_naics_sectors
+from flowsa.storage import flowby_table, write_flowby_table, fbs_sort_columns, fbs_row_group_size, \
+    build_filter_expression, fbs_filter_columns, build_sector_expression, combine_expressions
+
+cube_sector_levels = [2, 3, 4, 5, 6]
+
+cube_partitioning = ds.partitioning(pa.schema([('SectorLevel', pa.int32()), ('Geoscale', pa.string())]),
+                                    flavor='hive')
+
+
+def flowbysector_cube_path(method_name):
+    """Directory of the rollup cube of a FlowBySector method"""
+    return fbsoutputpath + method_name + '_cube/'
+
+
+def cube_geoscales(target_geoscale):
+    """
+    Geoscales a method's results can be rolled up to
+    :param target_geoscale: national, state, or county
+    :return: list of geoscales, from target_geoscale to national
+    """
+    geoscales = sorted(fips_number_key, key=fips_number_key.get, reverse=True)
+    return [g for g in geoscales if fips_number_key[g] <= fips_number_key[target_geoscale]]
+
+
+def rollup_location(location, geoscale):
+    """
+    Roll FIPS locations up to a geoscale
+    :param location: pandas series of FIPS codes at a lower geoscale
+    :param geoscale: national, state, or county
+    :return: pandas series
+    """
+    if geoscale == 'national':
+        return pd.Series(US_FIPS, index=location.index)
+    if geoscale == 'state':
+        return location.str[0:2] + '000'
+    return location
+
+
+def subset_sector_level(fbs, sector_level):
+    """
+    Flows with either sector at a NAICS level, or one of the non-NAICS sectors used with it. Each flow is kept
+    once, so its FlowAmount is counted once in every rollup of the cube.
+    :param fbs: FlowBySector df with sectors at all levels
+    :param sector_level: int, 2 to 6
+    :return: df
+    """
+    sector_list = add_non_naics_sectors(get_sector_list('NAICS_' + str(sector_level)), 'NAICS_' + str(sector_level))
+    at_level = [fbs[c].isin(sector_list) for c in fbs_activity_fields]
+    return fbs[at_level[0] | at_level[1]]
+
+
+def build_flowbysector_cube(fbs, target_geoscale):
+    """
+    Sum FlowBySector results for every sector level and geoscale
+    :param fbs: FlowBySector df with sectors at all levels, at the target geoscale, from sector_aggregation
+    :param target_geoscale: national, state, or county
+    :return: dict of (sector level, geoscale): FlowBySector df
+    """
+    cube = {}
+    for level in cube_sector_levels:
+        fbs_level = subset_sector_level(fbs, level)
+        for geoscale in cube_geoscales(target_geoscale):
+            df = fbs_level.copy()
+            df['Location'] = rollup_location(df['Location'], geoscale)
+            df = aggregator(df, fbs_default_grouping_fields)
+            cube[(level, geoscale)] = add_missing_flow_by_fields(df, flow_by_sector_fields)
+    return cube
+
+
+def write_flowbysector_cube(cube, method_name):
+    """
+    Replace the stored rollup cube of a method
+    :param cube: dict from build_flowbysector_cube
+    :param method_name: str, FlowBySector method name
+    :return: list of parquet file paths written
+    """
+    cube_path = flowbysector_cube_path(method_name)
+    if os.path.isdir(cube_path):
+        shutil.rmtree(cube_path)
+    written = []
+    for (level, geoscale), df in cube.items():
+        partition_path = cube_path + 'SectorLevel=' + str(level) + '/Geoscale=' + geoscale + '/'
+        os.makedirs(partition_path)
+        f = partition_path + method_name + '.parquet'
+        write_flowby_table(flowby_table(df, preserve_index=False), f, fbs_sort_columns, fbs_row_group_size)
+        written.append(f)
+    return written
+
+
+def read_flowbysector_cube(method_name, sector_level, geoscale, columns=None, locations=None, sectors=None,
+                           flowables=None, contexts=None, sector_prefix=None):
+    """
+    Read one rollup of the stored cube of a method
+    :param method_name: str, FlowBySector method name
+    :param sector_level: int, NAICS level, 2 to 6
+    :param geoscale: national, state, or county
+    :param columns: list, columns to return, None returns all FlowBySector columns
+    :param locations: list, only return flows for these Location codes
+    :param sectors: list, only return flows where SectorProducedBy or SectorConsumedBy is in the list
+    :param flowables: list, only return flows for these Flowables
+    :param contexts: list, only return flows in these Contexts
+    :param sector_prefix: str or list, only return flows where a sector starts with one of the prefixes
+    :return: FlowBySector df, empty if the rollup is not stored
+    """
+    cube_path = flowbysector_cube_path(method_name)
+    if not os.path.isdir(cube_path):
+        log.error("No rollup cube found for method " + method_name + " in flowsa")
+        return pd.DataFrame()
+    dataset = ds.dataset(cube_path, format='parquet', partitioning=cube_partitioning)
+    expression = combine_expressions((ds.field('SectorLevel') == int(sector_level)) &
+                                     (ds.field('Geoscale') == geoscale),
+                                     build_filter_expression(fbs_filter_columns, locations=locations,
+                                                             sectors=sectors, flowables=flowables,
+                                                             contexts=contexts),
+                                     build_sector_expression(sector_prefix))
+    if columns is None:
+        columns = [c for c in dataset.schema.names if c not in ('SectorLevel', 'Geoscale')]
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
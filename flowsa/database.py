@@ -0,0 +1,325 @@
+# database.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Export of stored FlowByActivity and FlowBySector parquet files into an indexed SQLite database, for repeated ad-hoc
+queries without reloading parquet files. Files are loaded incrementally: a file is only reloaded when its content
+fingerprint changes. Once set with set_database(), getFlowByActivity and getFlowBySector read from the database any
+source years and methods it holds.
+"""
+
+import os
+import glob
+import sqlite3
+import datetime
+from urllib.request import pathname2url
+import pyarrow.parquet as pq
+import pandas as pd
+from flowsa.common import log, outputpath, fbsoutputpath, flow_by_activity_fields, flow_by_sector_fields, \
+    get_flow_by_categorical_cols
+from flowsa.manifest import as_list
+import flowsa.storage as storage
+
+default_database_file = outputpath + 'flowsa.sqlite'
+
+# database read by getFlowByActivity and getFlowBySector, None reads the parquet files
+database_path = None
+
+# flow tables by kind of output, with the columns and indexes of each
+database_tables = {'FBA': ('fba', flow_by_activity_fields,
+                           ['Location', 'ActivityProducedBy', 'ActivityConsumedBy', 'FlowName', 'Class']),
+                   'FBS': ('fbs', flow_by_sector_fields,
+                           ['Location', 'SectorProducedBy', 'SectorConsumedBy', 'Flowable', 'Context'])}
+
+sqlite_types = {'str': 'TEXT', 'float': 'REAL', 'int': 'INTEGER'}
+
+
+def set_database(path=default_database_file):
+    """
+    Read FlowByActivity and FlowBySector data from a database made by export_database
+    :param path: str, database file, None to read the parquet files again
+    :return: None
+    """
+    global database_path
+    database_path = path
+
+
+def connect_database_readonly(path):
+    """
+    Open a flowsa database for reading, without creating it or its tables
+    :param path: str, database file
+    :return: sqlite3 Connection
+    """
+    return sqlite3.connect('file:' + pathname2url(os.path.abspath(path)) + '?mode=ro', uri=True, timeout=30)
+
+
+def database_schema():
+    """SQL creating the loaded files table and the indexed flow tables"""
+    statements = ["CREATE TABLE IF NOT EXISTS loaded_files (file TEXT PRIMARY KEY, kind TEXT NOT NULL, "
+                  "name TEXT NOT NULL, year TEXT, fingerprint TEXT, rows INTEGER, loaded TEXT)",
+                  "CREATE INDEX IF NOT EXISTS loaded_files_name ON loaded_files (kind, name, year)"]
+    for table, fields, index_columns in database_tables.values():
+        columns = ', '.join('"' + k + '" ' + sqlite_types[v[0]['dtype']] for k, v in fields.items())
+        statements.append("CREATE TABLE IF NOT EXISTS " + table + " (" + columns + ", source_file TEXT NOT NULL)")
+        for c in index_columns + ['source_file']:
+            statements.append("CREATE INDEX IF NOT EXISTS " + table + "_" + c + " ON " + table + " (\"" + c + "\")")
+    return ';\n'.join(statements) + ';'
+
+
+def connect_database(path=default_database_file):
+    """
+    Open a flowsa database, creating it if needed
+    :param path: str, database file
+    :return: sqlite3 Connection
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    con = sqlite3.connect(path, timeout=30)
+    con.executescript(database_schema())
+    return con
+
+
+def stored_outputs(fba_sources=None, fbs_methods=None):
+    """
+    Stored parquet files to export
+    :param fba_sources: list, FlowByActivity sources, None for all, [] for none
+    :param fbs_methods: list, FlowBySector methods, None for all, [] for none
+    :return: list of (file, kind, name, year, partition class)
+    """
+    outputs = []
+    if fba_sources is None or len(fba_sources) > 0:
+        vintage_outputs = []
+        for f in sorted(glob.glob(storage.fbaoutputpath + '*_vintages/year=*/*.parquet')):
+            source = os.path.basename(os.path.dirname(os.path.dirname(f)))[:-len('_vintages')]
+            year = os.path.basename(os.path.dirname(f)).split('=', 1)[1]
+            vintage_outputs.append((f, 'FBA', source, year, None))
+        partitioned_outputs = []
+        for f in sorted(glob.glob(storage.fbaoutputpath + 'source=*/year=*/Class=*/*.parquet')):
+            source, year, flowclass = [os.path.basename(d).split('=', 1)[1] for d in
+                                       (os.path.dirname(os.path.dirname(os.path.dirname(f))),
+                                        os.path.dirname(os.path.dirname(f)), os.path.dirname(f))]
+            partitioned_outputs.append((f, 'FBA', source, year, flowclass))
+        flat_outputs = []
+        for f in sorted(glob.glob(storage.fbaoutputpath + '*.parquet')):
+            name, _, year = os.path.basename(f)[:-len('.parquet')].rpartition('_')
+            flat_outputs.append((f, 'FBA', name, year, None))
+        # a year stored in more than one layout is exported once, from the layout locate_flowbyactivity reads
+        found = set()
+        for layout_outputs in (vintage_outputs, partitioned_outputs, flat_outputs):
+            outputs.extend(o for o in layout_outputs if (o[2], o[3]) not in found)
+            found.update((o[2], o[3]) for o in layout_outputs)
+        if fba_sources is not None:
+            outputs = [o for o in outputs if o[2] in fba_sources]
+    if fbs_methods is None or len(fbs_methods) > 0:
+        for f in sorted(glob.glob(fbsoutputpath + '*.parquet')):
+            name = os.path.basename(f)[:-len('.parquet')]
+            # collapsed copies of methods do not have the flowbysector columns
+            if name.endswith('_collapsed'):
+                continue
+            if fbs_methods is None or name in fbs_methods:
+                outputs.append((f, 'FBS', name, None, None))
+    return outputs
+
+
+def output_fingerprint(path):
+    """Content fingerprint of a stored file, or the hash of the whole file if it was written without one"""
+    return storage.fingerprint(path) or storage.file_content_hash(path)
+
+
+def load_output(con, path, kind, partition_class=None, batch_rows=100000):
+    """
+    Replace the rows of a stored parquet file in its flow table
+    :param con: sqlite3 Connection, in a transaction
+    :param path: str, parquet file path
+    :param kind: str, 'FBA' or 'FBS'
+    :param partition_class: str, Class of a file in the partitioned store, where Class is not a column
+    :param batch_rows: int, rows inserted at a time
+    :return: int, rows loaded
+    """
+    table, fields, index_columns = database_tables[kind]
+    con.execute("DELETE FROM " + table + " WHERE source_file = ?", (path,))
+    parquet = pq.ParquetFile(path)
+    columns = [c for c in parquet.schema_arrow.names if c in fields]
+    insert_columns = columns + (['Class'] if partition_class is not None and 'Class' not in columns else []) + \
+        ['source_file']
+    insert = "INSERT INTO " + table + " (" + ', '.join('"' + c + '"' for c in insert_columns) + ") VALUES (" + \
+             ', '.join('?' * len(insert_columns)) + ")"
+    rows = 0
+    if storage.is_vintage_file(path):
+        batches = storage.read_vintage_file(path, columns=columns, batch_rows=batch_rows)
+    else:
+        batches = parquet.iter_batches(batch_size=batch_rows, columns=columns)
+    for batch in batches:
+        df = batch.to_pandas()
+        if 'Class' in insert_columns and 'Class' not in columns:
+            df['Class'] = partition_class
+        df['source_file'] = path
+        df = df.astype(object).where(df.notnull(), None)
+        con.executemany(insert, df[insert_columns].itertuples(index=False, name=None))
+        rows = rows + len(df)
+    return rows
+
+
+def export_database(path=default_database_file, fba_sources=None, fbs_methods=None):
+    """
+    Load stored FlowByActivity and FlowBySector files into a database. Files whose content fingerprint is
+    unchanged since they were loaded are skipped, and files no longer stored are removed.
+    :param path: str, database file
+    :param fba_sources: list, FlowByActivity sources to export, None for all, [] for none
+    :param fbs_methods: list, FlowBySector methods to export, None for all, [] for none
+    :return: dict, counts of files loaded, skipped and removed
+    """
+    outputs = stored_outputs(fba_sources, fbs_methods)
+    counts = {'loaded': 0, 'skipped': 0, 'removed': 0}
+    con = connect_database(path)
+    try:
+        loaded = {r[0]: r[1:] for r in con.execute("SELECT file, kind, name, fingerprint FROM loaded_files")}
+        for f, kind, name, year, partition_class in outputs:
+            fingerprint = output_fingerprint(f)
+            if f in loaded and loaded[f][2] == fingerprint:
+                counts['skipped'] += 1
+                continue
+            log.info("Loading " + f + " into " + path)
+            # each file is loaded in its own transaction, so an interrupted export keeps the files loaded so far
+            with con:
+                rows = load_output(con, f, kind, partition_class)
+                con.execute("INSERT OR REPLACE INTO loaded_files (file, kind, name, year, fingerprint, rows, loaded) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (f, kind, name, year, fingerprint, rows,
+                             datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')))
+            counts['loaded'] += 1
+        # drop files of the exported sources and methods that are no longer stored
+        exported = set(o[0] for o in outputs)
+        for f, (kind, name, fingerprint) in loaded.items():
+            in_scope = (kind == 'FBA' and (fba_sources is None or name in fba_sources)) or \
+                       (kind == 'FBS' and (fbs_methods is None or name in fbs_methods))
+            if in_scope and f not in exported:
+                with con:
+                    con.execute("DELETE FROM " + database_tables[kind][0] + " WHERE source_file = ?", (f,))
+                    con.execute("DELETE FROM loaded_files WHERE file = ?", (f,))
+                counts['removed'] += 1
+    finally:
+        con.close()
+    log.info("Exported to " + path + ": " + ', '.join(k + ' ' + str(v) for k, v in counts.items()))
+    return counts
+
+
+def filter_conditions(filter_columns, **filters):
+    """
+    SQL conditions from lists of values to keep, the same filters as storage.build_filter_expression
+    :param filter_columns: fba_filter_columns or fbs_filter_columns
+    :param filters: list or str of values to keep, keyed by the names in filter_columns. None is ignored.
+    :return: list of SQL conditions, list of parameters
+    """
+    conditions = []
+    params = []
+    for k, values in filters.items():
+        if values is None:
+            continue
+        values = as_list(values)
+        # a row matches the filter if any of the filter columns contain one of the values
+        conditions.append('(' + ' OR '.join('"' + c + '" IN (' + ', '.join('?' * len(values)) + ')'
+                                            for c in filter_columns[k]) + ')')
+        params = params + values * len(filter_columns[k])
+    return conditions, params
+
+
+def sector_conditions(sector_prefix=None, sector_level=None,
+                      sector_columns=('SectorProducedBy', 'SectorConsumedBy')):
+    """
+    SQL condition keeping flows where a sector column starts with one of the prefixes and has the requested number
+    of digits, the same filter as storage.build_sector_expression
+    :param sector_prefix: str or list, sector code prefixes
+    :param sector_level: int, sector code length
+    :param sector_columns: columns checked, a row is kept if any of the columns match
+    :return: list of SQL conditions, list of parameters
+    """
+    if sector_prefix is None and sector_level is None:
+        return [], []
+    column_conditions = []
+    params = []
+    for c in sector_columns:
+        parts = []
+        if sector_prefix is not None:
+            prefixes = as_list(sector_prefix)
+            parts.append('(' + ' OR '.join('substr("' + c + '", 1, ' + str(len(p)) + ') = ?' for p in prefixes) + ')')
+            params = params + prefixes
+        if sector_level is not None:
+            parts.append('(length("' + c + '") = ' + str(int(sector_level)) + ' AND "' + c + '" != \'None\')')
+        column_conditions.append('(' + ' AND '.join(parts) + ')')
+    return ['(' + ' OR '.join(column_conditions) + ')'], params
+
+
+def database_files(kind, name, years=None, path=None):
+    """
+    Stored files of a source's years, or a method, loaded into the database. Files changed or removed since they
+    were loaded are read from the parquet files instead.
+    :param kind: str, 'FBA' or 'FBS'
+    :param name: str, FlowByActivity source or FlowBySector method name
+    :param years: list, years of FlowByActivity data
+    :param path: str, database file, defaults to the database set with set_database
+    :return: list of the source files, empty if a year or the method is not in the database, or a file is out of
+     date
+    """
+    path = path or database_path
+    if path is None or not os.path.isfile(path):
+        return []
+    con = connect_database_readonly(path)
+    try:
+        query = "SELECT file, year, fingerprint FROM loaded_files WHERE kind = ? AND name = ?"
+        rows = con.execute(query, (kind, name)).fetchall()
+    except sqlite3.OperationalError as e:
+        log.warning("Failed to read the loaded files of " + path + ": " + str(e))
+        return []
+    finally:
+        con.close()
+    if years is not None:
+        rows = [r for r in rows if r[1] in as_list(years)]
+        if set(r[1] for r in rows) != set(as_list(years)):
+            return []
+    for f, year, fingerprint in rows:
+        if not os.path.isfile(f) or output_fingerprint(f) != fingerprint:
+            log.info(f + " has changed since it was loaded into " + path + ", reading the parquet files")
+            return []
+    return [r[0] for r in rows]
+
+
+def read_database(kind, files, columns=None, categorical=False, sector_prefix=None, sector_level=None, path=None,
+                  **filters):
+    """
+    Read flows of loaded files from the database
+    :param kind: str, 'FBA' or 'FBS'
+    :param files: list, source files from database_files
+    :param columns: list, columns to return, None returns all flow columns
+    :param categorical: bool, if True descriptive string columns are returned as pandas categoricals
+    :param sector_prefix: str or list, FlowBySector only, sector code prefixes
+    :param sector_level: int, FlowBySector only, sector code length
+    :param path: str, database file, defaults to the database set with set_database
+    :param filters: list or str of values to keep, keyed by the names in fba_filter_columns or fbs_filter_columns
+    :return: df
+    """
+    table, fields, index_columns = database_tables[kind]
+    filter_columns = storage.fba_filter_columns if kind == 'FBA' else storage.fbs_filter_columns
+    conditions, params = filter_conditions(filter_columns, **filters)
+    sector_condition, sector_params = sector_conditions(sector_prefix, sector_level)
+    columns = [c for c in (columns or fields) if c in fields]
+    query = "SELECT " + ', '.join('"' + c + '"' for c in columns) + " FROM " + table + \
+            " WHERE source_file IN (" + ', '.join('?' * len(files)) + ")"
+    for c in conditions + sector_condition:
+        query = query + " AND " + c
+    con = connect_database_readonly(path or database_path)
+    try:
+        df = pd.read_sql_query(query, con, params=list(files) + params + sector_params)
+    finally:
+        con.close()
+    # sqlite columns without values are read as objects, so numeric fields get the dtypes they load with from parquet
+    for c in df.columns:
+        dtype = fields[c][0]['dtype']
+        if dtype == 'float':
+            df[c] = df[c].astype('float64')
+        elif dtype == 'int' and df[c].notnull().all():
+            df[c] = df[c].astype('int64')
+    if categorical:
+        for c in get_flow_by_categorical_cols(fields):
+            if c in df.columns:
+                df[c] = df[c].astype('category')
+    return df
@@ -2,14 +2,18 @@
 Functions to check data is loaded correctly
 """
 
+import os
 import flowsa
 from functools import reduce
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from flowsa.mapping import get_activitytosector_mapping
 from flowsa.flowbyfunctions import fba_fill_na_dict, harmonize_units, fba_activity_fields, filter_by_geoscale, \
     fba_default_grouping_fields, fbs_default_grouping_fields, aggregator, sector_aggregation
-from flowsa.common import US_FIPS
+from flowsa.common import US_FIPS, fbsoutputpath, log
+from flowsa.storage import row_hashes, decode_dictionary_columns
 from flowsa.USGS_NWIS_WU import standardize_usgs_nwis_names
 
 
@@ -187,3 +191,115 @@ def sector_flow_comparision(fbs_df):
     sector_comparison = sector_comparison.sort_values(['Flowable', 'Context', 'FlowType', 'SectorLength'])
 
     return sector_comparison
+
+
+# columns summed to per-sector totals when comparing FlowBySector versions
+fbs_compare_total_columns = ['SectorProducedBy', 'SectorConsumedBy', 'Unit']
+
+
+def fbs_parquet_path(fbs):
+    """Parquet file of a FlowBySector method name, or the path itself if given a file"""
+    return fbs if os.path.isfile(fbs) else fbsoutputpath + fbs + '.parquet'
+
+
+def sum_fbs_by_key(path, key_columns, batch_rows=500000):
+    """
+    Stream a stored FlowBySector file, summing FlowAmount by a 64-bit hash of the key columns and by sector
+    :param path: str, FlowBySector parquet file path
+    :param key_columns: list, columns identifying a flow
+    :param batch_rows: int, rows read at a time
+    :return: pandas Series of FlowAmount indexed by key hash, pandas Series of FlowAmount indexed by
+     fbs_compare_total_columns
+    """
+    key_sums = []
+    sector_sums = []
+    # string columns are read as dictionaries so each distinct value is only hashed once per batch
+    parquet = pq.ParquetFile(path, read_dictionary=key_columns)
+    # the sector totals are summed over their own columns, which need not be key columns
+    columns = key_columns + [c for c in fbs_compare_total_columns if c not in key_columns] + ['FlowAmount']
+    for batch in parquet.iter_batches(batch_size=batch_rows, columns=columns):
+        keys = pa.table({'key': row_hashes(batch, key_columns), 'FlowAmount': batch['FlowAmount']})
+        key_sums.append(keys.group_by('key').aggregate([('FlowAmount', 'sum')]))
+        sectors = pa.Table.from_batches([batch]).select(fbs_compare_total_columns + ['FlowAmount'])
+        sector_sums.append(decode_dictionary_columns(
+            sectors.group_by(fbs_compare_total_columns).aggregate([('FlowAmount', 'sum')])))
+    key_totals = pa.concat_tables(key_sums).group_by('key').aggregate([('FlowAmount_sum', 'sum')]).to_pandas()
+    sector_totals = pa.concat_tables(sector_sums).group_by(
+        fbs_compare_total_columns).aggregate([('FlowAmount_sum', 'sum')]).to_pandas()
+    return key_totals.set_index('key')['FlowAmount_sum_sum'], \
+        sector_totals.set_index(fbs_compare_total_columns)['FlowAmount_sum_sum']
+
+
+def fbs_rows_by_key(path, key_columns, hashes, batch_rows=500000):
+    """
+    Key column values of the flows in a stored FlowBySector file with one of a set of key hashes
+    :param path: str, FlowBySector parquet file path
+    :param key_columns: list, columns identifying a flow
+    :param hashes: numpy uint64 array, key hashes to keep
+    :param batch_rows: int, rows read at a time
+    :return: df of key_columns indexed by key hash, one row per hash
+    """
+    rows = []
+    if len(hashes) > 0:
+        parquet = pq.ParquetFile(path, read_dictionary=key_columns)
+        for batch in parquet.iter_batches(batch_size=batch_rows, columns=key_columns):
+            batch_hashes = row_hashes(batch, key_columns)
+            keep = np.isin(batch_hashes, hashes)
+            if keep.any():
+                df = decode_dictionary_columns(pa.Table.from_batches([batch]).filter(pa.array(keep))).to_pandas()
+                df.index = batch_hashes[keep]
+                rows.append(df)
+    if len(rows) == 0:
+        return pd.DataFrame(columns=key_columns, index=pd.Index([], dtype=np.uint64))
+    df = pd.concat(rows)
+    return df[~df.index.duplicated()]
+
+
+def compare_fbs(a, b, rtol=1e-5, atol=0.0, key_columns=None, batch_rows=500000):
+    """
+    Compare two versions of a FlowBySector output. Flows are joined on a 64-bit hash of their key columns and
+    both files are read in batches, so full county outputs can be compared without merging on the string columns.
+    :param a: str, FlowBySector method name or parquet file path of the reference version
+    :param b: str, FlowBySector method name or parquet file path of the new version
+    :param rtol: float, relative tolerance of a changed FlowAmount
+    :param atol: float, absolute tolerance of a changed FlowAmount
+    :param key_columns: list, columns identifying a flow, defaults to the FlowBySector grouping columns in both files
+    :param batch_rows: int, rows read at a time
+    :return: dict of dfs, 'added' and 'removed' flows, 'changed' flows with FlowAmount_a, FlowAmount_b and
+     Difference, and 'sector_totals' of FlowAmount_a, FlowAmount_b and Difference by sector and unit
+    """
+    path_a = fbs_parquet_path(a)
+    path_b = fbs_parquet_path(b)
+    if key_columns is None:
+        names_a = pq.read_schema(path_a).names
+        names_b = pq.read_schema(path_b).names
+        key_columns = [c for c in fbs_default_grouping_fields if c in names_a and c in names_b]
+    keys_a, sectors_a = sum_fbs_by_key(path_a, key_columns, batch_rows)
+    keys_b, sectors_b = sum_fbs_by_key(path_b, key_columns, batch_rows)
+
+    amounts = pd.concat([keys_a.rename('FlowAmount_a'), keys_b.rename('FlowAmount_b')], axis=1)
+    added = amounts.index[amounts['FlowAmount_a'].isnull()]
+    removed = amounts.index[amounts['FlowAmount_b'].isnull()]
+    both = amounts.dropna()
+    changed = both.index[~np.isclose(both['FlowAmount_b'], both['FlowAmount_a'], rtol=rtol, atol=atol)]
+
+    # only the key values of flows that differ are read back
+    keys = pd.concat([fbs_rows_by_key(path_a, key_columns, np.asarray(removed.append(changed), dtype=np.uint64),
+                                      batch_rows),
+                      fbs_rows_by_key(path_b, key_columns, np.asarray(added, dtype=np.uint64), batch_rows)])
+    result = {}
+    for name, index in (('added', added), ('removed', removed), ('changed', changed)):
+        df = keys.loc[index].join(amounts.loc[index])
+        df['Difference'] = df['FlowAmount_b'].fillna(0) - df['FlowAmount_a'].fillna(0)
+        result[name] = df.sort_values(key_columns).reset_index(drop=True)
+    result['added'] = result['added'].drop(columns=['FlowAmount_a'])
+    result['removed'] = result['removed'].drop(columns=['FlowAmount_b'])
+
+    sector_totals = pd.concat([sectors_a.rename('FlowAmount_a'), sectors_b.rename('FlowAmount_b')], axis=1)
+    sector_totals = sector_totals.fillna(0).reset_index()
+    sector_totals['Difference'] = sector_totals['FlowAmount_b'] - sector_totals['FlowAmount_a']
+    result['sector_totals'] = sector_totals
+
+    log.info("Compared " + str(len(keys_a)) + " and " + str(len(keys_b)) + " flows: " + str(len(added)) +
+             " added, " + str(len(removed)) + " removed, " + str(len(changed)) + " changed")
+    return result
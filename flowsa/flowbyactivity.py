@@ -9,7 +9,10 @@ EX: --year 2015 --source USGS_NWIS_WU
 
 import argparse
 from flowsa.common import *
-from flowsa.flowbyfunctions import add_missing_flow_by_fields
+from flowsa.flowbyfunctions import add_missing_flow_by_fields, clean_stamp, is_clean, fba_fill_na_dict
+from flowsa.storage import write_partitioned_flowbyactivity, write_flowby_parquet, write_ipc_sidecar, \
+    fba_sort_columns, file_provenance, write_vintage_flowbyactivity, read_flowbyactivity, remove_flowbyactivity_copies
+from flowsa.manifest import record_outputs
 from flowsa.BLS_QCEW import *
 from flowsa.Census_CBP import *
 from flowsa.Census_PEP_Population import *
@@ -32,20 +35,83 @@ def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument("-y", "--year", required=True, help="Year for data pull and save")
     ap.add_argument("-s", "--source", required=True, help="Data source code to pull and save")
+    ap.add_argument("-p", "--partitioned", action='store_true',
+                    help="Save to the partitioned FlowByActivity store instead of a single parquet file")
+    ap.add_argument("-v", "--vintages", action='store_true',
+                    help="Save to the vintage store, where all years of the source share string dictionaries")
+    ap.add_argument("-w", "--max_workers", type=int, default=None,
+                    help="Maximum number of urls requested at the same time")
+    ap.add_argument("--parse_workers", type=int, default=None,
+                    help="Number of processes parsing responses while urls are requested, by default responses "
+                         "are parsed in this process")
+    ap.add_argument("-o", "--offline", action='store_true',
+                    help="Parse the responses in the response cache instead of requesting the urls")
+    ap.add_argument("-i", "--ipc_sidecar", action='store_true',
+                    help="Also save an uncompressed Arrow IPC copy of the parquet file for memory-mapped reads")
     args = vars(ap.parse_args())
     return args
 
 
-def store_flowbyactivity(result, source, year=None):
-    """Prints the data frame into a parquet file."""
+def store_flowbyactivity(result, source, year=None, partitioned=False, ipc_sidecar=False, vintages=False):
+    """
+    Prints the data frame into a parquet file.
+    :param result: FlowByActivity df
+    :param source: str, source name, or source and year if year is None
+    :param year: year of data
+    :param partitioned: bool, if True save to the partitioned store, fbaoutputpath/source=/year=/Class=/
+    :param vintages: bool, if True save to the vintage store, fbaoutputpath/<source>_vintages/year=/, where all
+     years of the source share one dictionary per string column
+    :param ipc_sidecar: bool, if True also save an Arrow IPC sidecar next to a flat parquet file
+    :return: list of parquet files written, None if saving failed
+    """
+    if year is None and (partitioned or vintages):
+        raise ValueError("A year is required to store " + source + " in the partitioned or vintage store")
+    # record the source config the data was pulled with
+    provenance = file_provenance([sourceconfigpath + source + '.yaml'])
+    # stamp data that clean_df would not change, so loads can skip cleaning it
+    stamp = clean_stamp(flow_by_activity_fields) if is_clean(result, flow_by_activity_fields, fba_fill_na_dict) \
+        else None
     if year is not None:
         f = fbaoutputpath + source + "_" + str(year) + '.parquet'
     else:
         f = fbaoutputpath + source + '.parquet'
     try:
-        result.to_parquet(f, engine="pyarrow")
+        if vintages:
+            written = write_vintage_flowbyactivity(result, source, year, provenance, stamp)
+        elif partitioned:
+            written = write_partitioned_flowbyactivity(result, source, year, provenance, stamp)
+        else:
+            write_flowby_parquet(result, f, fba_sort_columns, provenance=provenance, clean_stamp=stamp)
+            written = [(f, None)]
+            if ipc_sidecar:
+                write_ipc_sidecar(f)
     except:
         log.error('Failed to save '+source + "_" + str(year) +' file.')
+        return None
+    try:
+        record_outputs(fbaoutputpath, 'FBA', source, year, [w[0] for w in written],
+                       partition_classes=[w[1] for w in written] if partitioned else None)
+    except Exception as e:
+        log.error('Failed to update the output manifest for ' + source + "_" + str(year) + ': ' + str(e))
+    return [w[0] for w in written]
+
+
+def store_flowbyactivity_vintages(source, years):
+    """
+    Move stored years of a source into the vintage store, where they share one dictionary per string column. Years
+    are read from wherever they are stored, and the flat and partitioned copies are deleted once the vintage
+    copy is written.
+    :param source: str, source name
+    :param years: list, years of data
+    """
+    for y in years:
+        df = read_flowbyactivity(source, [y])
+        if len(df) == 0:
+            continue
+        if store_flowbyactivity(df, source, y, vintages=True) is None:
+            continue
+        for path in remove_flowbyactivity_copies(source, y):
+            log.info('Removed ' + path + ', ' + source + ' ' + str(y) + ' is now in the vintage store')
 
 
 def build_url_for_query(urlinfo):
@@ -84,15 +150,15 @@ def assemble_urls_for_query(build_url, config, args):
 def call_urls(url_list, args):
     """This method calls all the urls that have been generated.
     It then calls the processing method to begin processing the returned data. The processing method is specific to
-    the data source, so this function relies on a function in source.py"""
-    data_frames_list = []
-    for url in url_list:
-        log.info("Calling " + url)
-        r = make_http_request(url)
-        if hasattr(sys.modules[__name__], config["call_response_fxn"]):
-            df = getattr(sys.modules[__name__], config["call_response_fxn"])(url, r, args)
-        data_frames_list.append(df)
-    return data_frames_list
+    the data source, so this function relies on a function in source.py.
+    Urls are requested concurrently, up to args['max_workers'] at a time. Responses are processed in this process,
+    or in a pool of args['parse_workers'] processes as soon as they are downloaded if set, see fetch_and_parse. The
+    data frames are returned in the order of url_list."""
+    if not hasattr(sys.modules[__name__], config["call_response_fxn"]):
+        return []
+    call_response_fxn = getattr(sys.modules[__name__], config["call_response_fxn"])
+    return fetch_and_parse(url_list, call_response_fxn, args, max_workers=args.get('max_workers'),
+                           parse_workers=args.get('parse_workers'))
 
 
 def parse_data(dataframe_list, args):
@@ -105,6 +171,9 @@ def parse_data(dataframe_list, args):
 if __name__ == '__main__':
     # assign arguments
     args = parse_args()
+    # re-parse downloaded data without requesting urls (common.py fxn)
+    if args['offline']:
+        set_offline()
     # assign yaml parameters (common.py fxn)
     config = load_sourceconfig(args['source'])
     # build the base url with strings that will be replaced
@@ -125,6 +194,6 @@ if __name__ == '__main__':
     flow_df = flow_df.sort_values(['Class', 'Location', 'ActivityProducedBy', 'ActivityConsumedBy',
                                    'FlowName', 'Compartment']).reset_index(drop=True)
     # save as parquet file
-    parquet_name = args['source'] + '_' + args['year']
-    store_flowbyactivity(flow_df, parquet_name)
+    store_flowbyactivity(flow_df, args['source'], args['year'], partitioned=args['partitioned'],
+                         ipc_sidecar=args['ipc_sidecar'], vintages=args['vintages'])
 
@@ -8,7 +8,8 @@ import numpy as np
 from flowsa.common import log, get_county_FIPS, get_state_FIPS, US_FIPS, activity_fields, \
     flow_by_activity_fields, flow_by_sector_fields, flow_by_sector_collapsed_fields, load_sector_crosswalk, \
     sector_source_name, get_flow_by_groupby_cols, create_fill_na_dict, generalize_activity_field_names, \
-    load_sector_length_crosswalk
+    load_sector_length_crosswalk, get_flow_by_categorical_cols
+from flowsa.manifest import flowbyactivity_exists_at_geoscale
 
 fba_activity_fields = [activity_fields['ProducedBy'][0]['flowbyactivity'],
                        activity_fields['ConsumedBy'][0]['flowbyactivity']]
@@ -23,19 +24,68 @@ fba_default_grouping_fields = get_flow_by_groupby_cols(flow_by_activity_fields)
 fbs_default_grouping_fields = get_flow_by_groupby_cols(flow_by_sector_fields)
 
 
-def clean_df(df, flowbyfields, fill_na_dict):
+# version of the cleaning done by clean_df, stamped into stored files that clean_df would not change. Increase it
+# when clean_df changes, so files stamped by older versions are cleaned in full again.
+clean_version = '1'
+
+# units converted by harmonize_units
+harmonized_units = ['ACRES', 'gallons/animal/day', 'ACRE FEET / ACRE']
+
+
+def clean_stamp(flowbyfields):
+    """
+    Stamp recorded in stored files that are already clean
+    :param flowbyfields: flow_by_activity_fields or flow_by_sector_fields
+    :return: str
+    """
+    return ('FBA' if flowbyfields is flow_by_activity_fields else 'FBS') + '.' + clean_version
+
+
+def is_clean(df, flowbyfields, fill_na_dict):
+    """
+    Check if clean_df would only drop the Description field of a df: all fields are present, in order and with
+    their data types, there are no null values to fill and no units to harmonize
+    :param df: flowbyactivity or flowbysector df
+    :param flowbyfields: flow_by_activity_fields or flow_by_sector_fields
+    :param fill_na_dict: fba_fill_na_dict or fbs_fill_na_dict
+    :return: bool
+    """
+    if list(df.columns) != list(flowbyfields.keys()):
+        return False
+    dtypes = {'str': 'object', 'int': 'int64', 'float': 'float64'}
+    if any(str(df[k].dtype) != dtypes[v[0]['dtype']] for k, v in flowbyfields.items()):
+        return False
+    return not df[[k for k in fill_na_dict.keys() if k in df.columns]].isnull().values.any() and \
+        not df['Unit'].isin(harmonized_units).any()
+
+
+def clean_df(df, flowbyfields, fill_na_dict, categorical=False, stamped=False):
     """
 
     :param df:
     :param flowbyfields: flow_by_activity_fields or flow_by_sector_fields
     :param fill_na_dict: fba_fill_na_dict or fbs_fill_na_dict
+    :param categorical: bool, if True the descriptive string fields are returned as pandas categoricals
+    :param stamped: bool, True if the df is read unchanged from stored files stamped with clean_stamp
     :return:
     """
-
-    # temporarily replace 'None' with None until old code modified
-    df = df.replace({'None': None})
+    fields = [k for k in flowbyfields.keys() if k != 'Description']
+    if stamped and all(k in df.columns for k in fields):
+        # stamped files were clean when written, so only select the fields in order, into a new df
+        df = df.reindex(columns=fields)
+        return categorize_flow_by_fields(df, flowbyfields) if categorical else df
+
+    if categorical:
+        # categorical columns are cleaned through their categories in add_missing_flow_by_fields, so only
+        # replace values in the remaining columns
+        cat_cols = [c for c in df.columns if pd.api.types.is_categorical_dtype(df[c])]
+        df = pd.concat([df.drop(columns=cat_cols).replace({'None': None}), df[cat_cols]], axis=1)
+        fill_na_dict = {k: v for k, v in fill_na_dict.items() if k not in get_flow_by_categorical_cols(flowbyfields)}
+    else:
+        # temporarily replace 'None' with None until old code modified
+        df = df.replace({'None': None})
     # ensure correct data types
-    df = add_missing_flow_by_fields(df, flowbyfields)
+    df = add_missing_flow_by_fields(df, flowbyfields, categorical=categorical)
     # drop description field, if exists
     if 'Description' in df.columns:
         df = df.drop(columns='Description')
@@ -43,6 +93,9 @@ def clean_df(df, flowbyfields, fill_na_dict):
     df = df.fillna(value=fill_na_dict)
     # harmonize units across dfs
     df = harmonize_units(df)
+    if categorical:
+        # unit harmonization returns the unit as strings
+        df = categorize_flow_by_fields(df, flowbyfields)
 
     return df
 
@@ -149,30 +202,68 @@ def aggregator(df, groupbycols):
     for e in column_headers:
         agg_funx.update({e: wm})
 
-    # aggregate df by groupby columns, either summing or creating weighted averages
-    df_dfg = df.groupby(groupbycols, as_index=False).agg(agg_funx)
+    # aggregate df by groupby columns, either summing or creating weighted averages. observed=True only groups
+    # on combinations of categorical values that exist in the df
+    df_dfg = df.groupby(groupbycols, as_index=False, observed=True).agg(agg_funx)
 
     return df_dfg
 
 
-def add_missing_flow_by_fields(flowby_partial_df, flowbyfields):
+def add_missing_flow_by_fields(flowby_partial_df, flowbyfields, categorical=False):
     """
     Add in missing fields to have a complete and ordered
     :param flowby_partial_df: Either flowbyactivity or flowbysector df
     :param flowbyfields: Either flow_by_activity_fields, flow_by_sector_fields, or flow_by_sector_collapsed_fields
+    :param categorical: bool, if True the descriptive string fields are cast to pandas categoricals
     :return:
     """
     for k in flowbyfields.keys():
         if k not in flowby_partial_df.columns:
             flowby_partial_df[k] = None
     # convert data types to match those defined in flow_by_activity_fields
+    categorical_cols = get_flow_by_categorical_cols(flowbyfields) if categorical else []
     for k, v in flowbyfields.items():
-        flowby_partial_df[k] = flowby_partial_df[k].astype(v[0]['dtype'])
+        if k in categorical_cols:
+            flowby_partial_df[k] = to_string_categorical(flowby_partial_df[k])
+        else:
+            flowby_partial_df[k] = flowby_partial_df[k].astype(v[0]['dtype'])
     # Resort it so order is correct
     flowby_partial_df = flowby_partial_df[flowbyfields.keys()]
     return flowby_partial_df
 
 
+def to_string_categorical(series):
+    """
+    Cast a series to a categorical of strings. Values match casting the series to 'str', but the strings are only
+    stored once per category.
+    :param series: pandas series, either categorical or not
+    :return: categorical pandas series
+    """
+    if not pd.api.types.is_categorical_dtype(series):
+        series = series.astype('category')
+    # missing values become 'None', as when casting to 'str'
+    if series.isna().any():
+        if 'None' not in series.cat.categories:
+            series = series.cat.add_categories(['None'])
+        series = series.fillna('None')
+    if not all(isinstance(c, str) for c in series.cat.categories):
+        series = series.astype(str).astype('category')
+    return series
+
+
+def categorize_flow_by_fields(df, flowbyfields):
+    """
+    Cast the descriptive string fields of a flowbyactivity or flowbysector df to categoricals
+    :param df: Either flowbyactivity or flowbysector df
+    :param flowbyfields: Either flow_by_activity_fields, flow_by_sector_fields, or flow_by_sector_collapsed_fields
+    :return: df with categorical string fields
+    """
+    for k in get_flow_by_categorical_cols(flowbyfields):
+        if k in df.columns and not pd.api.types.is_categorical_dtype(df[k]):
+            df[k] = to_string_categorical(df[k])
+    return df
+
+
 def check_flow_by_fields(flowby_df, flowbyfields):
     """
     Add in missing fields to have a complete and ordered
@@ -213,14 +304,26 @@ def check_if_activities_match_sectors(fba):
         return None
 
 
-def check_if_data_exists_at_geoscale(df, geoscale, activitynames='All'):
+def check_if_data_exists_at_geoscale(df, geoscale, activitynames='All', datasource=None, years=None,
+                                     flowclass=None):
     """
     Check if an activity or a sector exists at the specified geoscale
     :param df: flowbyactivity dataframe
     :param activitynames: Either an activity name (ex. 'Domestic') or a sector (ex. '1124')
     :param geoscale: national, state, or county
+    :param datasource: str, optional, stored FlowByActivity source the unmodified df was loaded from. If set, the
+     output manifest is checked instead of the df when it covers the stored files.
+    :param years: list, years of the stored FlowByActivity source
+    :param flowclass: list, classes of the stored FlowByActivity source loaded
     :return:
     """
+    if datasource is not None:
+        exists = flowbyactivity_exists_at_geoscale(datasource, years, geoscale, activitynames, flowclass)
+        if exists is not None:
+            log.info(("Flows found for " if exists == "Yes" else "No flows found for ") +
+                     (activitynames if isinstance(activitynames, str) else ', '.join(activitynames)) +
+                     " at the " + geoscale + " scale, from the output manifest.")
+            return exists
 
     # if any activity name is specified, check if activity data exists at the specified geoscale
     activity_list = []
@@ -432,9 +535,8 @@ def allocation_helper(df_w_sector, method, attr):
 
     helper_allocation = flowsa.getFlowByActivity(flowclass=[attr['helper_source_class']],
                                                  datasource=attr['helper_source'],
-                                                 years=[attr['helper_source_year']])
-    # clean df
-    helper_allocation = clean_df(helper_allocation, flow_by_activity_fields, fba_fill_na_dict)
+                                                 years=[attr['helper_source_year']],
+                                                 clean=True)
     # drop rows with flowamount = 0
     helper_allocation = helper_allocation[helper_allocation['FlowAmount'] != 0]
 
@@ -788,19 +890,17 @@ def collapse_fbs_sectors(fbs):
     :return:
     """
 
-    # collapse the FBS sector columns into one column based on FlowType
-    fbs.loc[:, 'Sector'] = np.where(fbs["FlowType"] == 'TECHNOSPHERE_FLOW', fbs["SectorConsumedBy"], "None")
-    fbs.loc[:, 'Sector'] = np.where(fbs["FlowType"] == 'WASTE_FLOW', fbs["SectorProducedBy"],
-                                    fbs['Sector'])
-    fbs.loc[:, 'Sector'] = np.where(
-        (fbs["FlowType"] == 'WASTE_FLOW') & (fbs['SectorProducedBy'] == 'None'),
-        fbs["SectorConsumedBy"], fbs['Sector'])
-    fbs.loc[:, 'Sector'] = np.where(
-        (fbs["FlowType"] == 'ELEMENTARY_FLOW') & (fbs['SectorProducedBy'] == 'None'),
-        fbs["SectorConsumedBy"], fbs['Sector'])
-    fbs.loc[:, 'Sector'] = np.where(
-        (fbs["FlowType"] == 'ELEMENTARY_FLOW') & (fbs['SectorConsumedBy'] == 'None'),
-        fbs["SectorProducedBy"], fbs['Sector'])
+    # collapse the FBS sector columns into one column based on FlowType, the first matching condition is used
+    flowtype = fbs['FlowType']
+    spb = fbs['SectorProducedBy']
+    scb = fbs['SectorConsumedBy']
+    sector = np.select([(flowtype == 'ELEMENTARY_FLOW') & (scb == 'None'),
+                        (flowtype == 'ELEMENTARY_FLOW') & (spb == 'None'),
+                        (flowtype == 'WASTE_FLOW') & (spb == 'None'),
+                        flowtype == 'WASTE_FLOW',
+                        flowtype == 'TECHNOSPHERE_FLOW'],
+                       [spb, scb, scb, spb, scb], default='None')
+    fbs = fbs.assign(Sector=sector)
 
     # drop sector consumed/produced by columns
     fbs_collapsed = fbs.drop(columns=['SectorProducedBy', 'SectorConsumedBy'])
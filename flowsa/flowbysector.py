@@ -23,18 +23,23 @@ import argparse
 import sys
 import pandas as pd
 from flowsa.common import log, flowbyactivitymethodpath, flow_by_sector_fields,  \
-    generalize_activity_field_names, fbsoutputpath, fips_number_key, flow_by_activity_fields
+    generalize_activity_field_names, fbsoutputpath, fips_number_key, flow_by_activity_fields, datapath
 from flowsa.mapping import add_sectors_to_flowbyactivity, get_fba_allocation_subset, map_elementary_flows, \
-    get_sector_list, add_non_naics_sectors
+    get_sector_list, add_non_naics_sectors, activitytosector_mapping_file
 from flowsa.flowbyfunctions import fba_activity_fields, fbs_default_grouping_fields, agg_by_geoscale, \
     fba_fill_na_dict, fbs_fill_na_dict, fba_default_grouping_fields, \
     fbs_activity_fields, allocate_by_sector, allocation_helper, sector_aggregation, \
     filter_by_geoscale, aggregator, check_if_data_exists_at_geoscale, check_if_location_systems_match, \
     check_if_data_exists_at_less_aggregated_geoscale, check_if_data_exists_for_same_geoscales, clean_df,\
-    sector_disaggregation
+    sector_disaggregation, clean_stamp, is_clean, collapse_fbs_sectors
 from flowsa.USGS_NWIS_WU import usgs_fba_data_cleanup, usgs_fba_w_sectors_data_cleanup
 from flowsa.USDA_CoA_Cropland import disaggregate_coa_cropland_to_6_digit_naics, coa_irrigated_cropland_fba_cleanup
 from flowsa.datachecks import sector_flow_comparision
+from flowsa.storage import write_flowby_parquet, write_ipc_sidecar, fbs_sort_columns, fbs_row_group_size, \
+    file_provenance, fingerprint, flowbyactivity_files, estimated_frame_bytes
+from flowsa.cache import flowby_cache
+from flowsa.manifest import record_outputs, flowbyactivity_exists_at_geoscale
+from flowsa.cube import build_flowbysector_cube, write_flowbysector_cube
 
 
 def parse_args():
@@ -42,6 +47,14 @@ def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument("-m", "--method", required=True, help="Method for flow by sector file. "
                                                           "A valid method config file must exist with this name.")
+    ap.add_argument("-i", "--ipc_sidecar", action='store_true',
+                    help="Also save an uncompressed Arrow IPC copy of the parquet file for memory-mapped reads")
+    ap.add_argument("-c", "--cube", action='store_true',
+                    help="Also save the rollup cube of all sector levels and geoscales")
+    ap.add_argument("-l", "--collapsed", action='store_true',
+                    help="Also save the flowbysector with the sector columns collapsed into one Sector column")
+    ap.add_argument("-w", "--max_workers", type=int, default=None,
+                    help="Maximum number of FlowByActivity datasets loaded at the same time")
     args = vars(ap.parse_args())
     return args
 
@@ -60,17 +73,18 @@ def load_method(method_name):
         log.error("File not found.")
     return method
 
-def load_source_dataframe(k, v):
+def load_source_dataframe(k, v, clean=False):
     """
     Load the source dataframe. Data can be a FlowbyActivity or FlowBySector parquet stored in flowsa, or a FlowBySector
     formatted dataframe from another package.
     :param k: The datasource name
     :param v: The datasource parameters
+    :param clean: bool, if True a FlowByActivity is returned cleaned with clean_df
     :return:
     """
     if v['data_format'] == 'FBA':
         log.info("Retrieving flowbyactivity for datasource " + k + " in year " + str(v['year']))
-        flows_df = flowsa.getFlowByActivity(flowclass=[v['class']], years=[v['year']], datasource=k)
+        flows_df = flowsa.getFlowByActivity(flowclass=[v['class']], years=[v['year']], datasource=k, clean=clean)
     elif v['data_format'] == 'FBS':
         log.info("Retrieving flowbysector for datasource " + k)
         flows_df = flowsa.getFlowBySector(k)
@@ -83,45 +97,218 @@ def load_source_dataframe(k, v):
     return flows_df
 
 
-def store_flowbysector(fbs_df, parquet_name):
-    """Prints the data frame into a parquet file."""
+def check_method_sources(method):
+    """
+    Check the stored FlowByActivity sources of a method exist at the geoscales used, from the output manifest alone
+    :param method: dictionary, loaded method yaml
+    :return: list of str, descriptions of the problems found
+    """
+    problems = []
+    for k, v in method['source_names'].items():
+        if v['data_format'] != 'FBA':
+            continue
+        checks = [(k, v['year'], v['class'], v['geoscale_to_use'], 'All')]
+        for aset, attr in v['activity_sets'].items():
+            if attr['allocation_method'] != 'direct':
+                checks.append((attr['allocation_source'], attr['allocation_source_year'],
+                               attr['allocation_source_class'], attr['allocation_from_scale'], 'All'))
+        for source, year, flowclass, geoscale, names in checks:
+            exists = flowbyactivity_exists_at_geoscale(source, [year], geoscale, names, [flowclass])
+            if exists == "No":
+                problems.append("No " + flowclass + " flows of " + source + " " + str(year) + " at the " +
+                                geoscale + " scale")
+            elif exists is None:
+                log.debug("The output manifest does not cover " + source + " " + str(year))
+    for p in problems:
+        log.warning(p)
+    return problems
+
+
+def method_fba_requests(method):
+    """
+    The FlowByActivity loads of a method, as getFlowByActivity keyword arguments, in the same form used by main, so
+    loading them ahead fills the FlowByActivity cache for main
+    :param method: dictionary, loaded method yaml
+    :return: list of dicts of getFlowByActivity keyword arguments, without duplicates
+    """
+    requests = []
+    for k, v in method['source_names'].items():
+        if v['data_format'] != 'FBA':
+            continue
+        requests.append({'flowclass': [v['class']], 'years': [v['year']], 'datasource': k})
+        for aset, attr in v['activity_sets'].items():
+            if attr['allocation_method'] == 'direct':
+                continue
+            requests.append({'flowclass': [attr['allocation_source_class']],
+                             'datasource': attr['allocation_source'],
+                             'years': [attr['allocation_source_year']],
+                             'flownames': None if attr['allocation_flow'] == 'None' else attr['allocation_flow'],
+                             'compartments': None if attr['allocation_compartment'] == 'None'
+                             else attr['allocation_compartment']})
+            if attr['allocation_helper'] == 'yes':
+                requests.append({'flowclass': [attr['helper_source_class']],
+                                 'datasource': attr['helper_source'],
+                                 'years': [attr['helper_source_year']]})
+    unique_requests = []
+    for r in requests:
+        if r not in unique_requests:
+            unique_requests.append(r)
+    return unique_requests
+
+
+def prefetch_flowbyactivity(requests, max_workers=None):
+    """
+    Load FlowByActivity datasets concurrently into the cache, so later loads of them are cache hits. Nothing is
+    loaded if the cache is disabled or the datasets are estimated to take more memory than the cache holds once
+    loaded, as the loaded dfs would evict each other before they are used.
+    :param requests: list of dicts of getFlowByActivity keyword arguments, from method_fba_requests
+    :param max_workers: int, maximum number of datasets loaded at the same time
+    :return: bool, True if the datasets were loaded
+    """
+    files = set(f for r in requests for f in flowbyactivity_files(r['datasource'], r['years']))
+    nbytes = estimated_frame_bytes(sorted(files))
+    if flowby_cache.max_bytes == 0 or nbytes > flowby_cache.max_bytes:
+        log.info("Not loading FlowByActivity datasets ahead, an estimated " + str(nbytes) + " bytes of loaded data "
+                 "do not fit the " + str(flowby_cache.max_bytes) + " byte cache")
+        return False
+    flowsa.getFlowByActivities(requests, max_workers=max_workers)
+    return True
+
+
+def method_provenance(method_name, method):
+    """
+    Hashes of the method yaml and the crosswalks a flowbysector method is built with
+    :param method_name: str, name of the method
+    :param method: dictionary, loaded method yaml
+    :return: dict of file name: hex digest
+    """
+    paths = [flowbyactivitymethodpath + method_name + '.yaml',
+             datapath + 'NAICS_07_to_17_Crosswalk.csv',
+             datapath + 'NAICS_2012_Crosswalk.csv',
+             datapath + 'Household_SectorCodes.csv']
+    for r in method_fba_requests(method):
+        paths.append(activitytosector_mapping_file(r['datasource']))
+    return file_provenance(paths)
+
+
+def store_flowbysector(fbs_df, parquet_name, ipc_sidecar=False, provenance=None):
+    """
+    Prints the data frame into a parquet file.
+    :param fbs_df: FlowBySector df
+    :param parquet_name: str, name of the parquet file
+    :param ipc_sidecar: bool, if True also save an Arrow IPC sidecar next to the parquet file
+    :param provenance: dict, hashes of the method yaml and crosswalks, from method_provenance
+    """
     f = fbsoutputpath + parquet_name + '.parquet'
+    # stamp data that clean_df would not change, so loads can skip cleaning it
+    stamp = clean_stamp(flow_by_sector_fields) if is_clean(fbs_df, flow_by_sector_fields, fbs_fill_na_dict) else None
     try:
-        fbs_df.to_parquet(f)
+        write_flowby_parquet(fbs_df, f, fbs_sort_columns, fbs_row_group_size, provenance, stamp)
+        if ipc_sidecar:
+            write_ipc_sidecar(f)
     except:
         log.error('Failed to save ' + parquet_name + ' file.')
+        return
+    try:
+        record_outputs(fbsoutputpath, 'FBS', parquet_name, None, [f])
+    except Exception as e:
+        log.error('Failed to update the output manifest for ' + parquet_name + ': ' + str(e))
+
+
+def collapsed_parquet_name(method_name):
+    """Name of the stored collapsed flowbysector of a method"""
+    return method_name + '_collapsed'
 
 
-def main(method_name):
+def store_flowbysector_collapsed(fbs_df, method_name):
+    """
+    Saves the flowbysector with collapsed sector columns next to the standard parquet file. The fingerprint of the
+    standard file is recorded as the file it was built from, so the collapsed file is only used while they match.
+    :param fbs_df: FlowBySector df, as stored by store_flowbysector
+    :param method_name: str, name of the method
+    """
+    f = fbsoutputpath + collapsed_parquet_name(method_name) + '.parquet'
+    try:
+        provenance = {method_name + '.parquet': fingerprint(fbsoutputpath + method_name + '.parquet')}
+        write_flowby_parquet(collapse_fbs_sectors(fbs_df), f, ['Location', 'Flowable', 'Context', 'Sector'],
+                             fbs_row_group_size, provenance)
+    except:
+        log.error('Failed to save ' + collapsed_parquet_name(method_name) + ' file.')
+        return
+    try:
+        record_outputs(fbsoutputpath, 'FBS', collapsed_parquet_name(method_name), None, [f])
+    except Exception as e:
+        log.error('Failed to update the output manifest for ' + collapsed_parquet_name(method_name) + ': ' + str(e))
+
+
+def store_flowbysector_cube(fbs_all_levels, method_name, target_geoscale):
+    """
+    Sums and saves the rollup cube of a flowbysector method
+    :param fbs_all_levels: list of FlowBySector dfs with sectors at all levels, at the target geoscale
+    :param method_name: str, name of the method
+    :param target_geoscale: national, state, or county
+    """
+    log.info("Building rollup cube of " + method_name)
+    fbs = pd.concat(fbs_all_levels, ignore_index=True, sort=False)
+    fbs = clean_df(fbs, flow_by_sector_fields, fbs_fill_na_dict)
+    try:
+        written = write_flowbysector_cube(build_flowbysector_cube(fbs, target_geoscale), method_name)
+    except:
+        log.error('Failed to save ' + method_name + ' rollup cube.')
+        return
+    try:
+        record_outputs(fbsoutputpath, 'FBS', method_name + '_cube', None, written)
+    except Exception as e:
+        log.error('Failed to update the output manifest for ' + method_name + ' rollup cube: ' + str(e))
+
+
+def main(method_name, ipc_sidecar=False, max_workers=None, cube=False, checkpoint=None, collapsed=False):
     """
     Creates a flowbysector dataset
     :param method_name: Name of method corresponding to flowbysector method yaml name
+    :param ipc_sidecar: bool, if True also save an Arrow IPC sidecar of the flowbysector parquet
+    :param max_workers: int, maximum number of FlowByActivity datasets loaded at the same time
+    :param cube: bool, if True also save the rollup cube of all sector levels and geoscales
+    :param checkpoint: function called with the name of each stage before it starts, which can raise an exception
+     to stop the build between stages
+    :param collapsed: bool, if True also save the flowbysector with the sector columns collapsed
     :return: flowbysector
     """
+    if checkpoint is None:
+        checkpoint = lambda stage: None
 
     log.info("Initiating flowbysector creation for " + method_name)
     # call on method
     method = load_method(method_name)
+    # flag missing data before any data is loaded
+    check_method_sources(method)
+    # load all FlowByActivity datasets of the method concurrently into the cache, rather than one at a time
+    checkpoint("load")
+    log.info("Loading FlowByActivity datasets used by " + method_name)
+    prefetch_flowbyactivity(method_fba_requests(method), max_workers=max_workers)
     # create dictionary of data and allocation datasets
     fb = method['source_names']
     # Create empty list for storing fbs files
     fbss = []
+    # fbs at every sector level, for the rollup cube
+    fbs_all_levels = []
     for k, v in fb.items():
-        # pull fba data for allocation
-        flows = load_source_dataframe(k, v)
+        checkpoint("source " + k)
+        # pull fba data for allocation, loaded already cleaned unless a cleanup function runs on the stored data first
+        flows = load_source_dataframe(k, v, clean=v.get('clean_fba_df_fxn', 'None') == 'None')
 
         if v['data_format'] == 'FBA':
             # clean up fba, if specified in yaml
             if v["clean_fba_df_fxn"] != 'None':
                 log.info("Cleaning up " + k + " FlowByActivity")
                 flows = getattr(sys.modules[__name__], v["clean_fba_df_fxn"])(flows)
-
-            flows = clean_df(flows, flow_by_activity_fields, fba_fill_na_dict)
+                flows = clean_df(flows, flow_by_activity_fields, fba_fill_na_dict)
 
             # create dictionary of allocation datasets for different activities
             activities = v['activity_sets']
             # subset activity data and allocate to sector
             for aset, attr in activities.items():
+                checkpoint("activity set " + k + " " + aset)
                 # subset by named activities
                 names = attr['names']
                 log.info("Preparing to handle subset of flownames " + ', '.join(map(str, names)) + " in " + k)
@@ -134,7 +321,14 @@ def main(method_name):
                                         (flows[fba_activity_fields[1]] == n)].reset_index(drop=True)
                     log.info("Checking if flowbyactivity data exists for " + n + " at the " +
                              v['geoscale_to_use'] + ' level')
-                    geocheck = check_if_data_exists_at_geoscale(flow_subset, v['geoscale_to_use'], activitynames=n)
+                    # without a cleaning function the stored data is unmodified, so the output manifest can answer
+                    if v["clean_fba_df_fxn"] == 'None':
+                        geocheck = check_if_data_exists_at_geoscale(flow_subset, v['geoscale_to_use'],
+                                                                    activitynames=n, datasource=k,
+                                                                    years=[v['year']], flowclass=[v['class']])
+                    else:
+                        geocheck = check_if_data_exists_at_geoscale(flow_subset, v['geoscale_to_use'],
+                                                                    activitynames=n)
                     # aggregate geographically to the scale of the allocation dataset
                     if geocheck == "Yes":
                         activity_from_scale = v['geoscale_to_use']
@@ -188,18 +382,17 @@ def main(method_name):
                     # determine appropriate allocation dataset
                     log.info("Loading allocation flowbyactivity " + attr['allocation_source'] + " for year " +
                              str(attr['allocation_source_year']))
+                    # subset based on yaml settings while loading, so unused flows are never read
+                    allocation_flow = None if attr['allocation_flow'] == 'None' else attr['allocation_flow']
+                    allocation_compartment = None if attr['allocation_compartment'] == 'None' \
+                        else attr['allocation_compartment']
                     fba_allocation = flowsa.getFlowByActivity(flowclass=[attr['allocation_source_class']],
                                                               datasource=attr['allocation_source'],
-                                                              years=[attr['allocation_source_year']]).reset_index(drop=True)
-
-                    fba_allocation = clean_df(fba_allocation, flow_by_activity_fields, fba_fill_na_dict)
+                                                              years=[attr['allocation_source_year']],
+                                                              flownames=allocation_flow,
+                                                              compartments=allocation_compartment,
+                                                              clean=True).reset_index(drop=True)
 
-                    # subset based on yaml settings
-                    if attr['allocation_flow'] != 'None':
-                        fba_allocation = fba_allocation.loc[fba_allocation['FlowName'].isin(attr['allocation_flow'])]
-                    if attr['allocation_compartment'] != 'None':
-                        fba_allocation = fba_allocation.loc[
-                            fba_allocation['Compartment'].isin(attr['allocation_compartment'])]
                     # cleanup the fba allocation df, if necessary
                     if 'clean_allocation_fba' in attr:
                         log.info("Cleaning " + attr['allocation_source'])
@@ -320,6 +513,8 @@ def main(method_name):
                 fbs = sector_aggregation(fbs, fbs_default_grouping_fields)
                 # add missing naics5/6 when only one naics5/6 associated with a naics4
                 fbs = sector_disaggregation(fbs)
+                if cube:
+                    fbs_all_levels.append(fbs.assign(SectorSourceName=method['target_sector_source']))
 
                 # test agg by sector
                 # sector_agg_comparison = sector_flow_comparision(fbs)
@@ -346,6 +541,9 @@ def main(method_name):
             # if the loaded flow dt is already in FBS format, append directly to list of FBS
             log.info("Append " + k + " to FBS list")
             fbss.append(flows)
+            if cube:
+                fbs_all_levels.append(flows)
+    checkpoint("combine")
     # create single df of all activities
     log.info("Concat data for all activities")
     fbss = pd.concat(fbss, ignore_index=True, sort=False)
@@ -360,11 +558,19 @@ def main(method_name):
     fbss = fbss.sort_values(
         ['SectorProducedBy', 'SectorConsumedBy', 'Flowable', 'Context']).reset_index(drop=True)
     # save parquet file
-    store_flowbysector(fbss, method_name)
+    checkpoint("store")
+    store_flowbysector(fbss, method_name, ipc_sidecar=ipc_sidecar,
+                       provenance=method_provenance(method_name, method))
+    if collapsed:
+        store_flowbysector_collapsed(fbss, method_name)
+    if cube:
+        store_flowbysector_cube(fbs_all_levels, method_name, method['target_geoscale'])
+    return fbss
 
 
 if __name__ == '__main__':
     # assign arguments
     args = parse_args()
-    main(args["method"])
+    main(args["method"], ipc_sidecar=args["ipc_sidecar"], max_workers=args["max_workers"],
+         cube=args["cube"], collapsed=args["collapsed"])
 
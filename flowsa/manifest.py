@@ -0,0 +1,321 @@
+# manifest.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Catalog of stored FlowByActivity and FlowBySector parquet files.
+Each output directory has a SQLite manifest, updated in one transaction whenever files are stored, recording the
+row count, size, content fingerprint and build time of each file with the classes, units, locations per geoscale and
+activities it contains. Data can then be found, and files skipped, without opening the parquet files.
+"""
+
+import os
+import json
+import sqlite3
+import datetime
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from flowsa.common import log, US_FIPS, get_state_FIPS, get_county_FIPS
+import flowsa.storage as storage
+
+manifest_name = 'manifest.sqlite'
+
+manifest_schema = """
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    year TEXT,
+    rows INTEGER,
+    bytes INTEGER,
+    mtime_ns INTEGER,
+    content_hash TEXT,
+    built TEXT,
+    classes TEXT,
+    units TEXT,
+    locations TEXT
+);
+CREATE TABLE IF NOT EXISTS activities (
+    path TEXT NOT NULL,
+    class TEXT,
+    activity TEXT NOT NULL,
+    geoscale TEXT
+);
+CREATE INDEX IF NOT EXISTS outputs_name ON outputs (kind, name, year);
+CREATE INDEX IF NOT EXISTS activities_path ON activities (path);
+"""
+
+# columns summarized as activities, by kind of output
+manifest_activity_columns = {'FBA': ['ActivityProducedBy', 'ActivityConsumedBy'],
+                             'FBS': ['SectorProducedBy', 'SectorConsumedBy']}
+
+# geoscale of each FIPS code, read once from the FIPS crosswalk
+_fips_geoscales = {}
+
+
+def manifest_file(outputdir):
+    """Path of the manifest of an output directory"""
+    return outputdir + manifest_name
+
+
+def connect_manifest(outputdir):
+    """
+    Open the manifest of an output directory, creating it if needed
+    :param outputdir: str, fbaoutputpath or fbsoutputpath
+    :return: sqlite3 Connection
+    """
+    os.makedirs(outputdir, exist_ok=True)
+    con = sqlite3.connect(manifest_file(outputdir), timeout=30)
+    con.executescript(manifest_schema)
+    return con
+
+
+def location_geoscale(location, location_system):
+    """
+    Geoscale of a location code
+    :param location: str, location code
+    :param location_system: str, e.g. 'FIPS_2015'
+    :return: 'national', 'state' or 'county', or None if the location system is not FIPS or the location is not
+     a FIPS code at any of these geoscales
+    """
+    if location is None or location_system is None or 'FIPS' not in location_system:
+        return None
+    return fips_geoscales().get(location)
+
+
+def fips_geoscales():
+    """
+    Geoscale of each FIPS code, from the same state and county FIPS lists create_geoscale_list filters by, so the
+    manifest agrees with filter_by_geoscale
+    :return: dict of FIPS code to 'national', 'state' or 'county'
+    """
+    if len(_fips_geoscales) == 0:
+        geoscales = {f: 'county' for f in get_county_FIPS()['FIPS']}
+        geoscales.update({f: 'state' for f in get_state_FIPS()['FIPS']})
+        geoscales[US_FIPS] = 'national'
+        _fips_geoscales.update(geoscales)
+    return _fips_geoscales
+
+
+def summarize_flowby_file(path, kind, partition_class=None):
+    """
+    Summarize the contents of a stored parquet file for the manifest
+    :param path: str, parquet file path
+    :param kind: str, 'FBA' or 'FBS'
+    :param partition_class: str, Class of a file in the partitioned store, where Class is not a column
+    :return: dict of outputs columns, list of (class, activity, geoscale) tuples
+    """
+    stat = os.stat(path)
+    parquet = pq.ParquetFile(path)
+    names = parquet.schema_arrow.names
+    activity_columns = [c for c in manifest_activity_columns[kind] if c in names]
+    columns = [c for c in ['Class', 'Unit', 'Location', 'LocationSystem'] if c in names] + activity_columns
+    if storage.is_vintage_file(path):
+        table = storage.read_vintage_file(path, columns=columns)
+    else:
+        table = parquet.read(columns=columns)
+    if partition_class is not None:
+        classes = [partition_class]
+    else:
+        classes = pc.unique(table['Class']).to_pylist() if 'Class' in names else []
+
+    # distinct combinations of class, location and activity, rather than every row
+    keys = [c for c in ['Class', 'Location', 'LocationSystem'] if c in names]
+    locations = {}
+    activities = set()
+    for activity_column in activity_columns or [None]:
+        group_columns = keys + ([activity_column] if activity_column is not None else [])
+        if len(group_columns) == 0:
+            continue
+        for row in table.group_by(group_columns).aggregate([]).to_pylist():
+            geoscale = location_geoscale(row.get('Location'), row.get('LocationSystem'))
+            locations.setdefault(str(geoscale), set()).add(row.get('Location'))
+            if activity_column is not None and row[activity_column] is not None:
+                activities.add((row.get('Class', partition_class), row[activity_column], geoscale))
+    summary = {'rows': parquet.metadata.num_rows,
+               'bytes': stat.st_size,
+               'mtime_ns': stat.st_mtime_ns,
+               'content_hash': storage.fingerprint(path) or storage.file_content_hash(path),
+               'built': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+               'classes': json.dumps(sorted(str(c) for c in classes)),
+               'units': json.dumps(sorted(str(u) for u in pc.unique(table['Unit']).to_pylist()))
+               if 'Unit' in names else '[]',
+               'locations': json.dumps({k: sorted(str(v) for v in values) for k, values in locations.items()})}
+    return summary, sorted(activities, key=str)
+
+
+def record_outputs(outputdir, kind, name, year, paths, partition_classes=None):
+    """
+    Replace the manifest entries of a stored source and year, or method, in one transaction
+    :param outputdir: str, fbaoutputpath or fbsoutputpath
+    :param kind: str, 'FBA' or 'FBS'
+    :param name: str, FlowByActivity source or FlowBySector method name
+    :param year: year of data, None for FlowBySector
+    :param paths: list, parquet file paths written
+    :param partition_classes: list, Class of each path in the partitioned store
+    :return: None
+    """
+    year = None if year is None else str(year)
+    summaries = []
+    for i, p in enumerate(paths):
+        partition_class = None if partition_classes is None else partition_classes[i]
+        summaries.append((p,) + summarize_flowby_file(p, kind, partition_class))
+    con = connect_manifest(outputdir)
+    try:
+        with con:
+            old_paths = [r[0] for r in con.execute(
+                "SELECT path FROM outputs WHERE kind = ? AND name = ? AND year IS ?", (kind, name, year))]
+            old_paths = set(old_paths + list(paths))
+            con.executemany("DELETE FROM activities WHERE path = ?", [(p,) for p in old_paths])
+            con.executemany("DELETE FROM outputs WHERE path = ?", [(p,) for p in old_paths])
+            for p, summary, activities in summaries:
+                con.execute("INSERT INTO outputs (path, kind, name, year, rows, bytes, mtime_ns, content_hash, "
+                            "built, classes, units, locations) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (p, kind, name, year, summary['rows'], summary['bytes'], summary['mtime_ns'],
+                             summary['content_hash'], summary['built'], summary['classes'], summary['units'],
+                             summary['locations']))
+                con.executemany("INSERT INTO activities (path, class, activity, geoscale) VALUES (?, ?, ?, ?)",
+                                [(p,) + a for a in activities])
+    finally:
+        con.close()
+
+
+def manifest_entries(outputdir, paths):
+    """
+    Manifest entries of files that are unchanged since they were recorded
+    :param outputdir: str, fbaoutputpath or fbsoutputpath
+    :param paths: list, parquet file paths
+    :return: dict of path: entry dict, files without a current entry are left out
+    """
+    if len(paths) == 0 or not os.path.isfile(manifest_file(outputdir)):
+        return {}
+    con = connect_manifest(outputdir)
+    try:
+        con.row_factory = sqlite3.Row
+        rows = con.execute("SELECT * FROM outputs WHERE path IN (" + ', '.join('?' * len(paths)) + ")",
+                           list(paths)).fetchall()
+    finally:
+        con.close()
+    entries = {}
+    for row in rows:
+        try:
+            stat = os.stat(row['path'])
+        except FileNotFoundError:
+            continue
+        if (stat.st_size, stat.st_mtime_ns) != (row['bytes'], row['mtime_ns']):
+            log.debug("Manifest entry is out of date for " + row['path'])
+            continue
+        entry = dict(row)
+        for c in ('classes', 'units', 'locations'):
+            entry[c] = json.loads(entry[c])
+        entries[row['path']] = entry
+    return entries
+
+
+def skip_files(outputdir, paths, flowclass=None, locations=None):
+    """
+    Drop files the manifest shows have no flows of the requested classes or locations
+    :param outputdir: str, fbaoutputpath or fbsoutputpath
+    :param paths: list, parquet file paths
+    :param flowclass: list, Class values to load, None for all
+    :param locations: list, Location codes to load, None for all
+    :return: list of the paths that may contain requested flows
+    """
+    entries = manifest_entries(outputdir, paths)
+    kept = []
+    for p in paths:
+        entry = entries.get(p)
+        if entry is not None:
+            if flowclass is not None and len(entry['classes']) > 0 and \
+                    set(entry['classes']).isdisjoint(as_list(flowclass)):
+                log.debug("Skipping " + p + ", no flows of the requested classes")
+                continue
+            stored_locations = set(l for values in entry['locations'].values() for l in values)
+            if locations is not None and stored_locations.isdisjoint(as_list(locations)):
+                log.debug("Skipping " + p + ", no flows at the requested locations")
+                continue
+        kept.append(p)
+    return kept
+
+
+def as_list(values):
+    """List of str values from a str or list"""
+    if isinstance(values, str):
+        values = [values]
+    return [str(v) for v in values]
+
+
+def exists_at_geoscale(outputdir, paths, geoscale, activitynames='All', flowclass=None):
+    """
+    Check if an activity, or any activity, exists at a geoscale using only the manifest
+    :param outputdir: str, fbaoutputpath or fbsoutputpath
+    :param paths: list, parquet file paths of the data
+    :param geoscale: national, state, or county
+    :param activitynames: Either an activity name (ex. 'Domestic'), a list of names, or 'All'
+    :param flowclass: list, only consider flows of these classes
+    :return: "Yes" or "No" like check_if_data_exists_at_geoscale, None if the manifest does not cover all files
+    """
+    entries = manifest_entries(outputdir, paths)
+    if len(paths) == 0 or len(entries) < len(paths):
+        return None
+    if activitynames == 'All':
+        classes = None if flowclass is None else set(as_list(flowclass))
+        for entry in entries.values():
+            if classes is not None and len(entry['classes']) > 0 and classes.isdisjoint(entry['classes']):
+                continue
+            if len(entry['locations'].get(geoscale, [])) > 0:
+                return "Yes"
+        return "No"
+    query = "SELECT COUNT(*) FROM activities WHERE geoscale = ? AND path IN (" + ', '.join('?' * len(paths)) + \
+            ") AND activity IN (" + ', '.join('?' * len(as_list(activitynames))) + ")"
+    params = [geoscale] + list(paths) + as_list(activitynames)
+    if flowclass is not None:
+        query = query + " AND class IN (" + ', '.join('?' * len(as_list(flowclass))) + ")"
+        params = params + as_list(flowclass)
+    con = connect_manifest(outputdir)
+    try:
+        count = con.execute(query, params).fetchone()[0]
+    finally:
+        con.close()
+    return "Yes" if count > 0 else "No"
+
+
+def skip_flowbyactivity_files(paths, flowclass=None, locations=None):
+    """
+    Drop stored FlowByActivity files the manifest shows have no flows of the requested classes or locations
+    :param paths: list, flat FlowByActivity parquet file paths
+    :param flowclass: list, Class values to load, None for all
+    :param locations: list, Location codes to load, None for all
+    :return: list of the paths that may contain requested flows
+    """
+    return skip_files(storage.fbaoutputpath, paths, flowclass, locations)
+
+
+def flowbyactivity_exists_at_geoscale(datasource, years, geoscale, activitynames='All', flowclass=None):
+    """
+    Check if a stored FlowByActivity source has an activity, or any activity, at a geoscale without loading data
+    :param datasource: str, FlowByActivity source name
+    :param years: list, years of data
+    :param geoscale: national, state, or county
+    :param activitynames: Either an activity name (ex. 'Domestic'), a list of names, or 'All'
+    :param flowclass: list, only consider flows of these classes
+    :return: "Yes" or "No", None if the data is not stored or not covered by the manifest
+    """
+    files = storage.flowbyactivity_files(datasource, years)
+    return exists_at_geoscale(storage.fbaoutputpath, files, geoscale, activitynames, flowclass)
+
+
+def read_manifest(outputdir):
+    """
+    All entries of the manifest of an output directory
+    :param outputdir: str, fbaoutputpath or fbsoutputpath
+    :return: list of entry dicts
+    """
+    if not os.path.isfile(manifest_file(outputdir)):
+        return []
+    con = connect_manifest(outputdir)
+    try:
+        paths = [r[0] for r in con.execute("SELECT path FROM outputs ORDER BY kind, name, year, path")]
+    finally:
+        con.close()
+    entries = manifest_entries(outputdir, paths)
+    return [entries[p] for p in paths if p in entries]
@@ -10,15 +10,24 @@ from flowsa.common import datapath, sector_source_name, activity_fields, load_so
     load_sector_crosswalk, log, load_sector_length_crosswalk, load_household_sector_codes
 from flowsa.flowbyfunctions import fbs_activity_fields
 
+def activitytosector_mapping_file(source):
+    """
+    Path of the activity-to-sector mapping of a data source
+    :param source: The data source name
+    :return: str, csv file path
+    """
+    if 'EPA_NEI' in source:
+        source = 'EPA_NEI'
+    return datapath+'activitytosectormapping/'+'Crosswalk_'+source+'_toNAICS.csv'
+
+
 def get_activitytosector_mapping(source):
     """
     Gets  the activity-to-sector mapping
     :param source: The data source name
     :return: a pandas df for a standard ActivitytoSector mapping
     """
-    if 'EPA_NEI' in source:
-        source = 'EPA_NEI'
-    mapping = pd.read_csv(datapath+'activitytosectormapping/'+'Crosswalk_'+source+'_toNAICS.csv',
+    mapping = pd.read_csv(activitytosector_mapping_file(source),
                           dtype={'Activity': 'str',
                                  'Sector': 'str'})
     return mapping
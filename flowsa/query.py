@@ -0,0 +1,196 @@
+# query.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Lazy queries of stored FlowByActivity and FlowBySector data.
+A FlowQuery collects filters, column selections and group sums, and only reads data when to_pandas() is called. The
+filters and column selection are pushed into a single pyarrow dataset scan and group sums are computed on the Arrow
+tables (or with DuckDB, if installed), so the full df is never built in pandas.
+"""
+
+import pandas as pd
+import pyarrow.dataset as ds
+from flowsa.common import fbsoutputpath, log
+from flowsa.storage import fba_filter_columns, fbs_filter_columns, build_filter_expression, \
+    build_sector_expression, combine_expressions, scan_flowby_parquet, scan_flowbyactivity
+
+
+class FlowQuery:
+    """
+    Deferred query of a FlowByActivity source or FlowBySector method. Each method returns a new FlowQuery, so a
+    query can be reused as the start of several more specific queries.
+    """
+
+    def __init__(self, kind, name, years=None, expression=None, columns=None, group_columns=None,
+                 value_columns=None):
+        """
+        :param kind: str, 'FBA' or 'FBS'
+        :param name: str, FlowByActivity source name or FlowBySector method name
+        :param years: list, years of FlowByActivity data, not used for FlowBySector
+        """
+        self.kind = kind
+        self.name = name
+        self.years = years
+        self.expression = expression
+        self.columns = columns
+        self.group_columns = group_columns
+        self.value_columns = value_columns
+
+    def _replace(self, **kwargs):
+        attributes = dict(vars(self))
+        attributes.update(kwargs)
+        return FlowQuery(**attributes)
+
+    @property
+    def filter_columns(self):
+        return fba_filter_columns if self.kind == 'FBA' else fbs_filter_columns
+
+    def where(self, expression=None, **filters):
+        """
+        Only keep rows matching all conditions
+        :param expression: pyarrow dataset expression, e.g. ds.field('FlowAmount') > 0
+        :param filters: list or str of values to keep, keyed by a filter name of getFlowByActivity/getFlowBySector
+         (e.g. locations, activities, sectors, sector_prefix, sector_level) or by a column name (e.g. Unit, Year)
+        :return: FlowQuery
+        """
+        conditions = [expression] if expression is not None else []
+        if self.kind == 'FBS':
+            conditions.append(build_sector_expression(filters.pop('sector_prefix', None),
+                                                      filters.pop('sector_level', None)))
+        for k, values in filters.items():
+            if values is None:
+                continue
+            if k in self.filter_columns:
+                conditions.append(build_filter_expression(self.filter_columns, **{k: values}))
+            else:
+                if isinstance(values, (str, int, float)):
+                    values = [values]
+                conditions.append(ds.field(k).isin(list(values)))
+        query_expression = combine_expressions(self.expression, *conditions)
+        return self._replace(expression=query_expression)
+
+    def select(self, *columns):
+        """
+        Only return these columns
+        :param columns: str, column names
+        :return: FlowQuery
+        """
+        return self._replace(columns=list(columns))
+
+    def groupby(self, *columns):
+        """
+        Group rows by these columns, followed by sum()
+        :param columns: str, column names
+        :return: FlowQuery
+        """
+        return self._replace(group_columns=list(columns))
+
+    def sum(self, *value_columns):
+        """
+        Sum value columns within the groups set by groupby()
+        :param value_columns: str, columns to sum, defaults to FlowAmount
+        :return: FlowQuery
+        """
+        if self.group_columns is None:
+            raise ValueError("groupby() must be called before sum()")
+        return self._replace(value_columns=list(value_columns) or ['FlowAmount'])
+
+    def scan_columns(self):
+        """Columns read from the stored data, None reads all columns"""
+        if self.value_columns is not None:
+            return self.group_columns + self.value_columns
+        return self.columns
+
+    def scan(self):
+        """
+        Run the filtered, projected scan of the stored data
+        :return: list of pyarrow Tables
+        """
+        if self.kind == 'FBA':
+            return scan_flowbyactivity(self.name, self.years, columns=self.scan_columns(),
+                                       filter_expression=self.expression)
+        try:
+            return scan_flowby_parquet(fbsoutputpath + self.name + ".parquet", columns=self.scan_columns(),
+                                       filter_expression=self.expression)
+        except FileNotFoundError:
+            log.error("No parquet file found for datasource " + self.name + " in flowsa")
+            return []
+
+    def to_pandas(self, engine='auto'):
+        """
+        Run the query
+        :param engine: str, 'arrow' or 'duckdb' to compute group sums, 'auto' uses DuckDB if it is installed
+        :return: pandas DataFrame
+        """
+        tables = self.scan()
+        if self.value_columns is None:
+            dfs = [t.to_pandas() for t in tables]
+        else:
+            dfs = [aggregate_table(t, self.group_columns, self.value_columns, engine) for t in tables]
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=self.scan_columns())
+        df = pd.concat(dfs, ignore_index=True)
+        if self.value_columns is not None and len(dfs) > 1:
+            # tables of different years or storage layouts are summed separately
+            df = df.groupby(self.group_columns, dropna=False, as_index=False)[self.value_columns].sum()
+        if self.value_columns is not None and self.columns is not None:
+            df = df[[c for c in self.columns if c in df.columns]]
+        if self.kind == 'FBA' and 'ActivityProducedBy' in df.columns:
+            # match the dtypes returned by getFlowByActivity
+            df['ActivityProducedBy'] = df['ActivityProducedBy'].astype(str)
+        return df
+
+    def __repr__(self):
+        return "FlowQuery(" + self.kind + ", " + self.name + ", where=" + str(self.expression) + \
+               ", columns=" + str(self.scan_columns()) + ", groupby=" + str(self.group_columns) + ")"
+
+
+def duckdb_available():
+    """Check if DuckDB can be imported"""
+    try:
+        import duckdb  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def aggregate_table(table, group_columns, value_columns, engine='auto'):
+    """
+    Sum value columns of an Arrow table by group
+    :param table: pyarrow Table
+    :param group_columns: list, columns to group by
+    :param value_columns: list, columns to sum
+    :param engine: str, 'arrow', 'duckdb' or 'auto'
+    :return: pandas DataFrame of group_columns and value_columns
+    """
+    if engine == 'duckdb' or (engine == 'auto' and duckdb_available()):
+        import duckdb
+        group = ', '.join('"' + c + '"' for c in group_columns)
+        sums = ', '.join('sum("' + c + '") AS "' + c + '"' for c in value_columns)
+        con = duckdb.connect()
+        con.register('flows', table)
+        return con.execute('SELECT ' + group + ', ' + sums + ' FROM flows GROUP BY ' + group).df()
+    grouped = table.group_by(group_columns).aggregate([(c, 'sum') for c in value_columns])
+    df = grouped.to_pandas().rename(columns={c + '_sum': c for c in value_columns})
+    return df[group_columns + value_columns]
+
+
+def query_fba(datasource, years, flowclass=None):
+    """
+    Start a lazy query of stored FlowByActivity data, e.g.
+    query_fba('USGS_NWIS_WU', [2015], ['Water']).where(locations='06000').groupby('FlowName').sum().to_pandas()
+    :param datasource: str, the code of the datasource
+    :param years: list, a list of years [2015], or [2010,2011,2012]
+    :param flowclass: list, optional, the `Class' of the flows
+    :return: FlowQuery
+    """
+    return FlowQuery('FBA', datasource, years).where(flowclass=flowclass)
+
+
+def query_fbs(methodname):
+    """
+    Start a lazy query of stored FlowBySector data
+    :param methodname: string, Name of an available method
+    :return: FlowQuery
+    """
+    return FlowQuery('FBS', methodname)
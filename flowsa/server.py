@@ -0,0 +1,251 @@
+# server.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Local read-only HTTP service for stored FlowByActivity and FlowBySector data.
+One server process keeps loaded and cleaned dfs in memory, so client processes on the same machine share a warm
+copy of the data. Endpoints:
+/fba?source=&year=&class=&location=&activity=&flowname=&compartment=&column=&clean=&format=
+/fbs?method=&location=&sector=&sector_prefix=&sector_level=&flowable=&context=&column=&clean=&format=
+/stats
+Parameters can be repeated or comma separated. format is json (default) or arrow, for an Arrow IPC stream.
+"""
+
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pyarrow as pa
+import flowsa
+from flowsa.common import log
+from flowsa.cache import FrameCache, cache_stats
+from flowsa.storage import flowbyactivity_files
+
+arrow_stream_type = 'application/vnd.apache.arrow.stream'
+
+
+class QueryError(ValueError):
+    """Invalid query parameters, returned as a 400 response"""
+
+
+def query_values(query, name, required=False):
+    """
+    Values of a query parameter, repeated or comma separated
+    :param query: dict from urllib.parse.parse_qs
+    :param name: str, parameter name
+    :param required: bool, if True raise QueryError when the parameter is missing
+    :return: list of str, or None if the parameter is missing
+    """
+    values = [v for value in query.get(name, []) for v in value.split(',') if v != '']
+    if len(values) == 0:
+        if required:
+            raise QueryError("Missing query parameter: " + name)
+        return None
+    return values
+
+
+def query_flag(query, name):
+    """True if a query parameter is set to 1, true or yes"""
+    return (query_values(query, name) or ['0'])[0].lower() in ('1', 'true', 'yes')
+
+
+def load_fba(query, clean=False):
+    """
+    FlowByActivity df of a /fba query
+    :param query: dict from urllib.parse.parse_qs
+    :param clean: bool, if True return the df cleaned with clean_df
+    :return: df
+    """
+    return flowsa.getFlowByActivity(query_values(query, 'class'), query_values(query, 'year', required=True),
+                                    query_values(query, 'source', required=True)[0],
+                                    columns=query_values(query, 'column'),
+                                    locations=query_values(query, 'location'),
+                                    activities=query_values(query, 'activity'),
+                                    flownames=query_values(query, 'flowname'),
+                                    compartments=query_values(query, 'compartment'), clean=clean)
+
+
+def fba_files(query):
+    """
+    Files a /fba query is loaded from
+    :param query: dict from urllib.parse.parse_qs
+    :return: list of file paths
+    """
+    source = query_values(query, 'source', required=True)[0]
+    years = query_values(query, 'year', required=True)
+    if flowsa.database_files('FBA', source, years):
+        return [flowsa.database.database_path]
+    return flowbyactivity_files(source, years)
+
+
+def load_fbs(query, clean=False):
+    """
+    FlowBySector df of a /fbs query
+    :param query: dict from urllib.parse.parse_qs
+    :param clean: bool, if True return the df cleaned with clean_df
+    :return: df
+    """
+    sector_level = query_values(query, 'sector_level')
+    if sector_level is not None:
+        try:
+            sector_level = int(sector_level[0])
+        except ValueError:
+            raise QueryError("sector_level is not a number: " + sector_level[0])
+    return flowsa.getFlowBySector(query_values(query, 'method', required=True)[0],
+                                  columns=query_values(query, 'column'),
+                                  locations=query_values(query, 'location'),
+                                  sectors=query_values(query, 'sector'),
+                                  flowables=query_values(query, 'flowable'),
+                                  contexts=query_values(query, 'context'),
+                                  sector_prefix=query_values(query, 'sector_prefix'),
+                                  sector_level=sector_level, clean=clean)
+
+
+def fbs_files(query):
+    """
+    Files a /fbs query is loaded from
+    :param query: dict from urllib.parse.parse_qs
+    :return: list of file paths
+    """
+    method = query_values(query, 'method', required=True)[0]
+    if flowsa.database_files('FBS', method):
+        return [flowsa.database.database_path]
+    return [flowsa.fbsoutputpath + method + '.parquet']
+
+
+# loaders and loaded files of each data endpoint
+endpoints = {'/fba': (load_fba, fba_files),
+             '/fbs': (load_fbs, fbs_files)}
+
+
+class FlowsaServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the cleaned df cache and request counters"""
+
+    daemon_threads = True
+
+    def __init__(self, server_address, cache_bytes=None):
+        super().__init__(server_address, FlowsaRequestHandler)
+        self.clean_cache = FrameCache() if cache_bytes is None else FrameCache(cache_bytes)
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def count_request(self, path, seconds, error=False):
+        """Add a request to the latency counters of an endpoint"""
+        with self.lock:
+            c = self.counters.setdefault(path, {'requests': 0, 'errors': 0, 'total_seconds': 0.0,
+                                                'max_seconds': 0.0})
+            c['requests'] += 1
+            c['errors'] += int(error)
+            c['total_seconds'] += seconds
+            c['max_seconds'] = max(c['max_seconds'], seconds)
+
+    def stats(self):
+        """Cache and request counters"""
+        with self.lock:
+            requests = {k: dict(v, mean_seconds=v['total_seconds'] / v['requests'])
+                        for k, v in self.counters.items()}
+        return {'cache': cache_stats(), 'clean_cache': self.clean_cache.stats(), 'requests': requests}
+
+    def query(self, path, query):
+        """
+        Run a data query, cleaning the df with clean_df if requested. Cleaned dfs are cached until the files they
+        are loaded from change.
+        :param path: str, '/fba' or '/fbs'
+        :param query: dict from urllib.parse.parse_qs
+        :return: df
+        """
+        loader, files_of = endpoints[path]
+        if not query_flag(query, 'clean'):
+            return loader(query)
+        key = (path, tuple(sorted((k, tuple(v)) for k, v in query.items() if k != 'format')))
+        files = files_of(query)
+        cleaned = self.clean_cache.get(key, files)
+        if cleaned is None:
+            cleaned = loader(query, clean=True)
+            self.clean_cache.put(key, files, cleaned)
+        return cleaned
+
+
+class FlowsaRequestHandler(BaseHTTPRequestHandler):
+    """Answers /fba, /fbs and /stats requests"""
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            if url.path == '/stats':
+                response = json_response(200, self.server.stats())
+            elif url.path in endpoints:
+                df = self.server.query(url.path, query)
+                if (query_values(query, 'format') or ['json'])[0] == 'arrow':
+                    response = (200, arrow_stream_type, arrow_stream(df))
+                else:
+                    response = (200, 'application/json', df.to_json(orient='records').encode())
+            else:
+                response = json_response(404, {'error': 'Unknown path ' + url.path})
+        except QueryError as e:
+            response = json_response(400, {'error': str(e)})
+        except Exception as e:
+            log.exception("Failed to answer " + self.path)
+            response = json_response(500, {'error': str(e)})
+        # count the request before answering, so clients see it in /stats once they have the response
+        if url.path in endpoints or url.path == '/stats':
+            self.server.count_request(url.path, time.perf_counter() - start, response[0] != 200)
+        self.send_body(*response)
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("flowsa server: " + format % args)
+
+
+def json_response(status, obj):
+    """Status, content type and body of a JSON response"""
+    return status, 'application/json', json.dumps(obj).encode()
+
+
+def arrow_stream(df):
+    """Arrow IPC stream of a df"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def make_server(host='127.0.0.1', port=8080, cache_bytes=None):
+    """
+    Create the query server, call serve_forever() to start answering requests
+    :param host: str, address to listen on
+    :param port: int, port to listen on, 0 picks a free port
+    :param cache_bytes: int, byte budget of each of the loaded and cleaned df caches, defaults to the cache default
+    :return: FlowsaServer
+    """
+    if cache_bytes is not None:
+        flowsa.set_cache_size(cache_bytes)
+    return FlowsaServer((host, port), cache_bytes)
+
+
+def serve(host='127.0.0.1', port=8080, cache_bytes=None):
+    """
+    Run the query server until interrupted
+    :param host: str, address to listen on
+    :param port: int, port to listen on
+    :param cache_bytes: int, byte budget of each of the loaded and cleaned df caches
+    :return: None
+    """
+    server = make_server(host, port, cache_bytes)
+    log.info("Serving flowsa data on http://" + host + ":" + str(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
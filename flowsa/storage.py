@@ -0,0 +1,972 @@
+# storage.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Functions for reading stored FlowByActivity and FlowBySector parquet files.
+Filters and column selections are pushed down to pyarrow so row groups that cannot match are never decoded.
+FlowByActivity data can be stored as flat <source>_<year>.parquet files, in a hive partitioned layout,
+fbaoutputpath/source=<source>/year=<year>/Class=<class>/, or in the vintage store, fbaoutputpath/<source>_vintages/,
+where all years of a source share one dictionary per string column and files hold integer codes. Each layout is
+read with a single scan.
+Flat parquet files can have an uncompressed Arrow IPC sidecar, <name>.arrow, that is memory-mapped instead of
+decoding the parquet file.
+Written files carry an order-independent content fingerprint and the hashes of the configuration files they were
+built from in their parquet key-value metadata, read from the footer with fingerprint() and read_provenance().
+"""
+
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+from flowsa.common import fbaoutputpath, log, flow_by_activity_fields
+
+# columns checked by each optional filter, a row is kept if any of the listed columns match a filter value
+fba_filter_columns = {'flowclass': ['Class'],
+                      'locations': ['Location'],
+                      'activities': ['ActivityProducedBy', 'ActivityConsumedBy'],
+                      'flownames': ['FlowName'],
+                      'compartments': ['Compartment']}
+
+fbs_filter_columns = {'locations': ['Location'],
+                      'sectors': ['SectorProducedBy', 'SectorConsumedBy'],
+                      'flowables': ['Flowable'],
+                      'contexts': ['Context']}
+
+# sort order of stored files, so row group and page statistics bound the values most queries filter on. Sectors
+# lead for FlowBySector files, so the rows of a sector prefix are in a contiguous run of row groups.
+fba_sort_columns = ['Class', 'Location', 'ActivityProducedBy', 'ActivityConsumedBy']
+fbs_sort_columns = ['SectorProducedBy', 'SectorConsumedBy', 'Location']
+
+# parquet writer profile of stored files: row groups small enough for statistics to skip most of a file on a
+# filtered read, dictionary encoded string columns, page indexes and zstd compression
+parquet_writer_profile = {'row_group_size': 64 * 1024,
+                          'compression': 'zstd',
+                          'compression_level': 3,
+                          'use_dictionary': True,
+                          'write_statistics': True,
+                          'write_page_index': True}
+# FlowBySector files are smaller, so use smaller row groups for sector ranges to skip
+fbs_row_group_size = 8 * 1024
+
+# partition keys below fbaoutputpath/source=<source>/ in the partitioned FlowByActivity store
+fba_partitioning = ds.partitioning(pa.schema([('year', pa.string()), ('Class', pa.string())]), flavor='hive')
+
+# partition key below fbaoutputpath/<source>_vintages/ in the vintage store
+vintage_partitioning = ds.partitioning(pa.schema([('year', pa.string())]), flavor='hive')
+# columns stored as codes into the shared dictionaries of the vintage store
+vintage_columns = [k for k, v in flow_by_activity_fields.items() if v[0]['dtype'] == 'str']
+# the dictionary file starts with '_', so dataset discovery of the year files skips it
+vintage_dictionary_name = '_dictionary.parquet'
+# held while the shared dictionaries are read, extended and written
+vintage_lock_name = '_dictionary.lock'
+
+# bytes a string value takes in a loaded df, the python str object and the pointer to it, used to estimate the
+# memory of files before loading them
+string_value_bytes = 64
+
+
+def build_filter_expression(filter_columns, **filters):
+    """
+    Create a pyarrow dataset expression from lists of values to keep
+    :param filter_columns: fba_filter_columns or fbs_filter_columns
+    :param filters: list or str of values to keep, keyed by the names in filter_columns. None is ignored.
+    :return: a pyarrow expression, or None if no filters are set
+    """
+    expression = None
+    for k, values in filters.items():
+        if values is None:
+            continue
+        if isinstance(values, str):
+            values = [values]
+        values = [str(v) for v in values]
+        # a row matches the filter if any of the filter columns contain one of the values
+        condition = None
+        for c in filter_columns[k]:
+            column_condition = ds.field(c).isin(values)
+            condition = column_condition if condition is None else condition | column_condition
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def sector_prefix_upper_bound(prefix):
+    """
+    Smallest string greater than every string starting with prefix, e.g. '32' for '31'
+    :param prefix: str, sector code prefix
+    :return: str, or None if there is no upper bound
+    """
+    if len(prefix) == 0:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def build_sector_expression(sector_prefix=None, sector_level=None,
+                            sector_columns=('SectorProducedBy', 'SectorConsumedBy')):
+    """
+    Create a pyarrow dataset expression keeping flows where a sector column starts with one of the prefixes and has
+    the requested number of digits. Prefixes are expressed as ranges, e.g. '31' as >= '31' and < '32', so row group
+    statistics of sorted files can skip the row groups outside the ranges.
+    :param sector_prefix: str or list, sector code prefixes, e.g. ['31', '32', '33']
+    :param sector_level: int, sector code length, e.g. 3
+    :param sector_columns: columns checked, a row is kept if any of the columns match
+    :return: a pyarrow expression, or None if neither is set
+    """
+    if sector_prefix is None and sector_level is None:
+        return None
+    if isinstance(sector_prefix, str):
+        sector_prefix = [sector_prefix]
+    expression = None
+    for c in sector_columns:
+        condition = None
+        for p in sector_prefix or []:
+            p = str(p)
+            prefix_condition = ds.field(c) >= p
+            upper = sector_prefix_upper_bound(p)
+            if upper is not None:
+                prefix_condition = prefix_condition & (ds.field(c) < upper)
+            condition = prefix_condition if condition is None else condition | prefix_condition
+        if sector_level is not None:
+            # missing sectors are stored as the string 'None', which has the length of a 4 digit sector
+            level_condition = (pc.utf8_length(ds.field(c)) == int(sector_level)) & (ds.field(c) != 'None')
+            condition = level_condition if condition is None else condition & level_condition
+        expression = condition if expression is None else expression | condition
+    return expression
+
+
+def combine_expressions(*expressions):
+    """
+    Combine pyarrow expressions with 'and', ignoring None
+    :param expressions: pyarrow expressions or None
+    :return: a pyarrow expression, or None if all are None
+    """
+    combined = None
+    for e in expressions:
+        if e is not None:
+            combined = e if combined is None else combined & e
+    return combined
+
+
+def parquet_format(dictionary_columns=None):
+    """
+    Parquet format used to scan flowby datasets
+    :param dictionary_columns: list, string columns to read as Arrow dictionaries, returned as pandas categoricals
+    :return: pyarrow ParquetFileFormat
+    """
+    if dictionary_columns:
+        return ds.ParquetFileFormat(read_options=ds.ParquetReadOptions(dictionary_columns=dictionary_columns))
+    return ds.ParquetFileFormat()
+
+
+def ipc_sidecar_path(parquet_path):
+    """Path of the Arrow IPC sidecar of a parquet file"""
+    return os.path.splitext(parquet_path)[0] + '.arrow'
+
+
+def file_content_hash(path):
+    """
+    sha256 hash of the content of a file
+    :param path: str, file path
+    :return: str, hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# hash of null values in content fingerprints
+null_hash = np.uint64(0x9e3779b97f4a7c15)
+
+
+def column_hashes(column):
+    """
+    uint64 hash of each value of an Arrow column. String columns are dictionary encoded so each distinct value is
+    hashed once, and nulls hash to a fixed value.
+    :param column: pyarrow Array or ChunkedArray
+    :return: numpy uint64 array
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if len(column) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        column = column.dictionary_encode()
+    if pa.types.is_dictionary(column.type):
+        # dictionary values are distinct, so skip pandas' factorizing of object arrays
+        dictionary_hashes = pd.util.hash_array(column.dictionary.to_numpy(zero_copy_only=False).astype(object),
+                                               categorize=False)
+        if len(dictionary_hashes) == 0:
+            dictionary_hashes = np.zeros(1, dtype=np.uint64)
+        hashes = dictionary_hashes[column.indices.fill_null(0).to_numpy(zero_copy_only=False)]
+    else:
+        hashes = pd.util.hash_array(column.to_numpy(zero_copy_only=False))
+    if column.null_count > 0:
+        hashes = np.where(column.is_null().to_numpy(zero_copy_only=False), null_hash, hashes)
+    return hashes.astype(np.uint64)
+
+
+def content_fingerprint(table):
+    """
+    Order-independent fingerprint of the content of a flowby table. Column hashes are combined into a hash per row
+    and the row hashes are summed, so the same rows in any order, with the columns in any order, give the same
+    fingerprint.
+    :param table: pyarrow Table
+    :return: str, hex digest
+    """
+    columns = sorted(c for c in table.column_names if not c.startswith('__index_level_'))
+    with np.errstate(over='ignore'):
+        total = np.sum(row_hashes(table, columns), dtype=np.uint64)
+    return format(int(total), '016x') + format(table.num_rows, 'x')
+
+
+def row_hashes(table, columns):
+    """
+    64-bit hash of the values of each row of a table in a set of columns, e.g. to join flows on their key columns
+    :param table: pyarrow Table or RecordBatch
+    :param columns: list, columns to hash, in order
+    :return: numpy uint64 array
+    """
+    hashes = np.zeros(table.num_rows, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for c in columns:
+            name_hash = pd.util.hash_array(np.array([c], dtype=object))[0]
+            # rotate the running row hash so swapped values between columns change the hash
+            hashes = ((hashes << np.uint64(7)) | (hashes >> np.uint64(57))) ^ (column_hashes(table[c]) + name_hash)
+    return pd.util.hash_array(hashes)
+
+
+def file_provenance(paths):
+    """
+    sha256 hashes of the configuration and crosswalk files a flowby file is built from
+    :param paths: list, file paths, missing files are left out
+    :return: dict of file name: hex digest
+    """
+    return {os.path.basename(p): file_content_hash(p) for p in paths if os.path.isfile(p)}
+
+
+def fingerprint(path):
+    """
+    Content fingerprint of a stored flowby parquet file, read from the file footer
+    :param path: str, parquet file path
+    :return: str, or None if the file was written without a fingerprint
+    """
+    metadata = pq.read_schema(path).metadata or {}
+    value = metadata.get(b'flowsa.fingerprint')
+    return None if value is None else value.decode()
+
+
+def read_provenance(path):
+    """
+    Hashes of the configuration and crosswalk files a stored flowby parquet file was built from
+    :param path: str, parquet file path
+    :return: dict of file name: hex digest, empty if none were recorded
+    """
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata.get(b'flowsa.provenance', b'{}'))
+
+
+def estimated_frame_bytes(paths):
+    """
+    Estimate the memory the stored flowby parquet files take once loaded into a df, from the row counts and column
+    types in the file footers. Compressed file sizes are far smaller than the loaded dfs, whose string columns hold
+    a python object per value.
+    :param paths: list, parquet file paths
+    :return: int, bytes
+    """
+    nbytes = 0
+    for p in paths:
+        # the shared dictionaries of the vintage store are decoded into the year files' columns
+        if os.path.basename(p) == vintage_dictionary_name:
+            continue
+        metadata = pq.read_metadata(p)
+        schema = metadata.schema.to_arrow_schema()
+        row_bytes = 0
+        for f in schema:
+            is_string = pa.types.is_string(f.type) or pa.types.is_large_string(f.type) or \
+                pa.types.is_dictionary(f.type) or (is_vintage_file(p) and f.name in vintage_columns)
+            row_bytes = row_bytes + (string_value_bytes if is_string else 8)
+        nbytes = nbytes + metadata.num_rows * row_bytes
+    return nbytes
+
+
+def stored_clean_stamp(paths):
+    """
+    Clean stamp shared by stored flowby parquet files, read from the file footers
+    :param paths: list, parquet file paths
+    :return: str, or None if there are no files, a file is missing, or any file is not stamped with the same value
+    """
+    # the shared dictionaries of the vintage store hold no flowby data, so they are not stamped
+    paths = [p for p in paths if os.path.basename(p) != vintage_dictionary_name]
+    if not all(os.path.isfile(p) for p in paths):
+        return None
+    stamps = set((pq.read_schema(p).metadata or {}).get(b'flowsa.clean') for p in paths)
+    if len(stamps) != 1 or None in stamps:
+        return None
+    return stamps.pop().decode()
+
+
+def write_ipc_sidecar(parquet_path):
+    """
+    Write an uncompressed Arrow IPC copy of a parquet file, recording the parquet content hash so the copy can be
+    validated when read
+    :param parquet_path: str, parquet file path
+    :return: None
+    """
+    stat = os.stat(parquet_path)
+    table = pq.read_table(parquet_path)
+    metadata = dict(table.schema.metadata or {})
+    metadata.update({b'flowsa.parquet_sha256': file_content_hash(parquet_path).encode(),
+                     b'flowsa.parquet_size': str(stat.st_size).encode(),
+                     b'flowsa.parquet_mtime_ns': str(stat.st_mtime_ns).encode()})
+    table = table.replace_schema_metadata(metadata)
+    # write to a temporary file first so readers never map a partially written sidecar, under a unique name so
+    # concurrent rebuilds of the same sidecar do not write to the same file
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(parquet_path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(parquet_path)))
+    os.close(fd)
+    try:
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, ipc_sidecar_path(parquet_path))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_ipc_sidecar(parquet_path):
+    """
+    Memory-map the Arrow IPC sidecar of a parquet file, if one exists. A sidecar that no longer matches the parquet
+    content is rebuilt, or ignored if it cannot be rewritten, such as in a read-only directory.
+    :param parquet_path: str, parquet file path
+    :return: pyarrow Table, or None if there is no sidecar, no parquet file or the sidecar is out of date and cannot
+     be rebuilt
+    """
+    sidecar_path = ipc_sidecar_path(parquet_path)
+    if not (os.path.isfile(sidecar_path) and os.path.isfile(parquet_path)):
+        return None
+    table = pa.ipc.open_file(pa.memory_map(sidecar_path, 'r')).read_all()
+    metadata = table.schema.metadata or {}
+    stat = os.stat(parquet_path)
+    # an unchanged size and modification time is trusted, otherwise compare the content fingerprint in the parquet
+    # footer, or the hash of the whole file if it was written without one
+    if (metadata.get(b'flowsa.parquet_size') != str(stat.st_size).encode() or
+            metadata.get(b'flowsa.parquet_mtime_ns') != str(stat.st_mtime_ns).encode()):
+        parquet_fingerprint = fingerprint(parquet_path)
+        if parquet_fingerprint is not None and \
+                metadata.get(b'flowsa.fingerprint') == parquet_fingerprint.encode():
+            return table
+        if parquet_fingerprint is not None or \
+                metadata.get(b'flowsa.parquet_sha256') != file_content_hash(parquet_path).encode():
+            log.info('Rebuilding out of date Arrow sidecar for ' + parquet_path)
+        try:
+            write_ipc_sidecar(parquet_path)
+        except OSError as e:
+            log.warning('Unable to rebuild Arrow sidecar for ' + parquet_path + ', reading the parquet file: ' +
+                        str(e))
+            return None
+        table = pa.ipc.open_file(pa.memory_map(sidecar_path, 'r')).read_all()
+    return table
+
+
+def encode_dictionary_columns(table, dictionary_columns=None):
+    """
+    Dictionary encode string columns that were not read as Arrow dictionaries, such as partition values and
+    columns of IPC sidecars
+    :param table: pyarrow Table
+    :param dictionary_columns: list, string columns to return as Arrow dictionaries
+    :return: pyarrow Table
+    """
+    for c in dictionary_columns or []:
+        if c in table.column_names and not pa.types.is_dictionary(table.schema.field(c).type):
+            table = table.set_column(table.column_names.index(c), c, table[c].dictionary_encode())
+    return table
+
+
+def decode_dictionary_columns(table):
+    """
+    Cast Arrow dictionary columns to their value type
+    :param table: pyarrow Table
+    :return: pyarrow Table
+    """
+    if any(pa.types.is_dictionary(f.type) for f in table.schema):
+        schema = pa.schema([pa.field(f.name, f.type.value_type) if pa.types.is_dictionary(f.type) else f
+                            for f in table.schema], metadata=table.schema.metadata)
+        table = table.cast(schema)
+    return table
+
+
+def scanner_options(columns=None, filter_expression=None, batch_rows=None):
+    """Keyword arguments of pyarrow Dataset.scanner"""
+    options = {'columns': columns, 'filter': filter_expression}
+    if batch_rows is not None:
+        options['batch_size'] = batch_rows
+    return options
+
+
+def flowby_parquet_scanners(paths, columns=None, filter_expression=None, dictionary_columns=None,
+                            batch_rows=None):
+    """
+    Scanners of one or more flowby parquet files, files with an Arrow IPC sidecar are memory-mapped instead
+    :param paths: str or list, parquet file path(s)
+    :param columns: list, columns to return, None returns all columns
+    :param filter_expression: pyarrow expression from build_filter_expression, None returns all rows
+    :param dictionary_columns: list, string columns to read as Arrow dictionaries
+    :param batch_rows: int, maximum rows per record batch
+    :return: list of pyarrow dataset Scanners
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    options = scanner_options(columns, filter_expression, batch_rows)
+    scanners = []
+    parquet_paths = []
+    for p in paths:
+        sidecar = read_ipc_sidecar(p)
+        if sidecar is None:
+            parquet_paths.append(p)
+        else:
+            scanners.append(ds.dataset(sidecar).scanner(**options))
+    if len(parquet_paths) > 0:
+        dataset = ds.dataset(parquet_paths, format=parquet_format(dictionary_columns))
+        scanners.append(dataset.scanner(**options))
+    return scanners
+
+
+def scan_flowby_parquet(paths, columns=None, filter_expression=None, dictionary_columns=None):
+    """
+    Scan one or more flowby parquet files into Arrow tables, only decoding the columns and row groups required.
+    Files with an Arrow IPC sidecar are memory-mapped instead.
+    :param paths: str or list, parquet file path(s)
+    :param columns: list, columns to return, None returns all columns
+    :param filter_expression: pyarrow expression from build_filter_expression, None returns all rows
+    :param dictionary_columns: list, string columns to return as Arrow dictionaries
+    :return: list of pyarrow Tables
+    """
+    return [encode_dictionary_columns(s.to_table(), dictionary_columns)
+            for s in flowby_parquet_scanners(paths, columns, filter_expression, dictionary_columns)]
+
+
+def read_flowby_parquet(paths, columns=None, filter_expression=None, dictionary_columns=None):
+    """
+    Read one or more flowby parquet files, only decoding the columns and row groups required. Files with an Arrow
+    IPC sidecar are memory-mapped instead.
+    :param paths: str or list, parquet file path(s)
+    :param columns: list, columns to return, None returns all columns
+    :param filter_expression: pyarrow expression from build_filter_expression, None returns all rows
+    :param dictionary_columns: list, string columns to return as pandas categoricals
+    :return: pandas DataFrame
+    """
+    tables = scan_flowby_parquet(paths, columns, filter_expression, dictionary_columns)
+    if len(tables) == 1:
+        return tables[0].to_pandas()
+    return concat_flowby_dfs([t.to_pandas() for t in tables], dictionary_columns)
+
+
+def concat_flowby_dfs(dfs, dictionary_columns=None):
+    """
+    Concat dfs read from different files or layouts
+    :param dfs: list of dfs
+    :param dictionary_columns: list, string columns to return as pandas categoricals
+    :return: df, empty if dfs is empty
+    """
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    df = pd.concat(dfs, ignore_index=True, sort=False)
+    if dictionary_columns and len(dfs) > 1:
+        # categoricals with differing categories are concatenated as strings
+        for c in dictionary_columns:
+            if c in df.columns and not pd.api.types.is_categorical_dtype(df[c]):
+                df[c] = df[c].astype('category')
+    return df
+
+
+def flowby_table(df, preserve_index=None):
+    """
+    Convert a flowby df to an Arrow table for writing. Categorical columns are stored with their string type,
+    parquet dictionary encodes them on disk, so files read the same whether or not the df was categorical.
+    :param df: flowbyactivity or flowbysector df
+    :param preserve_index: passed to pyarrow.Table.from_pandas
+    :return: pyarrow Table
+    """
+    return decode_dictionary_columns(pa.Table.from_pandas(df, preserve_index=preserve_index))
+
+
+def sort_flowby_table(table, sort_columns):
+    """
+    Sort a flowby table by the sort columns it contains
+    :param table: pyarrow Table
+    :param sort_columns: list, fba_sort_columns or fbs_sort_columns
+    :return: pyarrow Table, tuple of pyarrow.parquet.SortingColumn describing the order
+    """
+    sort_keys = [(c, 'ascending') for c in sort_columns or [] if c in table.column_names]
+    if len(sort_keys) == 0:
+        return table, None
+    table = table.sort_by(sort_keys)
+    return table, pq.SortingColumn.from_ordering(table.schema, sort_keys)
+
+
+def write_flowby_table(table, path, sort_columns=None, row_group_size=None, provenance=None, clean_stamp=None):
+    """
+    Write a flowby table to a parquet file with the writer profile, recording its content fingerprint and
+    provenance in the file metadata
+    :param table: pyarrow Table from flowby_table
+    :param path: str, parquet file path
+    :param sort_columns: list, columns to sort rows by before writing
+    :param row_group_size: int, rows per row group, defaults to the writer profile
+    :param provenance: dict, hashes of the files the data is built from, from file_provenance
+    :param clean_stamp: str, flowbyfunctions.clean_stamp if the data is already clean, None if not
+    :return: None
+    """
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'flowsa.fingerprint'] = content_fingerprint(table).encode()
+    metadata[b'flowsa.provenance'] = json.dumps(provenance or {}, sort_keys=True).encode()
+    if clean_stamp is not None:
+        metadata[b'flowsa.clean'] = clean_stamp.encode()
+    table = table.replace_schema_metadata(metadata)
+    table, sorting_columns = sort_flowby_table(table, sort_columns)
+    profile = dict(parquet_writer_profile)
+    if row_group_size is not None:
+        profile['row_group_size'] = row_group_size
+    pq.write_table(table, path, sorting_columns=sorting_columns, **profile)
+
+
+def write_flowby_parquet(df, path, sort_columns=None, row_group_size=None, provenance=None, clean_stamp=None):
+    """
+    Write a flowbyactivity or flowbysector df to a parquet file
+    :param df: flowbyactivity or flowbysector df
+    :param path: str, parquet file path
+    :param sort_columns: list, fba_sort_columns or fbs_sort_columns
+    :param row_group_size: int, rows per row group, defaults to the writer profile
+    :param provenance: dict, hashes of the files the data is built from, from file_provenance
+    :param clean_stamp: str, flowbyfunctions.clean_stamp if the data is already clean, None if not
+    :return: None
+    """
+    write_flowby_table(flowby_table(df), path, sort_columns, row_group_size, provenance, clean_stamp)
+
+
+def partitioned_fba_path(source, year=None):
+    """
+    Directory of a source, or a source and year, in the partitioned FlowByActivity store
+    :param source: str, FlowByActivity source name
+    :param year: optional, year of data
+    :return: str, directory path
+    """
+    path = fbaoutputpath + 'source=' + source + '/'
+    if year is not None:
+        path = path + 'year=' + str(year) + '/'
+    return path
+
+
+def write_partitioned_flowbyactivity(df, source, year, provenance=None, clean_stamp=None):
+    """
+    Write a FlowByActivity df to the partitioned store, one file per Class. Existing data for the source and year
+    is replaced.
+    :param df: FlowByActivity df
+    :param source: str, FlowByActivity source name
+    :param year: year of data
+    :param provenance: dict, hashes of the files the data is built from, from file_provenance
+    :param clean_stamp: str, flowbyfunctions.clean_stamp if the data is already clean, None if not
+    :return: list of (file path, Class) written
+    """
+    if year is None:
+        # the path of a source without a year is the whole source, which would be replaced
+        raise ValueError("A year is required to store " + source + " in the partitioned store")
+    year_path = partitioned_fba_path(source, year)
+    if os.path.isdir(year_path):
+        shutil.rmtree(year_path)
+    table = flowby_table(df, preserve_index=False)
+    written = []
+    for c in pd.unique(df['Class']):
+        # the class is stored in the directory name, so drop it from the file
+        class_table = table.filter(pc.equal(table['Class'], c)).drop(['Class'])
+        class_path = year_path + 'Class=' + str(c) + '/'
+        os.makedirs(class_path)
+        class_file = class_path + source + '_' + str(year) + '.parquet'
+        write_flowby_table(class_table, class_file, fba_sort_columns, provenance=provenance, clean_stamp=clean_stamp)
+        written.append((class_file, str(c)))
+    return written
+
+
+def remove_flowbyactivity_copies(source, year):
+    """
+    Delete the flat file, with its Arrow IPC sidecar, and the partitioned store directory of a source and year
+    :param source: str, FlowByActivity source name
+    :param year: year of data
+    :return: list of paths deleted
+    """
+    removed = []
+    flat_file = fbaoutputpath + source + '_' + str(year) + '.parquet'
+    for f in (flat_file, ipc_sidecar_path(flat_file)):
+        if os.path.isfile(f):
+            os.remove(f)
+            removed.append(f)
+    year_path = partitioned_fba_path(source, year)
+    if os.path.isdir(year_path):
+        shutil.rmtree(year_path)
+        removed.append(year_path)
+    return removed
+
+
+def vintage_fba_path(source, year=None):
+    """
+    Directory of a source, or a source and year, in the vintage store
+    :param source: str, FlowByActivity source name
+    :param year: optional, year of data
+    :return: str, directory path
+    """
+    path = fbaoutputpath + source + '_vintages/'
+    if year is not None:
+        path = path + 'year=' + str(year) + '/'
+    return path
+
+
+def vintage_dictionary_file(path):
+    """
+    Shared dictionary file of a file in the vintage store
+    :param path: str, parquet file path below vintage_fba_path(source, year)
+    :return: str, file path
+    """
+    return os.path.join(os.path.dirname(os.path.dirname(path)), vintage_dictionary_name)
+
+
+def is_vintage_file(path):
+    """True if a parquet file is in the vintage store, so its string columns hold dictionary codes"""
+    return os.path.basename(os.path.dirname(os.path.dirname(path))).endswith('_vintages') and \
+        os.path.isfile(vintage_dictionary_file(path))
+
+
+def read_vintage_dictionaries(path):
+    """
+    Read the shared dictionaries of the vintage store
+    :param path: str, dictionary file path
+    :return: dict of column: pyarrow string Array, a value's position is its code
+    """
+    if not os.path.isfile(path):
+        return {}
+    table = pq.read_table(path)
+    return {c: table.filter(pc.equal(table['column'], c))['value'].combine_chunks()
+            for c in pc.unique(table['column']).to_pylist()}
+
+
+def write_vintage_dictionaries(path, dictionaries):
+    """
+    Replace the shared dictionaries of the vintage store, so readers never see a partly written file. Writers
+    hold vintage_dictionary_lock while reading and replacing the dictionaries.
+    :param path: str, dictionary file path
+    :param dictionaries: dict of column: pyarrow string Array
+    :return: None
+    """
+    columns = sorted(dictionaries)
+    table = pa.table({'column': pa.array([c for c in columns for _ in range(len(dictionaries[c]))], pa.string()),
+                      'value': pa.concat_arrays([dictionaries[c] for c in columns]) if columns
+                      else pa.array([], pa.string())})
+    # the temporary name starts with '_', so dataset scans of the store skip it
+    fd, tmp_path = tempfile.mkstemp(prefix='_dictionary.', suffix='.tmp', dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def vintage_dictionary_lock(source):
+    """
+    Hold an exclusive lock on the shared dictionaries of a source in the vintage store, so concurrent writers of
+    different years do not drop each other's new values
+    :param source: str, FlowByActivity source name
+    """
+    os.makedirs(vintage_fba_path(source), exist_ok=True)
+    with open(vintage_fba_path(source) + vintage_lock_name, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def encode_vintage_table(table, dictionaries):
+    """
+    Replace the string columns of a FlowByActivity table with int32 codes into the shared dictionaries. Values not
+    in a dictionary are appended to it, so codes already stored for other years keep their meaning.
+    :param table: pyarrow Table from flowby_table
+    :param dictionaries: dict of column: pyarrow string Array, from read_vintage_dictionaries
+    :return: pyarrow Table, dict of column: pyarrow string Array with the new values added
+    """
+    dictionaries = dict(dictionaries)
+    for c in vintage_columns:
+        if c not in table.column_names:
+            continue
+        values = table[c].cast(pa.string())
+        dictionary = dictionaries.get(c, pa.array([], pa.string()))
+        distinct = pc.unique(values.combine_chunks()).drop_null()
+        new_values = distinct.filter(pc.invert(pc.is_in(distinct, value_set=dictionary)))
+        if len(new_values) > 0:
+            dictionary = pa.concat_arrays([dictionary, new_values])
+        dictionaries[c] = dictionary
+        codes = pc.index_in(values, value_set=dictionary).cast(pa.int32())
+        table = table.set_column(table.column_names.index(c), c, codes)
+    return table, dictionaries
+
+
+def decode_vintage_table(table, dictionaries, dictionary_columns=None):
+    """
+    Replace the codes of a table read from the vintage store with their values
+    :param table: pyarrow Table or RecordBatch
+    :param dictionaries: dict of column: pyarrow string Array, from read_vintage_dictionaries
+    :param dictionary_columns: list, columns returned as Arrow dictionaries over the shared dictionary, so all
+     years have the same categories. Other columns are returned as strings.
+    :return: pyarrow Table or RecordBatch
+    """
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if name in dictionaries and pa.types.is_integer(column.type):
+            if name in (dictionary_columns or []):
+                column = decode_codes(column, dictionaries[name])
+            else:
+                column = pc.take(dictionaries[name], column)
+        columns.append(column)
+    return type(table).from_arrays(columns, names=table.column_names)
+
+
+def decode_codes(codes, dictionary):
+    """Arrow dictionary array, or chunked array, of codes into a dictionary"""
+    if isinstance(codes, pa.ChunkedArray):
+        return pa.chunked_array([pa.DictionaryArray.from_arrays(c, dictionary) for c in codes.chunks],
+                                pa.dictionary(pa.int32(), pa.string()))
+    return pa.DictionaryArray.from_arrays(codes, dictionary)
+
+
+def read_vintage_file(path, columns=None, batch_rows=None):
+    """
+    Read a parquet file of the vintage store with its string columns decoded
+    :param path: str, parquet file path
+    :param columns: list, columns to return, None returns all columns
+    :param batch_rows: int, if set return a generator of record batches of up to batch_rows rows
+    :return: pyarrow Table, or generator of pyarrow RecordBatches
+    """
+    dictionaries = read_vintage_dictionaries(vintage_dictionary_file(path))
+    parquet = pq.ParquetFile(path)
+    if batch_rows is None:
+        return decode_vintage_table(parquet.read(columns=columns), dictionaries)
+    return (decode_vintage_table(b, dictionaries) for b in parquet.iter_batches(batch_size=batch_rows,
+                                                                                 columns=columns))
+
+
+def write_vintage_flowbyactivity(df, source, year, provenance=None, clean_stamp=None):
+    """
+    Write a FlowByActivity df to the vintage store, as codes into the dictionaries shared by all years of the
+    source. Existing data for the source and year is replaced.
+    :param df: FlowByActivity df
+    :param source: str, FlowByActivity source name
+    :param year: year of data
+    :param provenance: dict, hashes of the files the data is built from, from file_provenance
+    :param clean_stamp: str, flowbyfunctions.clean_stamp if the data is already clean, None if not
+    :return: list of (file path, None) written
+    """
+    if year is None:
+        # the path of a source without a year holds all years and the dictionaries, which would be replaced
+        raise ValueError("A year is required to store " + source + " in the vintage store")
+    year_path = vintage_fba_path(source, year)
+    dictionary_path = vintage_fba_path(source) + vintage_dictionary_name
+    with vintage_dictionary_lock(source):
+        table, dictionaries = encode_vintage_table(flowby_table(df, preserve_index=False),
+                                                   read_vintage_dictionaries(dictionary_path))
+        # dictionaries only grow, so they are written before any file using the new codes
+        write_vintage_dictionaries(dictionary_path, dictionaries)
+    if os.path.isdir(year_path):
+        shutil.rmtree(year_path)
+    os.makedirs(year_path)
+    f = year_path + source + '_' + str(year) + '.parquet'
+    write_flowby_table(table, f, fba_sort_columns, provenance=provenance, clean_stamp=clean_stamp)
+    return [(f, None)]
+
+
+def vintage_scanner(datasource, years, columns=None, filter_expression=None, dictionary_columns=None,
+                    batch_rows=None):
+    """
+    Scanner of years of a source in the vintage store. Year partitions are pruned while reading, codes are
+    decoded batch by batch and the filter is applied to the decoded batches.
+    :param datasource: str, FlowByActivity source name
+    :param years: list of str, years stored in the vintage store
+    :param columns: list, columns to return, None returns all columns
+    :param filter_expression: pyarrow expression from build_filter_expression, None returns all rows
+    :param dictionary_columns: list, string columns to return as Arrow dictionaries
+    :param batch_rows: int, maximum rows per record batch
+    :return: pyarrow dataset Scanner
+    """
+    dictionaries = read_vintage_dictionaries(vintage_fba_path(datasource) + vintage_dictionary_name)
+    dataset = ds.dataset(vintage_fba_path(datasource), format='parquet', partitioning=vintage_partitioning)
+    names = [c for c in dataset.schema.names if c != 'year']
+    # read the requested columns and the columns filters can refer to
+    filter_names = [c for c_list in fba_filter_columns.values() for c in c_list]
+    read_columns = [c for c in names if columns is None or c in columns or c in filter_names]
+    schema = decode_vintage_table(dataset.schema.empty_table().select(read_columns), dictionaries,
+                                  dictionary_columns).schema
+    inner = dataset.scanner(**scanner_options(read_columns, ds.field('year').isin(years), batch_rows))
+    batches = (decode_vintage_table(b, dictionaries, dictionary_columns) for b in inner.to_batches())
+    return ds.Scanner.from_batches(batches, schema=schema, **scanner_options(columns or names, filter_expression,
+                                                                              batch_rows))
+
+
+def locate_flowbyactivity(datasource, years):
+    """
+    Find where each year of a FlowByActivity source is stored. A year stored in more than one layout is read from
+    the vintage store first, then the partitioned store, then the flat file.
+    :param datasource: str, FlowByActivity source name
+    :param years: list, years of data
+    :return: lists of years in the vintage store, years in the partitioned store, flat parquet files, and years
+     not found
+    """
+    vintage_years = []
+    partitioned_years = []
+    flat_files = []
+    missing_years = []
+    for y in years:
+        if os.path.isdir(vintage_fba_path(datasource, y)):
+            vintage_years.append(str(y))
+        elif os.path.isdir(partitioned_fba_path(datasource, y)):
+            partitioned_years.append(str(y))
+        elif os.path.isfile(fbaoutputpath + datasource + "_" + str(y) + ".parquet"):
+            flat_files.append(fbaoutputpath + datasource + "_" + str(y) + ".parquet")
+        else:
+            missing_years.append(str(y))
+    return vintage_years, partitioned_years, flat_files, missing_years
+
+
+def flowbyactivity_files(datasource, years):
+    """
+    All files read when loading years of a FlowByActivity source
+    :param datasource: str, FlowByActivity source name
+    :param years: list, years of data
+    :return: sorted list of file paths
+    """
+    vintage_years, partitioned_years, files, missing_years = locate_flowbyactivity(datasource, years)
+    year_paths = [partitioned_fba_path(datasource, y) for y in partitioned_years] + \
+        [vintage_fba_path(datasource, y) for y in vintage_years]
+    if len(vintage_years) > 0:
+        files.append(vintage_fba_path(datasource) + vintage_dictionary_name)
+    for path in year_paths:
+        for root, dirs, filenames in os.walk(path):
+            files.extend(os.path.join(root, f) for f in filenames)
+    return sorted(files)
+
+
+def flowbyactivity_scanners(datasource, years, columns=None, filter_expression=None, dictionary_columns=None,
+                            file_filter=None, batch_rows=None):
+    """
+    Scanners of all requested years of a FlowByActivity source. Years found in the vintage store are read in one
+    scan with year pruning, years found in the partitioned store are read in one scan with year and Class partition
+    pruning, and years only stored as flat parquet files are read in a third scan.
+    :param datasource: str, FlowByActivity source name
+    :param years: list, years of data
+    :param columns: list, columns to return, None returns all columns
+    :param filter_expression: pyarrow expression from build_filter_expression, None returns all rows
+    :param dictionary_columns: list, string columns to read as Arrow dictionaries
+    :param file_filter: function returning the flat parquet files, of a list of files, that need to be read
+    :param batch_rows: int, maximum rows per record batch
+    :return: list of pyarrow dataset Scanners, empty if no data is found
+    """
+    vintage_years, partitioned_years, flat_files, missing_years = locate_flowbyactivity(datasource, years)
+    for y in missing_years:
+        log.error("No parquet file found for datasource " + datasource + "and year " + y + " in flowsa")
+    if file_filter is not None:
+        flat_files = file_filter(flat_files)
+
+    scanners = []
+    if len(vintage_years) > 0:
+        scanners.append(vintage_scanner(datasource, vintage_years, columns, filter_expression, dictionary_columns,
+                                        batch_rows))
+    if len(partitioned_years) > 0:
+        dataset = ds.dataset(partitioned_fba_path(datasource), format=parquet_format(dictionary_columns),
+                             partitioning=fba_partitioning)
+        expression = ds.field('year').isin(partitioned_years)
+        if filter_expression is not None:
+            expression = expression & filter_expression
+        partition_columns = columns
+        if partition_columns is None:
+            # return the partition column Class in its usual position, the first column
+            partition_columns = ['Class'] + [c for c in dataset.schema.names if c not in ('year', 'Class')]
+        scanners.append(dataset.scanner(**scanner_options(partition_columns, expression, batch_rows)))
+    if len(flat_files) > 0:
+        scanners.extend(flowby_parquet_scanners(flat_files, columns, filter_expression, dictionary_columns,
+                                                batch_rows))
+    return scanners
+
+
+def scan_flowbyactivity(datasource, years, columns=None, filter_expression=None, dictionary_columns=None,
+                        file_filter=None):
+    """
+    Scan all requested years of a FlowByActivity source into Arrow tables, see flowbyactivity_scanners
+    :param datasource: str, FlowByActivity source name
+    :param years: list, years of data
+    :param columns: list, columns to return, None returns all columns
+    :param filter_expression: pyarrow expression from build_filter_expression, None returns all rows
+    :param dictionary_columns: list, string columns to return as Arrow dictionaries
+    :param file_filter: function returning the flat parquet files, of a list of files, that need to be read
+    :return: list of pyarrow Tables, empty if no data is found
+    """
+    # partition values, like Class, are read as strings
+    return [encode_dictionary_columns(s.to_table(), dictionary_columns)
+            for s in flowbyactivity_scanners(datasource, years, columns, filter_expression, dictionary_columns,
+                                             file_filter)]
+
+
+def iter_flowbyactivity_batches(datasource, years, batch_rows, columns=None, filter_expression=None,
+                                dictionary_columns=None, file_filter=None):
+    """
+    Stream all requested years of a FlowByActivity source as Arrow record batches, so only one batch is held in
+    memory at a time, see flowbyactivity_scanners
+    :param datasource: str, FlowByActivity source name
+    :param years: list, years of data
+    :param batch_rows: int, maximum rows per batch
+    :param columns: list, columns to return, None returns all columns
+    :param filter_expression: pyarrow expression from build_filter_expression, None returns all rows
+    :param dictionary_columns: list, string columns to return as Arrow dictionaries
+    :param file_filter: function returning the flat parquet files, of a list of files, that need to be read
+    :return: generator of pyarrow Tables of up to batch_rows rows
+    """
+    for scanner in flowbyactivity_scanners(datasource, years, columns, filter_expression, dictionary_columns,
+                                           file_filter, batch_rows):
+        for batch in scanner.to_batches():
+            if batch.num_rows > 0:
+                yield encode_dictionary_columns(pa.Table.from_batches([batch]), dictionary_columns)
+
+
+def read_flowbyactivity(datasource, years, columns=None, filter_expression=None, dictionary_columns=None,
+                        file_filter=None):
+    """
+    Read all requested years of a FlowByActivity source, see scan_flowbyactivity
+    :param datasource: str, FlowByActivity source name
+    :param years: list, years of data
+    :param columns: list, columns to return, None returns all columns
+    :param filter_expression: pyarrow expression from build_filter_expression, None returns all rows
+    :param dictionary_columns: list, string columns to return as pandas categoricals
+    :param file_filter: function returning the flat parquet files, of a list of files, that need to be read
+    :return: pandas DataFrame, empty if no data is found
+    """
+    tables = scan_flowbyactivity(datasource, years, columns, filter_expression, dictionary_columns, file_filter)
+    return concat_flowby_dfs([t.to_pandas() for t in tables], dictionary_columns)
@@ -0,0 +1,74 @@
+# benchmark_parquet_writer_profile.py (scripts)
+# !/usr/bin/env python3
+# coding=utf-8
+
+"""
+Compare filtered read latency of a FlowByActivity parquet file written with pandas defaults against the same file
+written with the flowsa writer profile (sorted rows, sized row groups, page indexes, zstd).
+Uses a synthetic county level df, or a stored FlowByActivity file passed on the command line, e.g.
+python benchmark_parquet_writer_profile.py USGS_NWIS_WU_2015.parquet
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+import numpy as np
+import pandas as pd
+from flowsa.common import fbaoutputpath
+from flowsa.storage import fba_filter_columns, fba_sort_columns, build_filter_expression, \
+    read_flowby_parquet, write_flowby_parquet
+
+
+def synthetic_fba(n_rows=2000000, seed=0):
+    """Random county level FlowByActivity-like df"""
+    rng = np.random.default_rng(seed)
+    locations = np.array([str(s).zfill(2) + str(c).zfill(3) for s in range(1, 57) for c in range(1, 60)])
+    activities = np.array(['Activity ' + str(a) for a in range(200)])
+    return pd.DataFrame({'Class': rng.choice(['Water', 'Land', 'Employment', 'Chemicals'], n_rows),
+                         'SourceName': 'Benchmark',
+                         'FlowName': rng.choice(['fresh', 'saline', 'total'], n_rows),
+                         'FlowAmount': rng.random(n_rows),
+                         'Unit': 'Mgal',
+                         'ActivityProducedBy': rng.choice(activities, n_rows),
+                         'ActivityConsumedBy': rng.choice(activities, n_rows),
+                         'Compartment': rng.choice(['ground', 'surface'], n_rows),
+                         'Location': rng.choice(locations, n_rows),
+                         'Year': 2015})
+
+
+def time_reads(path, queries, repeat=5):
+    """Best of repeat read times, in ms, of each query"""
+    times = {}
+    for name, filters in queries.items():
+        expression = build_filter_expression(fba_filter_columns, **filters)
+        times[name] = 1000 * min(timeit.repeat(lambda: read_flowby_parquet(path, filter_expression=expression),
+                                               number=1, repeat=repeat))
+    return times
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        df = pd.read_parquet(fbaoutputpath + sys.argv[1])
+    else:
+        df = synthetic_fba()
+    first = df.iloc[0]
+    # getFlowByActivity always filters on Class, so it is included with the other filters
+    queries = {'one state, one flow': {'flowclass': first['Class'], 'locations': first['Location'],
+                                       'flownames': first['FlowName']},
+               'one class': {'flowclass': first['Class']},
+               'one activity': {'activities': first['ActivityConsumedBy']},
+               'all rows': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        default_path = os.path.join(tmp, 'default.parquet')
+        profile_path = os.path.join(tmp, 'profile.parquet')
+        df.to_parquet(default_path, engine="pyarrow")
+        write_flowby_parquet(df, profile_path, fba_sort_columns)
+        print('rows: ' + str(len(df)))
+        print('file size (MB), default: ' + str(round(os.path.getsize(default_path) / 1e6, 2)) +
+              ', profile: ' + str(round(os.path.getsize(profile_path) / 1e6, 2)))
+        default_times = time_reads(default_path, queries)
+        profile_times = time_reads(profile_path, queries)
+    for name in queries:
+        print(name + ' (ms), default: ' + str(round(default_times[name], 1)) +
+              ', profile: ' + str(round(profile_times[name], 1)))
@@ -8,18 +8,18 @@ setup(
     package_data={'flowsa': [
         "data/*.*", "output/*.*"]},
     include_package_data=True,
+    entry_points={'console_scripts': ['flowsa=flowsa.__main__:main']},
     install_requires=[
         'fedelemflowlist @ git+https://github.com/USEPA/Federal-LCA-Commons-Elementary-Flow-List',
         'pandas>=1.0',
         'pip>=9',
         'setuptools>=41',
         'pyyaml>=5.3',
-        'pyarrow==0.15',
+        'pyarrow>=14.0',
         'requests>=2.22.0',
         'appdirs>=1.4.3',
         'pycountry>=19.8.18',
         'xlrd>=1.2.0',
-        'requests_ftp==0.3.1',
         'tabula-py>=2.1.1'
     ],
     url='https://github.com/USEPA/FLOWSA',
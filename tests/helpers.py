@@ -0,0 +1,80 @@
+# helpers.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Test data and a test case storing flowbyactivity and flowbysector outputs in a temporary directory """
+import os
+import tempfile
+import unittest
+from unittest import mock
+import pandas as pd
+import flowsa
+from flowsa.common import flow_by_activity_fields, flow_by_sector_fields
+from flowsa.flowbyfunctions import add_missing_flow_by_fields
+
+# module level copies of fbaoutputpath and fbsoutputpath, patched by OutputDirTestCase
+fba_output_paths = ('flowsa.storage.fbaoutputpath', 'flowsa.flowbyactivity.fbaoutputpath', 'flowsa.fbaoutputpath')
+fbs_output_paths = ('flowsa.fbsoutputpath', 'flowsa.query.fbsoutputpath', 'flowsa.flowbysector.fbsoutputpath',
+                    'flowsa.cube.fbsoutputpath', 'flowsa.datachecks.fbsoutputpath', 'flowsa.database.fbsoutputpath')
+
+
+def create_test_fba(year=2015):
+    """Small FlowByActivity df with two classes, two activities and national, state and county locations"""
+    df = pd.DataFrame({'Class': ['Water', 'Water', 'Water', 'Land', 'Land'],
+                       'SourceName': 'Test_Source',
+                       'FlowName': ['fresh', 'saline', 'fresh', 'AREA', 'AREA'],
+                       'FlowAmount': [10.0, 20.0, 30.0, 40.0, 50.0],
+                       'Unit': ['Mgal', 'Mgal', 'Mgal', 'ACRES', 'ACRES'],
+                       'FlowType': 'ELEMENTARY_FLOW',
+                       'ActivityProducedBy': None,
+                       'ActivityConsumedBy': ['Mining', 'Mining', 'Domestic', 'Cropland', 'Cropland'],
+                       'Compartment': ['ground', 'surface', 'ground', None, None],
+                       'Location': ['00000', '06000', '06037', '06000', '06037'],
+                       'LocationSystem': 'FIPS_2015',
+                       'Year': year,
+                       'DataReliability': 5.0,
+                       'DataCollection': 5.0,
+                       'Description': 'test data'})
+    return add_missing_flow_by_fields(df, flow_by_activity_fields)
+
+
+def create_test_fbs():
+    """FlowBySector df of water use by 90 2-digit and 900 4-digit consuming sectors in two states"""
+    sectors = [str(s) for s in range(10, 100)] + [str(s) for s in range(1000, 10000, 10)]
+    df = pd.DataFrame({'Flowable': 'Water',
+                       'Class': 'Water',
+                       'SectorConsumedBy': sectors * 2,
+                       'Context': 'resource/water',
+                       'Location': ['06000'] * len(sectors) + ['48000'] * len(sectors),
+                       'LocationSystem': 'FIPS_2015',
+                       'FlowAmount': 1.0,
+                       'Unit': 'kg',
+                       'FlowType': 'ELEMENTARY_FLOW',
+                       'Year': 2015})
+    return add_missing_flow_by_fields(df, flow_by_sector_fields)
+
+
+class OutputDirTestCase(unittest.TestCase):
+    """
+    Test case with FlowByActivity outputs stored in a temporary directory, self.path, and FlowBySector outputs in
+    its fbs/ subdirectory, self.fbs_path. The in-memory cache is cleared before and after each test.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = self.tmp.name + '/'
+        self.fbs_path = self.path + 'fbs/'
+        os.makedirs(self.fbs_path)
+        for p in fba_output_paths:
+            self.patch(p, self.path)
+        for p in fbs_output_paths:
+            self.patch(p, self.fbs_path)
+        flowsa.clear_cache()
+        self.addCleanup(flowsa.clear_cache)
+
+    def patch(self, target, new):
+        """Patch an attribute for the rest of the test"""
+        patcher = mock.patch(target, new)
+        patcher.start()
+        self.addCleanup(patcher.stop)
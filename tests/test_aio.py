@@ -0,0 +1,58 @@
+# test_aio.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Tests of the asyncio flowsa api """
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from flowsa import aio
+from flowsa.flowbyactivity import store_flowbyactivity
+from helpers import OutputDirTestCase, create_test_fba
+
+
+class TestAsyncLoads(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store_flowbyactivity(create_test_fba(2015), 'Test_Source', 2015)
+        executor = ThreadPoolExecutor(2)
+        aio.set_executors(io=executor, build=executor)
+        self.addCleanup(aio.set_executors)
+        self.addCleanup(executor.shutdown)
+
+    def test_get_flow_by_activity(self):
+        fba = asyncio.run(aio.get_flow_by_activity(['Water'], [2015], 'Test_Source', locations=['06037']))
+        self.assertEqual([30.0], fba['FlowAmount'].tolist())
+        fbas = asyncio.run(aio.get_flow_by_activities(
+            {'water': {'flowclass': ['Water'], 'years': [2015], 'datasource': 'Test_Source'},
+             'land': {'flowclass': ['Land'], 'years': [2015], 'datasource': 'Test_Source'}}))
+        self.assertEqual({'water': 3, 'land': 2}, {k: len(v) for k, v in fbas.items()})
+
+    def test_build_cancelled_between_stages(self):
+        stages = []
+        stopped = threading.Event()
+
+        def main(method_name, checkpoint):
+            try:
+                for i in range(100):
+                    checkpoint('stage ' + str(i))
+                    stages.append(i)
+                    time.sleep(0.01)
+            except aio.BuildCancelled:
+                stopped.set()
+                raise
+
+        async def cancel_build():
+            task = asyncio.ensure_future(aio.build_flow_by_sector('Test_Method'))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with mock.patch('flowsa.flowbysector.main', main):
+            asyncio.run(cancel_build())
+            self.assertTrue(stopped.wait(1))
+        self.assertLess(len(stages), 100)
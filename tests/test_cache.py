@@ -0,0 +1,102 @@
+# test_cache.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Tests of the in-memory cache of loaded flowbyactivity and flowbysector dfs """
+import os
+import tempfile
+import unittest
+from unittest import mock
+import pandas as pd
+import flowsa
+from flowsa.cache import FrameCache, default_cache_bytes
+from flowsa.flowbysector import prefetch_flowbyactivity
+from flowsa.storage import estimated_frame_bytes
+from helpers import OutputDirTestCase, create_test_fba
+
+
+class TestFrameCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.file = self.tmp.name + '/data.parquet'
+        self.df = pd.DataFrame({'FlowAmount': range(100)})
+        self.df.to_parquet(self.file)
+
+    def test_hand_out_copies(self):
+        cache = FrameCache()
+        cache.put('a', [self.file], self.df)
+        df = cache.get('a', [self.file])
+        df.loc[:, 'FlowAmount'] = 0
+        self.assertEqual(99, cache.get('a', [self.file])['FlowAmount'].max())
+
+    def test_invalidated_by_file_change(self):
+        cache = FrameCache()
+        cache.put('a', [self.file], self.df)
+        self.df.iloc[0:10].to_parquet(self.file)
+        os.utime(self.file, ns=(0, 0))
+        self.assertIsNone(cache.get('a', [self.file]))
+        self.assertEqual(0, cache.nbytes)
+
+    def test_lru_eviction(self):
+        nbytes = int(self.df.memory_usage(deep=True).sum())
+        cache = FrameCache(max_bytes=2 * nbytes)
+        for key in ('a', 'b'):
+            cache.put(key, [self.file], self.df)
+        # use 'a' so 'b' is the least recently used entry
+        cache.get('a', [self.file])
+        cache.put('c', [self.file], self.df)
+        self.assertIsNone(cache.get('b', [self.file]))
+        self.assertIsNotNone(cache.get('a', [self.file]))
+        self.assertIsNotNone(cache.get('c', [self.file]))
+
+
+class TestGetFlowByActivityCache(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        create_test_fba(2015).to_parquet(self.path + 'Test_Source_2015.parquet')
+
+    def test_repeated_load_is_cached(self):
+        with mock.patch('flowsa.read_flowbyactivity', wraps=flowsa.read_flowbyactivity) as read:
+            first = flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source')
+            second = flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source')
+            flowsa.getFlowByActivity(['Land'], [2015], 'Test_Source')
+        self.assertEqual(2, read.call_count)
+        pd.testing.assert_frame_equal(first, second)
+
+    def test_batch_load_shares_cache(self):
+        create_test_fba(2010).to_parquet(self.path + 'Test_Source_2010.parquet')
+        requests = {'water': {'flowclass': ['Water'], 'years': [2015], 'datasource': 'Test_Source'},
+                    'land': {'flowclass': ['Land'], 'years': [2010, 2015], 'datasource': 'Test_Source',
+                             'locations': ['06037']}}
+        with mock.patch('flowsa.read_flowbyactivity', wraps=flowsa.read_flowbyactivity) as read:
+            fbas = flowsa.getFlowByActivities(requests, max_workers=2)
+            water = flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source')
+        self.assertEqual(2, read.call_count)
+        self.assertEqual([50.0, 50.0], fbas['land']['FlowAmount'].tolist())
+        pd.testing.assert_frame_equal(fbas['water'], water)
+        self.assertEqual([0], list(flowsa.getFlowByActivities([requests['water']])))
+
+    def test_prefetch_fits_cache(self):
+        # repeated rows compress well, so the file is much smaller than the loaded df
+        fba = pd.concat([create_test_fba(2016)] * 2000, ignore_index=True)
+        fba.to_parquet(self.path + 'Test_Source_2016.parquet')
+        requests = [{'flowclass': ['Water'], 'years': [2016], 'datasource': 'Test_Source'}]
+        loaded_bytes = int(fba.memory_usage(deep=True).sum())
+        estimate = estimated_frame_bytes([self.path + 'Test_Source_2016.parquet'])
+        self.assertLess(os.path.getsize(self.path + 'Test_Source_2016.parquet'), loaded_bytes / 10)
+        self.assertGreater(estimate, loaded_bytes / 2)
+        self.assertLess(estimate, loaded_bytes * 2)
+        self.addCleanup(flowsa.set_cache_size, default_cache_bytes)
+        with mock.patch('flowsa.read_flowbyactivity', wraps=flowsa.read_flowbyactivity) as read:
+            # the loaded df would not be kept, so it is not loaded ahead, even if the file fits the cache
+            for max_bytes in (0, estimate - 1):
+                flowsa.set_cache_size(max_bytes)
+                self.assertFalse(prefetch_flowbyactivity(requests))
+            self.assertEqual(0, read.call_count)
+            flowsa.set_cache_size(estimate)
+            self.assertTrue(prefetch_flowbyactivity(requests))
+            flowsa.getFlowByActivity(['Water'], [2016], 'Test_Source')
+        self.assertEqual(1, read.call_count)
@@ -0,0 +1,63 @@
+# test_cube.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Tests of the flowbysector rollup cube """
+import pandas as pd
+import flowsa
+from flowsa.common import flow_by_sector_fields
+from flowsa.flowbyfunctions import clean_df, fbs_fill_na_dict
+from flowsa.cube import build_flowbysector_cube, write_flowbysector_cube, subset_sector_level
+from helpers import OutputDirTestCase
+
+
+def create_test_fbs_all_levels():
+    """County FlowBySector df of one 6 digit sector and its parents, as returned by sector_aggregation"""
+    sectors = ['11', '111', '1111', '11111', '111110']
+    df = pd.DataFrame({'Flowable': 'Water',
+                       'Class': 'Water',
+                       'SectorConsumedBy': sectors * 3,
+                       'SectorSourceName': 'NAICS_2012_Code',
+                       'Context': 'resource/water',
+                       'Location': ['06037'] * 5 + ['06001'] * 5 + ['48201'] * 5,
+                       'LocationSystem': 'FIPS_2015',
+                       'FlowAmount': [1.0] * 5 + [2.0] * 5 + [4.0] * 5,
+                       'Unit': 'kg',
+                       'FlowType': 'ELEMENTARY_FLOW',
+                       'Year': 2015,
+                       'DataReliability': 1.0,
+                       'DataCollection': 1.0})
+    return clean_df(df, flow_by_sector_fields, fbs_fill_na_dict)
+
+
+class TestFlowBySectorCube(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cube = build_flowbysector_cube(create_test_fbs_all_levels(), 'county')
+        write_flowbysector_cube(self.cube, 'Test_Method')
+
+    def test_cube_partitions(self):
+        self.assertEqual(15, len(self.cube))
+        self.assertEqual([7.0], self.cube[(2, 'national')]['FlowAmount'].tolist())
+
+    def test_read_rollups(self):
+        fbs = flowsa.getFlowBySector_cube('Test_Method', 4, 'state').sort_values('Location')
+        self.assertEqual(['06000', '48000'], fbs['Location'].tolist())
+        self.assertEqual(['1111', '1111'], fbs['SectorConsumedBy'].tolist())
+        self.assertEqual([3.0, 4.0], fbs['FlowAmount'].tolist())
+        self.assertEqual(list(flow_by_sector_fields), list(fbs.columns))
+        fbs = flowsa.getFlowBySector_cube('Test_Method', 6, 'county', locations=['06001'], sector_prefix='11')
+        self.assertEqual([('111110', 2.0)], list(zip(fbs['SectorConsumedBy'], fbs['FlowAmount'])))
+
+    def test_sector_level_selection(self):
+        # flows with either sector at the level, each kept once
+        fbs = pd.DataFrame({'SectorProducedBy': ['11', '11', None],
+                            'SectorConsumedBy': ['111', '11', '1111'],
+                            'FlowAmount': [1.0, 2.0, 4.0]})
+        self.assertEqual([1.0, 2.0], subset_sector_level(fbs, 2)['FlowAmount'].tolist())
+        self.assertEqual([1.0], subset_sector_level(fbs, 3)['FlowAmount'].tolist())
+        self.assertEqual([4.0], subset_sector_level(fbs, 4)['FlowAmount'].tolist())
+
+    def test_missing_cube(self):
+        self.assertTrue(flowsa.getFlowBySector_cube('Other_Method', 2, 'national').empty)
@@ -0,0 +1,91 @@
+# test_database.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Tests of exporting flowbyactivity and flowbysector files to a database """
+import sqlite3
+import unittest
+import flowsa
+from flowsa.__main__ import main
+from flowsa.flowbyactivity import store_flowbyactivity
+from flowsa.flowbysector import store_flowbysector
+from flowsa.database import export_database
+from helpers import OutputDirTestCase, create_test_fba, create_test_fbs
+
+
+class TestExportDatabase(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(flowsa.set_database, None)
+        self.database = self.path + 'flowsa.sqlite'
+        store_flowbyactivity(create_test_fba(2015), 'Test_Source', 2015)
+        store_flowbyactivity(create_test_fba(2010), 'Test_Source', 2010, partitioned=True)
+        store_flowbysector(create_test_fbs(), 'Test_Method')
+        flowsa.clear_cache()
+
+    def test_export_incremental(self):
+        self.assertEqual({'loaded': 4, 'skipped': 0, 'removed': 0}, export_database(self.database))
+        self.assertEqual({'loaded': 0, 'skipped': 4, 'removed': 0}, export_database(self.database))
+        store_flowbyactivity(create_test_fba(2015).iloc[0:2], 'Test_Source', 2015)
+        self.assertEqual({'loaded': 1, 'skipped': 3, 'removed': 0}, export_database(self.database))
+
+    def test_read_from_database(self):
+        main(['export-db', '--database', self.database])
+        parquet_fba = flowsa.getFlowByActivity(['Water'], [2010, 2015], 'Test_Source', locations=['06000'])
+        parquet_fbs = flowsa.getFlowBySector('Test_Method', sector_prefix='1', sector_level=4)
+        flowsa.set_database(self.database)
+        fba = flowsa.getFlowByActivity(['Water'], [2010, 2015], 'Test_Source', locations=['06000'])
+        self.assertEqual(sorted(parquet_fba['FlowAmount'].tolist()), sorted(fba['FlowAmount'].tolist()))
+        self.assertEqual(sorted(parquet_fba['Year'].tolist()), sorted(fba['Year'].tolist()))
+        fbs = flowsa.getFlowBySector('Test_Method', sector_prefix='1', sector_level=4)
+        self.assertEqual(sorted(parquet_fbs['SectorConsumedBy']), sorted(fbs['SectorConsumedBy']))
+        self.assertEqual(200, len(fbs))
+
+    def test_subset(self):
+        main(['export-db', '--database', self.database, '--fba'])
+        flowsa.set_database(self.database)
+        # sources not in the database are read from the parquet files
+        self.assertEqual([], flowsa.database_files('FBA', 'Test_Source', [2015]))
+        self.assertEqual(3, len(flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source')))
+        self.assertEqual(1, len(flowsa.database_files('FBS', 'Test_Method')))
+
+    def test_dtypes_match_parquet(self):
+        parquet_fba = flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source')
+        export_database(self.database)
+        flowsa.set_database(self.database)
+        fba = flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source')
+        # Spread, Min and Max hold no values, but are still read as floats
+        for c in ('FlowAmount', 'Spread', 'Min', 'Max', 'Year'):
+            self.assertEqual(parquet_fba[c].dtype, fba[c].dtype, c)
+
+    def test_changed_file_read_from_parquet(self):
+        export_database(self.database)
+        flowsa.set_database(self.database)
+        self.assertEqual(1, len(flowsa.database_files('FBA', 'Test_Source', [2015])))
+        store_flowbyactivity(create_test_fba(2015).iloc[0:2], 'Test_Source', 2015)
+        self.assertEqual([], flowsa.database_files('FBA', 'Test_Source', [2015]))
+        self.assertEqual(2, len(flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source')))
+
+    def test_read_only(self):
+        other = self.path + 'other.sqlite'
+        sqlite3.connect(other).close()
+        flowsa.set_database(other)
+        self.assertEqual([], flowsa.database_files('FBS', 'Test_Method'))
+        con = sqlite3.connect(other)
+        self.assertEqual([], con.execute("SELECT name FROM sqlite_master").fetchall())
+        con.close()
+
+    def test_layout_exported_once(self):
+        # an older flat copy of a year in the partitioned store is not exported alongside it
+        store_flowbyactivity(create_test_fba(2010), 'Test_Source', 2010)
+        self.assertEqual({'loaded': 4, 'skipped': 0, 'removed': 0}, export_database(self.database))
+        main(['vintages', '--source', 'Test_Source', '--years', '2010', '2015'])
+        self.assertEqual({'loaded': 2, 'skipped': 1, 'removed': 3}, export_database(self.database))
+        flowsa.set_database(self.database)
+        self.assertEqual(5, len(flowsa.getFlowByActivity(['Water', 'Land'], [2015], 'Test_Source')))
+        self.assertEqual(5, len(flowsa.getFlowByActivity(['Water', 'Land'], [2010], 'Test_Source')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# test_datachecks.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Tests of comparing flowbysector versions """
+import unittest
+import pandas as pd
+import flowsa
+from flowsa.common import flow_by_sector_fields
+from flowsa.flowbyfunctions import add_missing_flow_by_fields
+from flowsa.flowbysector import store_flowbysector
+from helpers import OutputDirTestCase
+
+
+def create_test_fbs(amounts, sectors=('11', '21', '22', '23')):
+    """State FlowBySector df of water use by consuming sectors"""
+    df = pd.DataFrame({'Flowable': 'Water',
+                       'Class': 'Water',
+                       'SectorConsumedBy': list(sectors),
+                       'Context': 'resource/water',
+                       'Location': '06000',
+                       'LocationSystem': 'FIPS_2015',
+                       'FlowAmount': amounts,
+                       'Unit': 'kg',
+                       'FlowType': 'ELEMENTARY_FLOW',
+                       'Year': 2015})
+    return add_missing_flow_by_fields(df, flow_by_sector_fields)
+
+
+class TestCompareFlowBySector(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store_flowbysector(create_test_fbs([1.0, 2.0, 3.0, 4.0]), 'Test_a')
+        store_flowbysector(create_test_fbs([1.0, 2.0000001, 5.0, 6.0], ('11', '21', '22', '31')), 'Test_b')
+
+    def test_compare(self):
+        # small batches so flows are summed across batches
+        result = flowsa.compare_fbs('Test_a', 'Test_b', rtol=1e-5, batch_rows=2)
+        self.assertEqual(['31'], result['added']['SectorConsumedBy'].tolist())
+        self.assertEqual(['23'], result['removed']['SectorConsumedBy'].tolist())
+        changed = result['changed']
+        self.assertEqual(['22'], changed['SectorConsumedBy'].tolist())
+        self.assertEqual([2.0], changed['Difference'].tolist())
+        totals = result['sector_totals'].set_index('SectorConsumedBy')
+        self.assertEqual(-4.0, totals.loc['23', 'Difference'])
+        self.assertEqual(6.0, totals.loc['31', 'FlowAmount_b'])
+
+    def test_identical(self):
+        result = flowsa.compare_fbs('Test_a', self.fbs_path + 'Test_a.parquet')
+        for k in ('added', 'removed', 'changed'):
+            self.assertEqual(0, len(result[k]))
+
+    def test_custom_key_columns(self):
+        # the sector totals read their columns even when they are not key columns
+        result = flowsa.compare_fbs('Test_a', 'Test_b', key_columns=['Location', 'SectorConsumedBy', 'Flowable'],
+                                    batch_rows=2)
+        self.assertEqual(['31'], result['added']['SectorConsumedBy'].tolist())
+        self.assertEqual(['22'], result['changed']['SectorConsumedBy'].tolist())
+        self.assertEqual(-4.0, result['sector_totals'].set_index('SectorConsumedBy').loc['23', 'Difference'])
+
+
+if __name__ == '__main__':
+    unittest.main()
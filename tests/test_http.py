@@ -0,0 +1,335 @@
+# test_http.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Tests of requesting source urls, against a local stand-in http server """
+import ftplib
+import gc
+import io
+import os
+import pickle
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+import flowsa.flowbyactivity
+from flowsa.common import make_http_requests, make_http_request, http_stats, set_offline, response_cache_key, \
+    response_file, fetch_and_parse
+from flowsa.EPA_NEI import epa_nei_call
+
+
+def stand_in_call(url, r, args):
+    """call_response_fxn returning the response text"""
+    return r.text
+
+
+def slow_parse(url, r, args):
+    """call_response_fxn taking args['seconds'] to parse a response"""
+    time.sleep(args['seconds'])
+    return r.text
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers /<n> with the path after a delay, counting the requests in flight, /flaky with 503 for the first two
+    requests, /slow after a second, /etag with an ETag, and 304 to requests for a changed version, and /zip with a
+    zip archive of two csv files
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections_opened += 1
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/flaky':
+            with server.lock:
+                server.flaky_requests += 1
+                status = 503 if server.flaky_requests <= 2 else 200
+            return self.send_text(status, 'flaky')
+        if self.path.startswith('/etag'):
+            with server.lock:
+                server.full_responses += self.headers.get('If-None-Match') != '"v1"'
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            return self.send_text(200, 'versioned', {'ETag': '"v1"'})
+        if self.path == '/zip':
+            return self.send_body(200, server.zip_body)
+        if self.path == '/slow':
+            time.sleep(1)
+            return self.send_text(200, 'slow')
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        # later urls answer sooner, so responses arrive out of order
+        time.sleep(server.delay / (1 + int(self.path.strip('/') or 0)))
+        with server.lock:
+            server.in_flight -= 1
+        self.send_text(200, self.path)
+
+    def send_text(self, status, text, headers=None):
+        self.send_body(status, text.encode(), headers)
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInFTP:
+    """ftplib.FTP serving one file in blocks, recording the blocks sent and whether the connection was closed"""
+
+    body = b''
+    error = None
+    instances = []
+
+    def __init__(self, timeout=None):
+        self.blocks = 0
+        self.closed = False
+        StandInFTP.instances.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closed = True
+
+    def connect(self, host, port):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def retrbinary(self, cmd, callback, blocksize):
+        if self.error is not None:
+            raise self.error
+        for i in range(0, len(self.body), blocksize):
+            self.blocks += 1
+            callback(self.body[i:i + blocksize])
+
+
+class StandInServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        self.server.delay = 0.2
+        self.server.flaky_requests = 0
+        self.server.connections_opened = 0
+        self.server.full_responses = 0
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as z:
+            for region in (1, 2):
+                z.writestr('region' + str(region) + '.csv', 'region,amount\n' + str(region) + ',' + str(region * 10))
+        self.server.zip_body = archive.getvalue()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+        self.urls = [self.url + '/' + str(i) for i in range(12)]
+        flowsa.common.close_http_session()
+        flowsa.common.reset_http_stats()
+        self.addCleanup(flowsa.common.close_http_session)
+        # each test starts with an empty response cache
+        self.cache = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache.cleanup)
+        patcher = mock.patch('flowsa.common.response_cache_path', self.cache.name + '/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestConcurrentRequests(StandInServerTestCase):
+
+    def test_order_and_host_limit(self):
+        start = time.perf_counter()
+        responses = list(make_http_requests(self.urls, max_workers=8, max_per_host=3))
+        elapsed = time.perf_counter() - start
+        self.assertEqual(['/' + str(i) for i in range(12)], [r.text for r in responses])
+        self.assertEqual(3, self.server.max_in_flight)
+        # one at a time would take the sum of the delays, about 0.6 seconds
+        self.assertLess(elapsed, 0.5)
+
+    def test_call_urls_order(self):
+        config = {'call_response_fxn': 'stand_in_call'}
+        with mock.patch('flowsa.flowbyactivity.config', config, create=True), \
+                mock.patch('flowsa.flowbyactivity.stand_in_call', stand_in_call, create=True):
+            results = flowsa.flowbyactivity.call_urls(self.urls, {'max_workers': 4, 'parse_workers': 2})
+        self.assertEqual(['/' + str(i) for i in range(12)], results)
+
+
+class TestFetchAndParse(StandInServerTestCase):
+
+    def test_in_process_parsing(self):
+        results = fetch_and_parse(self.urls, stand_in_call, {}, max_workers=4, parse_workers=0)
+        self.assertEqual(['/' + str(i) for i in range(12)], results)
+
+    def test_parse_workers(self):
+        pool = flowsa.common.parse_workers_pool
+        with mock.patch('flowsa.common.parse_workers_pool', side_effect=pool) as parse_pool:
+            # by default and for a single url responses are parsed in this process
+            fetch_and_parse(self.urls, stand_in_call, {}, max_workers=4)
+            fetch_and_parse(self.urls[0:1], stand_in_call, {}, max_workers=4, parse_workers=2)
+            parse_pool.assert_not_called()
+            results = fetch_and_parse(self.urls[0:2], stand_in_call, {}, max_workers=4, parse_workers=8)
+            fetch_and_parse(self.urls, stand_in_call, {}, max_workers=4, parse_workers=8)
+        self.assertEqual(['/0', '/1'], results)
+        self.assertEqual([mock.call(2), mock.call(flowsa.common.http_max_parse_workers)], parse_pool.call_args_list)
+
+    def test_backpressure(self):
+        self.server.delay = 0.05
+        results = fetch_and_parse(self.urls[0:4], slow_parse, {'seconds': 0.1}, max_workers=4, parse_workers=1,
+                                  max_pending=1)
+        self.assertEqual(['/' + str(i) for i in range(4)], results)
+        # a url is only requested once the previous response is parsed
+        self.assertEqual(1, self.server.max_in_flight)
+
+    def test_download_error(self):
+        request = flowsa.common.make_http_request
+
+        def failing_request(url, *args, **kwargs):
+            if url == self.urls[0]:
+                raise ValueError('bad url')
+            return request(url, *args, **kwargs)
+
+        self.server.delay = 0.05
+        outcome = []
+
+        def run():
+            try:
+                fetch_and_parse(self.urls, stand_in_call, {}, max_workers=4, parse_workers=1, max_pending=2)
+            except ValueError as e:
+                outcome.append(e)
+
+        with mock.patch('flowsa.common.make_http_request', failing_request):
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            thread.join(20)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual('bad url', str(outcome[0]))
+
+    def test_response_pickled_without_body(self):
+        r = make_http_request(self.url + '/zip')
+        restored = pickle.loads(pickle.dumps(r))
+        self.assertNotIn(self.server.zip_body, pickle.dumps(r))
+        self.assertEqual(self.server.zip_body, restored.content)
+        self.assertEqual(r.headers['Content-Length'], restored.headers['Content-Length'])
+
+
+class TestHttpSession(StandInServerTestCase):
+
+    def test_connections_reused(self):
+        for url in self.urls[0:4]:
+            make_http_request(url)
+        self.assertEqual(1, self.server.connections_opened)
+        stats = http_stats()[self.url[len('http://'):]]
+        self.assertEqual(4, stats['requests'])
+        self.assertEqual(sum(len('/' + str(i)) for i in range(4)), stats['bytes'])
+
+    def test_retry_with_backoff(self):
+        with mock.patch('flowsa.common.http_backoff_factor', 0.01):
+            flowsa.common.close_http_session()
+            r = make_http_request(self.url + '/flaky')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(3, self.server.flaky_requests)
+        stats = http_stats()[self.url[len('http://'):]]
+        self.assertEqual((1, 2, 0), (stats['requests'], stats['retries'], stats['errors']))
+
+    def test_read_timeout(self):
+        with mock.patch('flowsa.common.http_retries', 1), mock.patch('flowsa.common.http_backoff_factor', 0.01):
+            flowsa.common.close_http_session()
+            start = time.perf_counter()
+            r = make_http_request(self.url + '/slow', timeout=(1, 0.1))
+        self.assertLess(time.perf_counter() - start, 0.9)
+        self.assertEqual([], r)
+        self.assertEqual(1, http_stats()[self.url[len('http://'):]]['errors'])
+
+
+class TestResponseCache(StandInServerTestCase):
+
+    def test_conditional_refresh(self):
+        self.assertEqual('versioned', make_http_request(self.url + '/etag?year=2015&key=abc').text)
+        # the api key is not part of the cache key, so the cached response is refreshed with a conditional request
+        r = make_http_request(self.url + '/etag?key=def&year=2015')
+        self.assertEqual('versioned', r.text)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(1, self.server.full_responses)
+        self.assertEqual(1, http_stats()[self.url[len('http://'):]]['cached'])
+        for f in os.listdir(self.cache.name):
+            with open(os.path.join(self.cache.name, f), 'rb') as cached:
+                self.assertNotIn(b'abc', cached.read())
+
+    def test_offline(self):
+        make_http_request(self.url + '/etag?year=2015')
+        self.server.shutdown()
+        self.addCleanup(set_offline, False)
+        set_offline()
+        self.assertEqual('versioned', make_http_request(self.url + '/etag?year=2015').text)
+        self.assertEqual([], make_http_request(self.url + '/etag?year=2016'))
+
+    def test_cache_key(self):
+        self.assertEqual('https://quickstats.nass.usda.gov/api/api_GET/?format=JSON&year=2017',
+                         response_cache_key('HTTPS://QuickStats.nass.usda.gov/api/api_GET/?key=abc&year=2017'
+                                            '&format=JSON#results'))
+
+
+class TestStreamedDownloads(StandInServerTestCase):
+
+    def test_zip_read_from_disk(self):
+        with mock.patch('flowsa.common.http_chunk_bytes', 64):
+            r = make_http_request(self.url + '/zip')
+        path = response_file(r)
+        self.assertTrue(path.startswith(self.cache.name))
+        df = epa_nei_call(self.url + '/zip', r, {})
+        self.assertEqual([10, 20], sorted(df['amount'].tolist()))
+        # the body is only read into memory when content is used
+        self.assertEqual(self.server.zip_body, r.content)
+
+    def test_uncached_body_removed(self):
+        r = make_http_request(self.url + '/zip', use_cache=False)
+        path = response_file(r)
+        self.assertTrue(os.path.isfile(path))
+        self.assertEqual([], os.listdir(self.cache.name))
+        del r
+        gc.collect()
+        self.assertFalse(os.path.isfile(path))
+
+    def test_ftp_streamed_to_file(self):
+        StandInFTP.instances = []
+        with mock.patch('ftplib.FTP', StandInFTP), mock.patch.object(StandInFTP, 'body', self.server.zip_body), \
+                mock.patch('flowsa.common.http_chunk_bytes', 64):
+            r = make_http_request('ftp://127.0.0.1/pub/nei.zip')
+        ftp = StandInFTP.instances[0]
+        self.assertGreater(ftp.blocks, 1)
+        self.assertTrue(ftp.closed)
+        self.assertTrue(response_file(r).startswith(self.cache.name))
+        df = epa_nei_call('ftp://127.0.0.1/pub/nei.zip', r, {})
+        self.assertEqual([10, 20], sorted(df['amount'].tolist()))
+
+    def test_ftp_error(self):
+        with mock.patch('ftplib.FTP', StandInFTP), \
+                mock.patch.object(StandInFTP, 'error', ftplib.error_perm('550 not found')):
+            self.assertEqual([], make_http_request('ftp://127.0.0.1/pub/missing.zip'))
+        self.assertEqual([], os.listdir(self.cache.name))
+        self.assertEqual(1, http_stats()['127.0.0.1']['errors'])
+
+
+if __name__ == '__main__':
+    unittest.main()
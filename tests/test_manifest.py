@@ -0,0 +1,65 @@
+# test_manifest.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Tests of the output manifest of stored flowbyactivity files """
+import os
+import flowsa
+from flowsa.flowbyactivity import store_flowbyactivity
+from flowsa.flowbyfunctions import check_if_data_exists_at_geoscale, filter_by_geoscale
+from flowsa.manifest import read_manifest, skip_flowbyactivity_files, flowbyactivity_exists_at_geoscale, \
+    location_geoscale
+from helpers import OutputDirTestCase, create_test_fba
+
+
+class TestManifest(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store_flowbyactivity(create_test_fba(2010), 'Test_Source', 2010)
+        store_flowbyactivity(create_test_fba(2015), 'Test_Source', 2015, partitioned=True)
+
+    def test_entries(self):
+        entries = read_manifest(self.path)
+        self.assertEqual(3, len(entries))
+        flat = [e for e in entries if e['year'] == '2010'][0]
+        self.assertEqual(5, flat['rows'])
+        self.assertEqual(['Land', 'Water'], flat['classes'])
+        self.assertEqual(['ACRES', 'Mgal'], flat['units'])
+        self.assertEqual({'national': ['00000'], 'state': ['06000'], 'county': ['06037']}, flat['locations'])
+        self.assertEqual(os.path.getsize(flat['path']), flat['bytes'])
+
+    def test_rewrite_replaces_entries(self):
+        store_flowbyactivity(create_test_fba(2015).iloc[0:1], 'Test_Source', 2015, partitioned=True)
+        entries = [e for e in read_manifest(self.path) if e['year'] == '2015']
+        self.assertEqual([['Water']], [e['classes'] for e in entries])
+
+    def test_exists_at_geoscale(self):
+        self.assertEqual("Yes", flowbyactivity_exists_at_geoscale('Test_Source', [2010], 'county', 'Cropland'))
+        self.assertEqual("No", flowbyactivity_exists_at_geoscale('Test_Source', [2015], 'national', 'Cropland'))
+        self.assertEqual("No", flowbyactivity_exists_at_geoscale('Test_Source', [2015], 'county', 'Mining',
+                                                                 flowclass=['Land']))
+        self.assertEqual("Yes", check_if_data_exists_at_geoscale(None, 'state', datasource='Test_Source',
+                                                                 years=[2015], flowclass=['Water']))
+
+    def test_location_geoscale(self):
+        # locations are classified as filter_by_geoscale selects them, not by their suffix
+        fba = create_test_fba(2015)
+        fba['Location'] = ['00000', '06000', '06037', '99000', '06999']
+        for geoscale in ('national', 'state', 'county'):
+            self.assertEqual(filter_by_geoscale(fba, geoscale, ['All'])['Location'].tolist(),
+                             [l for l in fba['Location'] if location_geoscale(l, 'FIPS_2015') == geoscale])
+        self.assertIsNone(location_geoscale('99000', 'FIPS_2015'))
+        self.assertIsNone(location_geoscale('06000', 'Census_Region'))
+
+    def test_changed_file_not_trusted(self):
+        create_test_fba(2010).iloc[3:].to_parquet(self.path + 'Test_Source_2010.parquet')
+        self.assertIsNone(flowbyactivity_exists_at_geoscale('Test_Source', [2010], 'county', 'Mining'))
+
+    def test_file_skipping(self):
+        files = [self.path + 'Test_Source_2010.parquet']
+        self.assertEqual([], skip_flowbyactivity_files(files, flowclass=['Energy']))
+        self.assertEqual([], skip_flowbyactivity_files(files, locations=['01000']))
+        self.assertEqual(files, skip_flowbyactivity_files(files, flowclass=['Water'], locations=['06000']))
+        fba = flowsa.getFlowByActivity(['Water'], [2010, 2015], 'Test_Source', locations=['01000'])
+        self.assertTrue(fba.empty)
@@ -0,0 +1,48 @@
+# test_query.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Tests of lazy flowbyactivity and flowbysector queries """
+from unittest import mock
+import pyarrow.dataset as ds
+import flowsa
+from flowsa.flowbyactivity import store_flowbyactivity
+from helpers import OutputDirTestCase, create_test_fba
+
+
+class TestFlowQuery(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store_flowbyactivity(create_test_fba(2010), 'Test_Source', 2010)
+        store_flowbyactivity(create_test_fba(2015), 'Test_Source', 2015, partitioned=True)
+
+    def test_query_is_lazy(self):
+        with mock.patch('flowsa.query.scan_flowbyactivity') as scan:
+            flowsa.query_fba('Test_Source', [2015], ['Water']).where(locations='06000').select('FlowAmount')
+        scan.assert_not_called()
+
+    def test_where_select(self):
+        df = flowsa.query_fba('Test_Source', [2010, 2015], ['Water']).where(locations='06037', Year=2015) \
+            .select('Location', 'FlowAmount').to_pandas()
+        self.assertEqual(['Location', 'FlowAmount'], list(df.columns))
+        self.assertEqual([30.0], df['FlowAmount'].tolist())
+
+    def test_where_expression(self):
+        df = flowsa.query_fba('Test_Source', [2015]).where(ds.field('FlowAmount') > 25).to_pandas()
+        self.assertEqual([30.0, 40.0, 50.0], sorted(df['FlowAmount'].tolist()))
+
+    def test_groupby_sum_across_layouts(self):
+        query = flowsa.query_fba('Test_Source', [2010, 2015]).groupby('Class', 'Unit')
+        for engine in ('arrow', 'auto'):
+            df = query.sum().to_pandas(engine=engine).sort_values('Class')
+            self.assertEqual(['Land', 'Water'], df['Class'].tolist())
+            self.assertEqual([180.0, 120.0], df['FlowAmount'].tolist())
+
+    def test_sum_requires_groupby(self):
+        with self.assertRaises(ValueError):
+            flowsa.query_fba('Test_Source', [2015]).sum()
+
+    def test_missing_fbs(self):
+        with mock.patch('flowsa.query.fbsoutputpath', self.path):
+            self.assertTrue(flowsa.query_fbs('Test_Method').to_pandas().empty)
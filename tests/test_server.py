@@ -0,0 +1,70 @@
+# test_server.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Tests of the local flowbyactivity/flowbysector query server """
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+from unittest import mock
+import pyarrow as pa
+from flowsa.flowbyactivity import store_flowbyactivity
+from flowsa.server import make_server
+from helpers import OutputDirTestCase, create_test_fba
+
+
+class TestQueryServer(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store_flowbyactivity(create_test_fba(2015), 'Test_Source', 2015)
+        self.server = make_server(port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+    def get(self, path):
+        with urllib.request.urlopen(self.url + path) as response:
+            return response.headers['Content-Type'], response.read()
+
+    def test_json_query(self):
+        content_type, body = self.get('/fba?source=Test_Source&year=2015&class=Water&location=06000,06037')
+        self.assertEqual('application/json', content_type)
+        self.assertEqual([20.0, 30.0], [r['FlowAmount'] for r in json.loads(body)])
+
+    def test_arrow_clean_query(self):
+        content_type, body = self.get('/fba?source=Test_Source&year=2015&class=Land&clean=1&format=arrow')
+        self.assertEqual('application/vnd.apache.arrow.stream', content_type)
+        df = pa.ipc.open_stream(io.BytesIO(body)).read_all().to_pandas()
+        self.assertEqual(['m2.yr', 'm2.yr'], df['Unit'].tolist())
+        self.assertNotIn('Description', df.columns)
+        self.get('/fba?source=Test_Source&year=2015&class=Land&clean=1&format=arrow')
+        stats = json.loads(self.get('/stats')[1])
+        self.assertEqual(1, stats['clean_cache']['hits'])
+        self.assertEqual(2, stats['requests']['/fba']['requests'])
+
+    def test_clean_columns(self):
+        # cleaning harmonizes units, which needs the unit and amount columns even when they are not requested
+        content_type, body = self.get('/fba?source=Test_Source&year=2015&class=Land&clean=1&column=Location')
+        self.assertEqual([{'Location': '06000'}, {'Location': '06037'}], json.loads(body))
+        # a cached cleaned df is returned without loading the files again
+        with mock.patch('flowsa.getFlowByActivity') as load:
+            self.get('/fba?source=Test_Source&year=2015&class=Land&clean=1&column=Location')
+        load.assert_not_called()
+
+    def test_bad_request(self):
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            self.get('/fba?source=Test_Source')
+        self.assertEqual(400, e.exception.code)
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            self.get('/other')
+        self.assertEqual(404, e.exception.code)
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            self.get('/fbs?method=Test_Method&sector_level=two')
+        self.assertEqual(400, e.exception.code)
+        # requests are counted before they are answered, so a client sees its own requests in /stats
+        stats = json.loads(self.get('/stats')[1])
+        self.assertEqual((1, 1), (stats['requests']['/fbs']['requests'], stats['requests']['/fbs']['errors']))
@@ -0,0 +1,431 @@
+# test_storage.py (tests)
+# !/usr/bin/env python3
+# coding=utf-8
+
+""" Tests of reading stored flowbyactivity and flowbysector parquet files """
+import os
+import threading
+from unittest import mock
+import pandas as pd
+import pyarrow.parquet as pq
+import flowsa
+import pyarrow.dataset as ds
+from flowsa.__main__ import main
+from flowsa.flowbyactivity import store_flowbyactivity
+from flowsa.flowbysector import store_flowbysector, store_flowbysector_collapsed
+from flowsa.common import flow_by_activity_fields, sourceconfigpath
+from flowsa.storage import ipc_sidecar_path, read_ipc_sidecar, file_content_hash, content_fingerprint, \
+    flowby_table, stored_clean_stamp, read_vintage_dictionaries, read_vintage_file, flowbyactivity_files
+from flowsa.flowbyfunctions import clean_df, aggregator, fba_fill_na_dict, collapse_fbs_sectors
+from helpers import OutputDirTestCase, create_test_fba, create_test_fbs
+
+
+class TestGetFlowByActivity(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for y in (2010, 2015):
+            create_test_fba(y).to_parquet(self.path + 'Test_Source_' + str(y) + '.parquet', engine="pyarrow")
+
+    def test_class_filter(self):
+        fba = flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source')
+        self.assertEqual(3, len(fba))
+        self.assertEqual({'Water'}, set(fba['Class']))
+
+    def test_pushdown_filters(self):
+        fba = flowsa.getFlowByActivity(['Water'], [2010, 2015], 'Test_Source', locations=['06000', '06037'],
+                                       activities=['Mining'], compartments=['surface'])
+        self.assertEqual([20.0, 20.0], fba['FlowAmount'].tolist())
+        self.assertEqual({2010, 2015}, set(fba['Year']))
+
+    def test_column_selection(self):
+        fba = flowsa.getFlowByActivity(['Land'], [2015], 'Test_Source', columns=['Location', 'FlowAmount'],
+                                       flownames='AREA')
+        self.assertEqual(['Location', 'FlowAmount'], list(fba.columns))
+        self.assertEqual(90.0, fba['FlowAmount'].sum())
+
+    def test_missing_year(self):
+        fba = flowsa.getFlowByActivity(['Water'], [2012], 'Test_Source')
+        self.assertTrue(fba.empty)
+
+
+class TestParquetWriterProfile(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store_flowbyactivity(create_test_fba(2015), 'Test_Source', 2015)
+        self.file = pq.ParquetFile(self.path + 'Test_Source_2015.parquet')
+
+    def test_rows_sorted(self):
+        df = self.file.read().to_pandas()
+        self.assertEqual(['Land', 'Land', 'Water', 'Water', 'Water'], df['Class'].tolist())
+        self.assertEqual(['06000', '06037', '00000', '06000', '06037'], df['Location'].tolist())
+
+    def test_row_group_metadata(self):
+        row_group = self.file.metadata.row_group(0)
+        self.assertEqual(['Class', 'Location', 'ActivityProducedBy', 'ActivityConsumedBy'],
+                         [self.file.schema_arrow.names[c.column_index] for c in row_group.sorting_columns])
+        location = row_group.column(self.file.schema_arrow.names.index('Location'))
+        self.assertEqual(('00000', '06037'), (location.statistics.min, location.statistics.max))
+        self.assertEqual('ZSTD', location.compression)
+        self.assertTrue(location.has_offset_index)
+
+
+class TestPartitionedFlowByActivity(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # 2010 is stored in the legacy flat layout, the other years are partitioned
+        store_flowbyactivity(create_test_fba(2010), 'Test_Source', 2010)
+        for y in (2012, 2015):
+            store_flowbyactivity(create_test_fba(y), 'Test_Source', y, partitioned=True)
+
+    def test_partition_layout(self):
+        self.assertTrue(os.path.isfile(self.path + 'source=Test_Source/year=2015/Class=Land/Test_Source_2015.parquet'))
+
+    def test_partitioned_and_flat_years(self):
+        fba = flowsa.getFlowByActivity(['Water'], [2010, 2012, 2015], 'Test_Source')
+        self.assertEqual(9, len(fba))
+        self.assertEqual('Class', fba.columns[0])
+        self.assertEqual(list(create_test_fba().columns), list(fba.columns))
+        self.assertEqual({2010, 2012, 2015}, set(fba['Year']))
+
+    def test_partition_pruning(self):
+        fba = flowsa.getFlowByActivity(['Land'], [2015], 'Test_Source', locations=['06037'])
+        self.assertEqual([50.0], fba['FlowAmount'].tolist())
+        self.assertEqual(['Land'], fba['Class'].tolist())
+
+    def test_rewrite_replaces_year(self):
+        store_flowbyactivity(create_test_fba(2015).iloc[0:1], 'Test_Source', 2015, partitioned=True)
+        fba = flowsa.getFlowByActivity(['Water', 'Land'], [2015], 'Test_Source')
+        self.assertEqual(1, len(fba))
+
+    def test_year_required(self):
+        for layout in ({'partitioned': True}, {'vintages': True}):
+            with self.assertRaises(ValueError):
+                store_flowbyactivity(create_test_fba(2015), 'Test_Source', **layout)
+        # the stored years are left in place
+        self.assertEqual(15, len(flowsa.getFlowByActivity(['Water', 'Land'], [2010, 2012, 2015], 'Test_Source')))
+
+
+class TestVintageFlowByActivity(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for y in (2010, 2015):
+            store_flowbyactivity(create_test_fba(y), 'Test_Source', y, vintages=True)
+        self.year_file = self.path + 'Test_Source_vintages/year=2015/Test_Source_2015.parquet'
+
+    def test_codes_stored(self):
+        schema = pq.read_schema(self.year_file)
+        self.assertEqual('int32', str(schema.field('Location').type))
+        dictionaries = read_vintage_dictionaries(self.path + 'Test_Source_vintages/_dictionary.parquet')
+        # the years share their location values
+        self.assertEqual(['00000', '06000', '06037'], sorted(dictionaries['Location'].to_pylist()))
+
+    def test_read_matches_stored(self):
+        fba = flowsa.getFlowByActivity(['Water', 'Land'], [2010, 2015], 'Test_Source')
+        expected = pd.concat([create_test_fba(2010), create_test_fba(2015)], ignore_index=True)
+        sort = ['Year', 'FlowAmount']
+        pd.testing.assert_frame_equal(expected.sort_values(sort).reset_index(drop=True),
+                                      fba[expected.columns].sort_values(sort).reset_index(drop=True),
+                                      check_dtype=False)
+
+    def test_filters_and_categories(self):
+        fba = flowsa.getFlowByActivity(['Land'], [2010, 2015], 'Test_Source', locations=['06037'], categorical=True,
+                                       columns=['Location', 'FlowAmount', 'Year'])
+        self.assertEqual([50.0, 50.0], fba['FlowAmount'].tolist())
+        self.assertEqual(['Location', 'FlowAmount', 'Year'], list(fba.columns))
+        # both years decode to the shared dictionary, so the column stays categorical
+        self.assertTrue(pd.api.types.is_categorical_dtype(fba['Location']))
+
+    def test_rewrite_replaces_year(self):
+        df = create_test_fba(2015).iloc[0:1].copy()
+        df['Location'] = '48000'
+        store_flowbyactivity(df, 'Test_Source', 2015, vintages=True)
+        self.assertEqual(1, len(flowsa.getFlowByActivity(['Water', 'Land'], [2015], 'Test_Source')))
+        self.assertEqual(5, len(flowsa.getFlowByActivity(['Water', 'Land'], [2010], 'Test_Source')))
+        self.assertEqual(['48000'], read_vintage_file(self.year_file, columns=['Location'])['Location'].to_pylist())
+
+    def test_move_years(self):
+        store_flowbyactivity(create_test_fba(2012), 'Test_Source', 2012)
+        main(['vintages', '--source', 'Test_Source', '--years', '2012'])
+        self.assertTrue(os.path.isfile(self.path + 'Test_Source_vintages/year=2012/Test_Source_2012.parquet'))
+        fba = flowsa.getFlowByActivity(['Water'], [2010, 2012, 2015], 'Test_Source')
+        self.assertEqual({2010, 2012, 2015}, set(fba['Year']))
+        # the flat copy is moved, not left behind
+        self.assertFalse(os.path.isfile(self.path + 'Test_Source_2012.parquet'))
+
+    def test_concurrent_writers(self):
+        years = list(range(2000, 2008))
+
+        def store(y):
+            df = create_test_fba(y)
+            df['Location'] = str(y)
+            store_flowbyactivity(df, 'Test_Source', y, vintages=True)
+
+        threads = [threading.Thread(target=store, args=(y,)) for y in years]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # each writer extends the dictionary the others left, so every year decodes to its own values
+        fba = flowsa.getFlowByActivity(['Water', 'Land'], years, 'Test_Source')
+        self.assertEqual({str(y): {y} for y in years}, fba.groupby('Location')['Year'].agg(set).to_dict())
+        self.assertEqual([], [f for f in os.listdir(self.path + 'Test_Source_vintages') if f.endswith('.tmp')])
+
+
+class TestSectorPrefixQuery(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fbs = create_test_fbs()
+        with mock.patch('flowsa.flowbysector.fbs_row_group_size', 100):
+            store_flowbysector(self.fbs, 'Test_Method')
+
+    def test_prefix_and_level(self):
+        fbs = flowsa.getFlowBySector('Test_Method', sector_prefix=['31', '32', '33'], locations=['48000'])
+        self.assertEqual(sorted(['31', '32', '33'] + [str(s) for s in range(3100, 3400, 10)]),
+                         sorted(fbs['SectorConsumedBy'].tolist()))
+        fbs = flowsa.getFlowBySector('Test_Method', sector_prefix='31', sector_level=2)
+        self.assertEqual(['31', '31'], fbs['SectorConsumedBy'].tolist())
+        fbs = flowsa.query_fbs('Test_Method').where(sector_level=4, locations='06000').to_pandas()
+        self.assertEqual(900, len(fbs))
+
+    def test_prefix_row_group_pruning(self):
+        fragment = next(ds.dataset(self.fbs_path + 'Test_Method.parquet').get_fragments())
+        expression = flowsa.build_sector_expression('31')
+        row_groups = fragment.split_by_row_group(expression)
+        self.assertEqual(20, fragment.metadata.num_row_groups)
+        # the 22 rows of '31' sectors in both states are in at most 2 consecutive row groups of 100 rows
+        self.assertLessEqual(len(row_groups), 2)
+
+
+class TestCollapsedFlowBySector(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fbs = create_test_fbs()
+        self.fbs['SectorProducedBy'] = 'None'
+        self.fbs.loc[0:9, 'FlowType'] = 'TECHNOSPHERE_FLOW'
+        self.fbs.loc[10:19, 'FlowType'] = 'WASTE_FLOW'
+        store_flowbysector(self.fbs, 'Test_Method')
+        store_flowbysector_collapsed(self.fbs, 'Test_Method')
+
+    def test_collapsed_file_used(self):
+        expected = collapse_fbs_sectors(self.fbs)
+        self.assertNotIn('Sector', self.fbs.columns)
+        with mock.patch('flowsa.collapse_fbs_sectors') as collapse:
+            fbs = flowsa.getFlowBySector_collapsed('Test_Method')
+        collapse.assert_not_called()
+        self.assertEqual(len(expected), len(fbs))
+        pd.testing.assert_series_equal(expected['Sector'].reset_index(drop=True), fbs['Sector'],
+                                       check_categorical=False)
+
+    def test_stale_collapsed_file_ignored(self):
+        store_flowbysector(self.fbs.iloc[0:100], 'Test_Method')
+        fbs = flowsa.getFlowBySector_collapsed('Test_Method')
+        self.assertEqual(100, len(fbs))
+
+    def test_unfingerprinted_file_collapsed(self):
+        # neither the FBS parquet nor the provenance of the collapsed file hold a fingerprint for the method
+        self.fbs.iloc[0:100].to_parquet(self.fbs_path + 'Test_Method.parquet')
+        collapse_fbs_sectors(self.fbs).to_parquet(self.fbs_path + 'Test_Method_collapsed.parquet')
+        fbs = flowsa.getFlowBySector_collapsed('Test_Method')
+        self.assertEqual(100, len(fbs))
+
+
+class TestCategoricalSchema(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store_flowbyactivity(create_test_fba(2015), 'Test_Source', 2015)
+        store_flowbyactivity(create_test_fba(2012), 'Test_Source', 2012, partitioned=True)
+
+    def test_categorical_read(self):
+        fba = flowsa.getFlowByActivity(['Water'], [2012, 2015], 'Test_Source', categorical=True)
+        for c in ('Class', 'Location', 'Unit', 'ActivityProducedBy', 'Compartment'):
+            self.assertTrue(pd.api.types.is_categorical_dtype(fba[c]), c)
+        self.assertFalse(pd.api.types.is_categorical_dtype(fba['Description']))
+        self.assertEqual(['None'] * 6, fba['ActivityProducedBy'].tolist())
+
+    def test_categorical_clean_df_matches(self):
+        fba = flowsa.getFlowByActivity(['Water', 'Land'], [2015], 'Test_Source')
+        fba_cat = flowsa.getFlowByActivity(['Water', 'Land'], [2015], 'Test_Source', categorical=True)
+        fba = clean_df(fba, flow_by_activity_fields, fba_fill_na_dict)
+        fba_cat = clean_df(fba_cat, flow_by_activity_fields, fba_fill_na_dict, categorical=True)
+        self.assertTrue(pd.api.types.is_categorical_dtype(fba_cat['Unit']))
+        pd.testing.assert_frame_equal(fba, fba_cat.astype({c: 'str' for c in fba_cat.columns
+                                                           if pd.api.types.is_categorical_dtype(fba_cat[c])}))
+
+    def test_categorical_aggregator(self):
+        fba = flowsa.getFlowByActivity(['Water', 'Land'], [2015], 'Test_Source', categorical=True)
+        fba = clean_df(fba, flow_by_activity_fields, fba_fill_na_dict, categorical=True)
+        # only observed combinations of categories are returned
+        agg = aggregator(fba, ['Class', 'Unit'])
+        self.assertEqual(2, len(agg))
+        self.assertEqual(60.0, agg.loc[agg['Class'] == 'Water', 'FlowAmount'].iloc[0])
+
+    def test_categorical_frame_stored_as_strings(self):
+        fba = clean_df(create_test_fba(2017), flow_by_activity_fields, fba_fill_na_dict, categorical=True)
+        store_flowbyactivity(fba, 'Test_Source', 2017)
+        stored = pd.read_parquet(self.path + 'Test_Source_2017.parquet')
+        self.assertEqual(object, stored['Location'].dtype)
+
+
+class TestIPCSidecar(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.parquet = self.path + 'Test_Source_2015.parquet'
+        store_flowbyactivity(create_test_fba(2015), 'Test_Source', 2015, ipc_sidecar=True)
+
+    def test_sidecar_written(self):
+        self.assertTrue(os.path.isfile(ipc_sidecar_path(self.parquet)))
+        table = read_ipc_sidecar(self.parquet)
+        self.assertEqual(5, table.num_rows)
+
+    def test_sidecar_read_matches_parquet(self):
+        fba = flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source', locations=['06000', '06037'])
+        self.assertEqual([20.0, 30.0], fba['FlowAmount'].tolist())
+        fba = flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source', categorical=True)
+        self.assertTrue(pd.api.types.is_categorical_dtype(fba['Location']))
+
+    def test_stale_sidecar_rebuilt(self):
+        # replace the parquet without writing a new sidecar
+        store_flowbyactivity(create_test_fba(2015).iloc[0:2], 'Test_Source', 2015)
+        fba = flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source')
+        self.assertEqual(2, len(fba))
+        metadata = read_ipc_sidecar(self.parquet).schema.metadata
+        self.assertEqual(file_content_hash(self.parquet).encode(), metadata[b'flowsa.parquet_sha256'])
+
+    def test_read_only_stale_sidecar(self):
+        store_flowbyactivity(create_test_fba(2015).iloc[0:2], 'Test_Source', 2015)
+        os.chmod(self.path, 0o555)
+        self.addCleanup(os.chmod, self.path, 0o755)
+        if os.access(self.path, os.W_OK):
+            # permissions do not apply to root, fail the write as the read-only directory would
+            self.patch('flowsa.storage.tempfile.mkstemp', mock.Mock(side_effect=PermissionError(13, 'read-only')))
+        self.assertIsNone(read_ipc_sidecar(self.parquet))
+        fba = flowsa.getFlowByActivity(['Water'], [2015], 'Test_Source')
+        self.assertEqual([10.0, 20.0], fba['FlowAmount'].tolist())
+
+    def test_concurrent_rebuilds(self):
+        store_flowbyactivity(create_test_fba(2015).iloc[0:2], 'Test_Source', 2015)
+        errors = []
+
+        def read():
+            try:
+                self.assertEqual(2, read_ipc_sidecar(self.parquet).num_rows)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertEqual([], [f for f in os.listdir(self.path) if f.endswith('.tmp')])
+
+
+class TestFingerprint(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fba = create_test_fba(2015)
+
+    def test_order_independent(self):
+        shuffled = self.fba.sample(frac=1, random_state=1)[list(reversed(self.fba.columns))]
+        self.assertEqual(content_fingerprint(flowby_table(self.fba, preserve_index=False)),
+                         content_fingerprint(flowby_table(shuffled, preserve_index=False)))
+
+    def test_content_changes_fingerprint(self):
+        changed = self.fba.copy()
+        changed.loc[0, 'FlowAmount'] = 11.0
+        swapped = self.fba.copy()
+        swapped.loc[0, 'FlowName'], swapped.loc[1, 'FlowName'] = 'saline', 'fresh'
+        fingerprints = [content_fingerprint(flowby_table(df, preserve_index=False))
+                        for df in (self.fba, changed, swapped, self.fba.iloc[0:4])]
+        self.assertEqual(4, len(set(fingerprints)))
+
+    def test_fingerprint_in_footer(self):
+        # stored under a real source name so the source config is recorded
+        store_flowbyactivity(self.fba, 'USGS_NWIS_WU', 2015)
+        f = self.path + 'USGS_NWIS_WU_2015.parquet'
+        self.assertEqual(content_fingerprint(pq.read_table(f)), flowsa.fingerprint(f))
+        self.assertEqual(file_content_hash(sourceconfigpath + 'USGS_NWIS_WU.yaml'),
+                         flowsa.read_provenance(f)['USGS_NWIS_WU.yaml'])
+
+
+class TestCleanStamp(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # a df clean_df would not change, other than dropping the description
+        self.clean_fba = clean_df(create_test_fba(2015), flow_by_activity_fields, fba_fill_na_dict)
+        self.clean_fba['Description'] = 'test data'
+
+    def test_clean_file_stamped(self):
+        store_flowbyactivity(self.clean_fba, 'Test_Source', 2015)
+        store_flowbyactivity(create_test_fba(2010), 'Test_Source', 2010)
+        self.assertEqual('FBA.1', stored_clean_stamp([self.path + 'Test_Source_2015.parquet']))
+        # acres are converted by clean_df, so the file is not stamped
+        self.assertIsNone(stored_clean_stamp([self.path + 'Test_Source_2010.parquet']))
+
+    def test_empty_clean_load(self):
+        # a missing year, or a filter matching nothing, returns an empty df with the flowby fields
+        fba = flowsa.getFlowByActivity(['Water'], [2012], 'Test_Source', clean=True)
+        self.assertTrue(fba.empty)
+        self.assertIn('FlowAmount', fba.columns)
+        self.assertEqual('float64', str(fba['FlowAmount'].dtype))
+        fba = flowsa.getFlowByActivity(['Water'], [2012], 'Test_Source', clean=True, columns=['Location', 'Unit'])
+        self.assertEqual(['Location', 'Unit'], list(fba.columns))
+        fbs = flowsa.getFlowBySector('Missing_Method', clean=True)
+        self.assertIn('SectorConsumedBy', fbs.columns)
+
+    def test_vintage_file_stamped(self):
+        store_flowbyactivity(self.clean_fba, 'Test_Source', 2015, vintages=True)
+        # the shared dictionary file is read with the year, but is not stamped itself
+        self.assertEqual('FBA.1', stored_clean_stamp(flowbyactivity_files('Test_Source', [2015])))
+
+    def test_clean_load(self):
+        store_flowbyactivity(self.clean_fba, 'Test_Source', 2015, partitioned=True)
+        store_flowbyactivity(create_test_fba(2010), 'Test_Source', 2010)
+        for years in ([2015], [2010], [2010, 2015]):
+            fba = flowsa.getFlowByActivity(['Land', 'Water'], years, 'Test_Source')
+            expected = clean_df(fba, flow_by_activity_fields, fba_fill_na_dict)
+            cleaned = flowsa.getFlowByActivity(['Land', 'Water'], years, 'Test_Source', clean=True)
+            pd.testing.assert_frame_equal(expected.sort_values('FlowAmount').reset_index(drop=True),
+                                          cleaned.sort_values('FlowAmount').reset_index(drop=True))
+        # the cached df is not changed by cleaning
+        self.assertIn('Description', flowsa.getFlowByActivity(['Land'], [2015], 'Test_Source').columns)
+        cleaned = flowsa.getFlowByActivity(['Land'], [2015], 'Test_Source', columns=['Location', 'FlowAmount'],
+                                           clean=True)
+        self.assertEqual(['Location', 'FlowAmount'], list(cleaned.columns))
+
+
+class TestIterFlowByActivity(OutputDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store_flowbyactivity(create_test_fba(2010), 'Test_Source', 2010)
+        store_flowbyactivity(create_test_fba(2015), 'Test_Source', 2015, partitioned=True)
+
+    def test_chunks_match_full_load(self):
+        chunks = list(flowsa.iterFlowByActivity(['Water', 'Land'], [2010, 2015], 'Test_Source', batch_rows=2))
+        self.assertTrue(all(0 < len(c) <= 2 for c in chunks))
+        fba = clean_df(flowsa.getFlowByActivity(['Water', 'Land'], [2010, 2015], 'Test_Source'),
+                       flow_by_activity_fields, fba_fill_na_dict)
+        streamed = pd.concat(chunks, ignore_index=True)
+        sort = ['Year', 'Class', 'FlowAmount']
+        pd.testing.assert_frame_equal(fba.sort_values(sort).reset_index(drop=True),
+                                      streamed.sort_values(sort).reset_index(drop=True))
+
+    def test_filtered_categorical_chunks(self):
+        chunks = list(flowsa.iterFlowByActivity(['Water'], [2010, 2015], 'Test_Source', locations=['06037'],
+                                                columns=['Class', 'Location', 'FlowAmount'], categorical=True))
+        streamed = pd.concat(chunks, ignore_index=True)
+        self.assertEqual(['Class', 'Location', 'FlowAmount'], list(streamed.columns))
+        self.assertEqual([30.0, 30.0], streamed['FlowAmount'].tolist())
+        self.assertTrue(all(pd.api.types.is_categorical_dtype(c['Location']) for c in chunks))